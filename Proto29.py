@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 # Copyright (c) 2014 Adafruit Industries, 2019 R.S. Fowler
 # Author: Tony DiCola - for content from simpletest.py
 # Author: R.S. Fowler for WG Oven Thermometer project
@@ -26,14 +26,62 @@
 #logging.basicConfig(level=logging.DEBUG)
 # ---- End of Adafruit disclaimer - RSF too
 
+import time # imported first, to time the startup from here
+Starttime = time.time() # when the programme started, for the startup profile
+
 # -----Define testing variables - up front for ease of access.
 Forcetft = True # if False, SDL will try X11 first. If True, the PiTFT will be forced.
 Debugprt = True # if True, some debug printing will be enabled
-Tempadj = -3.0 # Fixed temperature adjustment in C - from calibration testing
-Glitchless = False # Cheat - if True, one time temp differences will be removed
+Probecs = [6] # chip select GPIO for each MAX31855 board, sharing CLK and DO. The first is the main probe
+Probeadj = [-3.0] # Fixed temperature adjustment in C for each probe - from calibration testing
+Spibackend = 'bitbang' # 'bitbang' reads the probes from Python, 'spidev' uses the hardware SPI bus, 'auto' tries 'spidev' then 'bitbang'
+Spiport = 1 # the hardware SPI bus and device for 'spidev', i.e. /dev/spidev1.0, since the PiTFT uses bus 0
+Spidevice = 0
+Filters = '' # filters for the graphed temperatures, e.g. 'median:3' removes one time glitches, see WGOTfilter.py, '' = none
+Filterprime = 1000 # number of logged samples to restart the filters from, when resuming
+Samplerate = 4 # probe readings per second, taken by the acquisition thread
+Oversample = 4 # number of recent probe readings averaged for each temperature, 1 = no averaging
+Adaptive = False # True starts with adaptive recording, the 'Auto' Time Interval, which records often while the temperature changes and seldom while it holds
+Adaptfast = 2 # seconds between adaptive recording checks, which is as often as it records
+Deadband = 0.5 # C a probe must move from the last recorded sample before adaptive recording records it again
+Maxgap = 300 # most seconds between adaptively recorded samples, even if nothing moves
+Seriesmax = 200000 # maximum recorded points kept in memory for graphs, 16 bytes each
+Seriesretain = 'decimate' # when full, 'decimate' halves the detail of the whole session, 'drop' drops the oldest half
 # The following should really be made arguments for the command line
 Csvfilename = '/home/pi/WGOTdata.csv'
+Binfilename = '/home/pi/WGOTdata.bin' # compact binary log alongside the csv log, '' = none
 Graphfile = '/home/pi/WGOTgraph.png'
+Logmode = 'batch' # 'sample' flushes the log every sample, 'batch' every Logbatch sec, 'fsync' also fsyncs every Logfsync sec
+Logbatch = 30 # seconds between log flushes in 'batch' and 'fsync' modes
+Logfsync = 300 # seconds between fsyncs to the SD card in 'fsync' mode
+Loggens = 5 # number of old generations of each log to keep, save1 is the newest
+Logmaxsize = 50000000 # bytes, a log bigger than this is saved and a new one started, 0 = no limit
+Logrotatesession = False # True also saves the logs and starts new ones when button 3 restarts
+Logcompress = 'gzip' # 'gzip' or 'zstd' compresses saved logs in the background, '' = don't compress
+Logbudget = 500000000 # bytes, the oldest saved logs are removed to keep all logs within this, 0 = no limit
+Resume = False # True carries on with the last session from the logs at startup, e.g. after a power blip
+Prewarm = True # True loads matplotlib in the background after startup, if it's needed, so the first graph is quick
+Startlog = '/home/pi/WGOTstartup.log' # startup times are added to this file to track them, '' = none
+Graphexport = 0 # minimum seconds between Graphfile exports to the SD card, e.g. 60, 0 = never export
+Graphbackend = 'pygame' # 'pygame' draws a fast graph directly, 'matplotlib' draws a fancier one
+Graphworker = True # True draws the matplotlib graph in its own process, so the buttons and timers aren't held up
+Graphwindow = 0 # minutes shown by the pygame graph, scrolling as time goes by, 0 = whole session
+Textcachemax = 128 # maximum number of rendered text surfaces to keep for reuse
+# The following can also be set from the command line, see read_options
+Hardware = 'pi' # 'pi' uses the MAX31855, GPIO and PiTFT, 'sim' uses the WGOTsim stand-ins with no display
+Simspeed = 1.0 # how many times faster than real time the simulation runs
+Simreplay = '' # a csv log for the simulated probe to replay, '' = follow a heat curve
+Simnoise = 0.25 # standard deviation (C) of the simulated probe noise
+Simfaults = 0.0 # chance of a simulated probe fault on each reading
+Simseed = 1 # seed for the simulated noise and faults, so runs can be repeated
+Simbuttons = '' # simulated button presses, as seconds:GPIO pairs, e.g. '30:22,90:23'
+Simduration = 0 # virtual seconds to run the simulation for, 0 = until quit
+Profilefile = '' # if set, the main thread is profiled and the stats are saved here at exit
+Stallwatch = 5 # real seconds without a heartbeat from the event loop or the probe reading before it's reported as a stall, 0 = no watchdog
+Stalllog = '/home/pi/WGOTstalls.log' # stalls are added to this file with the threads' stacks, as well as printed, '' = printed only
+Metricsfile = '' # a Prometheus text file of the performance metrics, e.g. for node_exporter's textfile collector, '' = none
+Metricsinterval = 60 # seconds between performance summary lines and Metricsfile updates, 0 = never
+Webserver = '' # host:port to serve the live readings and graph to browsers, e.g. 'localhost:8080', or '0.0.0.0:8080' for the LAN, '' = none
 # -----End testing variables
 
 # -----Define some colour tuple names for shorthand use
@@ -42,6 +90,8 @@ WHITE = (255, 255, 255)
 RED = (255, 0, 0)
 GREEN = (0, 255, 0)
 BLUE = (0, 0, 255)
+GREY = (96, 96, 96)
+Probecolours = [RED, GREEN, (255, 160, 0), (255, 0, 255), (0, 255, 255), WHITE] # graph line for each probe
 
 ########################################
 # ----- Menu/Screen Definitions
@@ -98,8 +148,8 @@ timeadj_menu = {
     1: [2, 28, 4, None, 'Time Interval (sec)'],
     2: [4, 28, 4, None, '6'], # a dummy placeholder
     3: [14, 16, 4, None, '* Only Affects Ongoing Readings']}
-# Matching time adjust values for the above menu, in seconds
-Timevals = [6, 30, 60, 120, 600, 1800, 3600]
+# Matching time adjust values for the above menu, in seconds, 0 is 'Auto' for adaptive recording
+Timevals = [0, 6, 30, 60, 120, 600, 1800, 3600]
 
 # Define button labels dictionary to go with the tempatures screen
 # (right alignment is hard, hence the leading blanks and mono-spaced font)
@@ -121,25 +171,34 @@ button_menu2 = {
 # ----- Import all required packages
 ########################################
 # Note: all packages except MAX31855 and Matplotlib are part of Raspian Stretch
+# Note: only the display packages are imported here, so the splash screen shows quickly.
+#  The hardware and data packages are imported after the splash screen, and
+#  matplotlib is imported by WGOTrender when it's first needed.
 
-import time
+import math # used to pick tidy graph axis values
+from collections import OrderedDict # used to keep rendered text in least recently used order
 import os # used to update environment variables
 import sys # used to exit and to get command line arguments
 import getopt # used to parse command line arguments
+import threading # used to read the probe and write the log in the background
+import queue # used to pass log lines to the log writer thread
+import concurrent.futures # used to pass series snapshots to the web server thread
+import atexit # used to make sure the log is flushed however we exit
+import gzip # used to compress saved logs
+import shutil # used to copy saved logs into compressed files
+import faulthandler # used to dump the threads' stacks when the event loop stalls
+import signal # used to dump the threads' stacks on request
+import traceback # used to show the stack of a stalled thread
+try: # zstd compression is optional, gzip is used if it's not installed
+    import zstandard
+except ImportError:
+    zstandard = None
 from decimal import Decimal # needed to do correct temperature adjustment
 import pygame # used to manage the display contents and timers
 from pygame.locals import *
 from pygame import event, fastevent # fastevent is for multithreaded posts
-import RPi.GPIO as GPIO # GPIO is a shorthand name
-# The following require prior s/w installations.
-# Follow the directions on the back of the box for details.
-import Adafruit_GPIO.SPI as SPI # From Adafruit MAX31855 package
-import Adafruit_MAX31855.MAX31855 as MAX31855 # to talk to the MAX31855 board
-import matplotlib # used to make graphs
-# the following line allows this program to start from rc.local to avoid errors
-matplotlib.use('Agg') # Needed to run screenless matplotlib - BEFORE importing pyplot
-import matplotlib.pyplot as plt # plt is a shorthand name for Python Matplotlib
-import numpy as np # np is a shorthand name
+import WGOTmetrics # latency histograms and counters, to watch the performance
+Metrics = WGOTmetrics.Metrics() # the hot path stage times, added to by the @Metrics.timed functions
 
 ########################################
 #----- Function Definitions
@@ -160,85 +219,1219 @@ def gpiobut(channel): # 'channel' is PiTFT button's BCM GPIO value for GPIO even
 # ignore anything else
 #--End gpiobut callback function
 
-# --Define a function to convert Celsius to Fahrenheit.
-def c_to_f(c):
-    return c * 9.0 / 5.0 + 32.0
-# -- End c_to_f function
-    
-# --Define a function to get the temperature from the MAX31855 board
+# --Define a function to combine pairs of graph buckets into buckets twice the size
+# Each bucket is a row of [first time, last time, minimums, maximums, means],
+#  with a minimum, maximum and mean for each probe in turn, and a single point
+#  is just a bucket with the same time and values all through.
+# NaN values from probe faults are skipped, unless both buckets are NaN.
+def pair_buckets(first, second): # arrays of rows, paired up row by row
+    probes = (first.shape[1] - 2) // 3 # the number of probes
+    low, high, mean = slice(2, 2+probes), slice(2+probes, 2+probes*2), slice(2+probes*2, None)
+    paired = np.empty(first.shape)
+    paired[:, 0] = first[:, 0] # first time of the first bucket
+    paired[:, 1] = second[:, 1] # last time of the second bucket
+    paired[:, low] = np.fmin(first[:, low], second[:, low]) # fmin/fmax ignore NaN
+    paired[:, high] = np.fmax(first[:, high], second[:, high])
+    paired[:, mean] = np.where(np.isnan(first[:, mean]), second[:, mean],
+                               np.where(np.isnan(second[:, mean]), first[:, mean], (first[:, mean] + second[:, mean]) / 2))
+    return paired
+# --End pair_buckets function
+
+# --Define a class to hold one level of graph buckets, growing as needed
+class SeriesLevel(object):
+    def __init__(self, width, rows=None): # width is the number of values in each bucket
+        if rows is None: # start empty
+            rows = np.empty((0, width))
+        self.count = len(rows) # number of buckets in use
+        self.buf = np.empty((max(self.count * 2, 16), width))
+        self.buf[:self.count] = rows
+
+    def __len__(self):
+        return self.count
+
+    def append(self, row): # add a bucket to the end
+        if self.count == len(self.buf): # double the buffer size if it's full
+            newbuf = np.empty((self.count * 2, self.buf.shape[1]))
+            newbuf[:self.count] = self.buf
+            self.buf = newbuf
+        self.buf[self.count] = row
+        self.count = self.count + 1
+# --End SeriesLevel class
+
+# --Define a class to write a log file from a background thread
+# Note: lines are queued by write() and written by the thread, which flushes them
+#  following Logmode, so the event loop never waits on the SD card unless the
+#  queue is full. close() writes out anything queued before closing the file.
+# The thread also saves the log and starts a new one when it gets bigger than
+#  Logmaxsize, or when rotate() is called. header is a function giving the text
+#  (or bytes) to start each new file with, if needed.
+# The time the thread takes to write, flush and fsync is put in the metrics,
+#  as stages named after the file's extension, e.g. csv_write.
+# If writing fails, e.g. the SD card is full or read only, the error is
+#  reported once and that text is lost, but the thread carries on, reopening
+#  the file if it has to, so it recovers when the card does. If the thread
+#  has gone anyway, write() drops the text rather than wait for it forever.
+#  'dropped' counts the writes lost either way.
+class LogWriter(object):
+    ROTATE = object() # queued by rotate() to start a new file
+
+    def __init__(self, filename, mode='w', header=None, queuesize=1000):
+        self.filename = filename
+        self.mode = mode
+        self.header = header
+        self.queue = queue.Queue(queuesize) # lines waiting to be written
+        self.stalls = 0 # number of times write() had to wait for a full queue
+        self.rotations = 0 # number of new files started while running
+        self.dropped = 0 # number of writes lost to errors, or because the thread has gone
+        self.error = None # the last write error reported, so it's only reported once
+        self.rotateerror = None # the same for saving the log
+        self.kind = os.path.splitext(filename)[1].lstrip('.') or 'log' # e.g. 'csv', for the metrics
+        self.writetime = Metrics.stage(self.kind + '_write') # only the log writer thread adds to these
+        self.flushtime = Metrics.stage(self.kind + '_flush')
+        self.fsynctime = Metrics.stage(self.kind + '_fsync')
+        self.open()
+        self.thread = threading.Thread(target=self.run, name='logwriter')
+        self.thread.daemon = True # close() is used to finish up
+        self.thread.start()
+
+    def open(self, mode=None): # open a fresh file, with its header, or an existing one to append to
+        self.file = open(self.filename, mode or self.mode)
+        self.size = self.file.tell() # approximate bytes written to this file
+        if self.header != None and self.size == 0: # only new files need a header
+            self.file.write(self.header())
+
+    def write(self, text): # queue some text to be written
+        try:
+            self.queue.put_nowait(text)
+            return
+        except queue.Full: # wait rather than lose data
+            self.stalls = self.stalls + 1
+        while self.thread.is_alive(): # but only while there's a thread to wait for
+            try:
+                self.queue.put(text, timeout=1)
+                return
+            except queue.Full:
+                pass
+        self.dropped = self.dropped + 1
+
+    def rotate(self): # save this log and start a new one, after anything already queued
+        self.write(LogWriter.ROTATE)
+
+    def run(self): # the log writer thread (text or binary)
+        lastflush = lastsync = time.monotonic() # when the file was last flushed and synced
+        unflushed = False # whether anything has been written since the last flush
+        while True:
+            try:
+                text = self.queue.get(timeout=1) # wake up now and then, to flush on time
+            except queue.Empty:
+                text = ''
+            if text is None: # close() was called
+                break
+            try:
+                if self.file.closed: # a write or a new file failed, so try again, adding to what's there
+                    self.open(self.mode.replace('w', 'a'))
+                if text is LogWriter.ROTATE or (Logmaxsize > 0 and self.size >= Logmaxsize):
+                    self.finish() # save this file and start a new one
+                    try:
+                        rotate_log(self.filename)
+                        self.open()
+                        self.rotations = self.rotations + 1
+                        self.rotateerror = None
+                    except OSError as error: # carry on adding to this one, and try again after another Logmaxsize
+                        if str(error) != self.rotateerror: # only once
+                            self.rotateerror = str(error)
+                            print ("Log", self.filename, "can't be saved:", error)
+                        self.open(self.mode.replace('w', 'a'))
+                        self.size = 0
+                    lastflush = lastsync = time.monotonic()
+                    unflushed = False
+                    if text is LogWriter.ROTATE: # nothing else to write
+                        continue
+                if len(text) > 0: # write it out
+                    start = time.perf_counter()
+                    self.file.write(text)
+                    self.writetime.observe(time.perf_counter() - start)
+                    self.size = self.size + len(text)
+                    unflushed = True
+                now = time.monotonic()
+                if unflushed == True and (Logmode == 'sample' or now - lastflush >= Logbatch):
+                    start = time.perf_counter()
+                    self.file.flush() # pass it on to the OS
+                    self.flushtime.observe(time.perf_counter() - start)
+                    lastflush = now
+                    unflushed = False
+                    self.error = None # it's working
+                    if Logmode == 'fsync' and now - lastsync >= Logfsync: # make sure it's on the card
+                        start = time.perf_counter()
+                        os.fsync(self.file.fileno())
+                        self.fsynctime.observe(time.perf_counter() - start)
+                        lastsync = now
+            except (OSError, ValueError) as error: # lose this text, but keep going
+                if text is not LogWriter.ROTATE and len(text) > 0:
+                    self.dropped = self.dropped + 1
+                self.report(error)
+                self.abandon()
+                unflushed = False
+        try:
+            self.finish()
+        except (OSError, ValueError) as error:
+            self.report(error)
+
+    def report(self, error): # print an error, unless it's the same as the last one
+        if str(error) != self.error:
+            self.error = str(error)
+            print ("Log", self.filename, "failed:", error)
+
+    def abandon(self): # close the file after a failure, without writing out what's buffered, which may fail again
+        try:
+            self.file.close()
+        except (OSError, ValueError): # the buffer couldn't be written, but it's closed anyway
+            pass
+
+    def finish(self): # write out everything and close the file
+        if self.file.closed: # already, after a failure
+            return
+        try:
+            self.file.flush()
+            if Logmode == 'fsync':
+                os.fsync(self.file.fileno())
+        finally:
+            self.abandon()
+
+    def close(self): # finish writing and close the file, safe to call more than once
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+# --End LogWriter class
+
+# --Define a function to log a sample as a line of the csv log file and binary records
+# Note: the csv line has C and F columns for each probe, and the binary log a record for each probe
+# The binary records have the time, chip temperatures and faults of the probe
+#  reading in 'latest', which is Latest unless the sample was held back
+@Metrics.timed('log_sample')
+def log_sample(timex, temps, latest=None): # time in seconds and an array of probe temperatures in Celsius
+    if latest == None: # the probes' latest reading
+        latest = Latest
+    temps = temps.tolist() # plain Python values are much quicker to format
+    Csvlog.write("%d" % round(timex) + "".join([",%r,%r" % (tempc, c_to_f(tempc)) for tempc in temps]) + "\n") # write time (sec) and temps (C and F)
+    if Binlog != None: # add the probes' timestamp, chip temperatures and faults in the binary log
+        readtime, itemps, faults = latest[0] + Timeoffset, latest[2].tolist(), latest[3].tolist()
+        Binlog.write(b"".join([WGOTlog.pack_record(readtime, tempc, itemps[probe], faults[probe], probe, WGOTlog.SAMPLE, Session)
+                               for probe, tempc in enumerate(temps)]))
+# --End log_sample function
+
+# --Define a function to give the header for a new binary log file
+# Note: it's followed by a START record with the time this session started,
+#  so the samples in the file can be timed from it, like the csv log
+def bin_header():
+    return (WGOTlog.pack_header(time.time(), Clock.monotonic()) +
+            WGOTlog.pack_record(Sessionstart + Timeoffset, float('nan'), float('nan'), 0, 0, WGOTlog.START, Session))
+# --End bin_header function
+
+# --Define a function to log a restart of the recording
+def log_restart():
+    Csvlog.write("00,00,00\n") # write zeros line to record a restart
+    if Binlog != None: # the binary log has a record type for it
+        Binlog.write(WGOTlog.pack_record(Sessionstart + Timeoffset, 0, 0, 0, 0, WGOTlog.RESTART, Session)) # timed at the new session's start
+# --End log_restart function
+
+# --Define a function to log recording deadlines that were missed, so the gaps are explained
+def log_missed(deadlines): # the monotonic times of the missed deadlines
+    if Binlog != None: # only the binary log has a record type for it
+        Binlog.write(b"".join([WGOTlog.pack_record(deadline + Timeoffset, float('nan'), float('nan'), 0, 0, WGOTlog.MISSED, Session)
+                               for deadline in deadlines]))
+# --End log_missed function
+
+# --Define a function to log a save/hold temperature, so it can be restored by Resume
+def log_hold(tempc): # the held temperature in Celsius
+    if Binlog != None: # only the binary log has a record type for it
+        Binlog.write(WGOTlog.pack_record(Clock.monotonic() + Timeoffset, tempc, Latest[2][0], Latest[3][0], 0, WGOTlog.HOLD, Session))
+# --End log_hold function
+
+# --Define a function to carry on with the last session in the logs, for Resume
+# Note: the binary log is used if possible, since it has the hold values too,
+#  otherwise the csv log. Only the end of the log is read, from the last restart.
+# Returns 'bin' or 'csv' for the log used, or None if there was nothing to resume
+def resume_session():
+    global Timex, Updtimex, Minx, Secx, Htemp, Htempf, Htimex, Hminx, Hsecx, Session, Timeoffset, Sessionstart # declare globals as needed
+    resumed = None
+    session = None
+    if Binfilename != '' and os.path.exists(Binfilename): # try the binary log first
+        try:
+            session = WGOTlog.read_bin_session(Binfilename, len(Probecs))
+            resumed = 'bin'
+        except Exception as error: # say what happened and try the csv log
+            if Debugprt == True:
+                print ("Can't resume from", Binfilename, error)
+    if (session == None or len(session['times']) == 0) and os.path.exists(Csvfilename): # try the csv log
+        try:
+            times, tempc = WGOTlog.read_csv_session(Csvfilename)
+            tempc = np.column_stack((tempc, np.full((len(times), len(Probecs)), np.nan)))[:, :len(Probecs)] # a column for each probe
+            session = {'times': times, 'tempc': tempc, 'session': None, 'lasttime': None, 'hold': None}
+            resumed = 'csv'
+        except Exception as error: # say what happened and give up
+            if Debugprt == True:
+                print ("Can't resume from", Csvfilename, error)
+    if session == None or len(session['times']) == 0: # nothing to carry on with
+        return None
+# Rebuild the recorded data and times
+    Series.reset()
+    if len(Filter) > 0: # filter them all in one go
+        Filter.prime(session['tempc'][-Filterprime:]) # carry on filtering from the end of the session
+        session['tempc'] = Filter.batch(session['tempc'])
+    Series.extend(session['times'] / 60.0, c_to_f(session['tempc'])) # time in minutes, temps in F
+    Timex = int(round(session['times'][-1])) # carry on from the last recorded time
+    Sessionstart = Clock.monotonic() - Timex # so the session time carries on from there too
+    Updtimex = Timex # the display time too
+    Minx = Updtimex // 60 # get elapsed time in minutes
+    Secx = Updtimex % 60 # get remainder secs elapsed
+    if session['hold'] == None: # hold the last recorded values, if there's no hold in the log
+        session['hold'] = (Timex, session['tempc'][-1, 0])
+    Htimex = int(round(session['hold'][0])) # the hold time in seconds
+    Hminx = Htimex // 60
+    Hsecx = Htimex % 60
+    Htemp = float(session['hold'][1]) # the hold temperature in Celsius
+    Htempf = c_to_f(Htemp)
+    if session['session'] != None: # carry on with the same session id and timestamps
+        Session = session['session']
+        Timeoffset = session['lasttime'] - Clock.monotonic()
+    if Debugprt == True:
+        print ("Resumed", len(session['times']), "samples from the", resumed, "log at", Minx, "min", Secx, "sec")
+    return resumed
+# --End resume_session function
+
+# --Define a function to find a saved generation of a log, compressed or not
+def saved_log(filename, gen): # gen 1 is the newest
+    for suffix in ('', '.gz', '.zst'):
+        if os.path.exists(filename + 'save' + str(gen) + suffix):
+            return filename + 'save' + str(gen) + suffix
+    return None # there isn't one
+# --End saved_log function
+
+# --Define a function to save a log as generation 1, moving older generations down
+# Note: up to Loggens generations are kept (save1 ... saveN, maybe compressed),
+#  and the new save1 is compressed by the compression thread
+def rotate_log(filename):
+    Compressq.join() # let any compression finish first, so it doesn't lose its file
+    with Rotatelock:
+        for gen in range(Loggens, 0, -1): # the oldest first
+            name = saved_log(filename, gen)
+            if name == None: # nothing to move
+                continue
+            if gen == Loggens: # remove the oldest
+                os.remove(name)
+            else: # move it down a generation, keeping any compressed suffix
+                os.rename(name, filename + 'save' + str(gen+1) + name[len(filename + 'save' + str(gen)):])
+        if os.path.exists(filename): # save the log itself
+            if Loggens > 0:
+                os.rename(filename, filename + 'save1')
+                if Logcompress != '': # compress it in the background
+                    Compressq.put(filename + 'save1')
+            else: # we're not keeping any
+                os.remove(filename)
+    Compressq.put('') # check the disk budget afterwards
+# --End rotate_log function
+
+# --Define a function to compress a saved log, replacing the original
+def compress_log(name):
+    if Logcompress == 'zstd' and zstandard != None:
+        compressed = name + '.zst'
+        with open(name, 'rb') as original, open(compressed + '.tmp', 'wb') as target:
+            with zstandard.ZstdCompressor(level=3).stream_writer(target) as writer:
+                shutil.copyfileobj(original, writer, 65536)
+    else: # gzip is always available
+        compressed = name + '.gz'
+        with open(name, 'rb') as original, gzip.open(compressed + '.tmp', 'wb', 6) as writer:
+            shutil.copyfileobj(original, writer, 65536)
+    with Rotatelock: # swap the compressed file in for the original
+        os.rename(compressed + '.tmp', compressed)
+        os.remove(name)
+# --End compress_log function
+
+# --Define a function to remove the oldest saved logs to keep within Logbudget
+def enforce_budget():
+    if Logbudget <= 0: # no limit
+        return
+    with Rotatelock:
+        total = 0 # bytes used by all of the logs
+        saved = [] # (time, name, size) of the saved logs
+        for filename in Logfiles:
+            if os.path.exists(filename):
+                total = total + os.path.getsize(filename)
+            for gen in range(1, Loggens+1):
+                name = saved_log(filename, gen)
+                if name != None:
+                    saved.append((os.path.getmtime(name), name, os.path.getsize(name)))
+                    total = total + saved[-1][2]
+        for mtime, name, size in sorted(saved): # remove the oldest first
+            if total <= Logbudget:
+                break
+            os.remove(name)
+            total = total - size
+            if Debugprt == True:
+                print ("Removed", name, "to keep logs within", Logbudget, "bytes")
+# --End enforce_budget function
+
+# --Define a function to compress saved logs and check the budget, in its own thread
+# Note: '' in the queue just checks the budget
+def compress_logs():
+    try: # on Linux, this lowers the priority of just this thread
+        os.nice(10)
+    except Exception:
+        pass
+    while True:
+        name = Compressq.get()
+        try:
+            if name != '':
+                compress_log(name)
+            enforce_budget()
+        except Exception as error: # keep going, but say what happened
+            if Debugprt == True:
+                print ("Log compression failed:", error)
+        Compressq.task_done()
+# --End compress_logs function
+
+# --Define a function to tidy up and exit the programme
+def exit_programme():
+    finish_adaptive() # the logs run to the end
+    Csvlog.close() # write out and close the csv log file
+    if Binlog != None: # and the binary log
+        Binlog.close()
+    Watchdog.close() # stop flashing the LED
+    GPIO.output(Ledgpio, GPIO.LOW) # turn off the LED
+    if Renderworker != None: # stop drawing graphs
+        Renderworker.close()
+    if Liveserver != None: # and serving them
+        Liveserver.close()
+    pygame.display.quit() # clean up and revert to X11 on main display, if available
+    if Profiler != None: # save the profile, if there is one
+        Profiler.disable()
+        Profiler.dump_stats(Profilefile)
+        if Debugprt == True:
+            pstats.Stats(Profiler).sort_stats('cumulative').print_stats(15)
+    sys.exit() # exit this programme
+# --End exit_programme function
+
+# --Define a function to read the command line options, which override the testing variables
+# Note: e.g. 'python3 Proto29.py --sim --speed=100 --logdir=/tmp' runs a simulation 100 times faster
+def read_options():
+    global Hardware, Simspeed, Simreplay, Simnoise, Simfaults, Simseed, Simbuttons, Simduration # declare globals as needed
+    global Profilefile, Csvfilename, Binfilename, Graphfile, Startlog, Probecs, Probeadj, Spibackend, Filters, Webserver
+    global Metricsfile, Stalllog, Adaptive
+    usage = ("Usage: python3 Proto29.py [--sim] [--speed=N] [--replay=csvfile] [--noise=C] [--faults=P]\n"
+             "        [--seed=N] [--buttons=sec:gpio,...] [--duration=sec] [--profile=file] [--logdir=dir]\n"
+             "        [--probes=cs,cs,...] [--adjust=C,C,...] [--spi=bitbang|spidev|auto] [--filters=spec]\n"
+             "        [--serve=host:port] [--metrics=file] [--adaptive]")
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'h', ['help', 'sim', 'speed=', 'replay=', 'noise=', 'faults=',
+            'seed=', 'buttons=', 'duration=', 'profile=', 'logdir=', 'probes=', 'adjust=', 'spi=', 'filters=', 'serve=', 'metrics=', 'adaptive'])
+    except getopt.GetoptError as error:
+        print (error)
+        print (usage)
+        sys.exit(2)
+    for opt, value in opts:
+        if opt in ('-h', '--help'):
+            print (usage)
+            sys.exit()
+        elif opt == '--sim':
+            Hardware = 'sim'
+        elif opt == '--speed':
+            Simspeed = float(value)
+        elif opt == '--replay': # replaying implies a simulation
+            Hardware = 'sim'
+            Simreplay = value
+        elif opt == '--noise':
+            Simnoise = float(value)
+        elif opt == '--faults':
+            Simfaults = float(value)
+        elif opt == '--seed':
+            Simseed = int(value)
+        elif opt == '--buttons':
+            Simbuttons = value
+        elif opt == '--duration':
+            Simduration = float(value)
+        elif opt == '--profile':
+            Profilefile = value
+        elif opt == '--logdir': # keep the same file names, in another directory
+            Csvfilename = os.path.join(value, os.path.basename(Csvfilename))
+            if Binfilename != '':
+                Binfilename = os.path.join(value, os.path.basename(Binfilename))
+            Graphfile = os.path.join(value, os.path.basename(Graphfile))
+            if Startlog != '':
+                Startlog = os.path.join(value, os.path.basename(Startlog))
+            if Stalllog != '':
+                Stalllog = os.path.join(value, os.path.basename(Stalllog))
+        elif opt == '--probes': # the chip select GPIO for each probe
+            Probecs = [int(cs) for cs in value.split(',')]
+        elif opt == '--adjust': # the temperature adjustment for each probe
+            Probeadj = [float(adj) for adj in value.split(',')]
+        elif opt == '--spi':
+            Spibackend = value
+        elif opt == '--filters':
+            Filters = value
+        elif opt == '--serve':
+            Webserver = value
+        elif opt == '--metrics':
+            Metricsfile = value
+        elif opt == '--adaptive': # start with the 'Auto' Time Interval
+            Adaptive = True
+    Probeadj = (Probeadj + [0.0] * len(Probecs))[:len(Probecs)] # an adjustment for every probe, 0 if not given
+# --End read_options function
+
+# --Define a function to pass the render worker's graphs to the event loop, in its own thread
+# Note: if the worker stops without being closed, the event loop is told with
+#  gone=True, so it can draw the graphs itself from then on
+def receive_frames():
+    worker = Renderworker # the one to wait for, even if it's replaced
+    while True:
+        gone = False
+        try:
+            frame, size, seconds, skipped, tag, error = worker.receive() # wait for the next graph
+        except EOFError: # the worker has gone
+            if worker.closed == True: # we're exiting
+                break
+            frame, size, seconds, skipped, tag, error, gone = None, None, 0.0, 0, None, "the render worker has stopped", True
+        try:
+            fastevent.post(pygame.event.Event(USEREVENT+4, frame=frame, size=size, seconds=seconds, skipped=skipped,
+                                              tag=tag, error=error, gone=gone))
+        except pygame.error: # the display has gone, so we're exiting
+            break
+        if gone == True:
+            break
+# --End receive_frames function
+
+# --Define a function to ask the event loop for a series snapshot, for the web server
+# Note: this is called in the web server's thread, and Series is only read in
+#  the event loop's thread, so it's never read while it's being changed
+def series_snapshot(points): # about this many points, 0 = all
+    future = concurrent.futures.Future()
+    fastevent.post(pygame.event.Event(USEREVENT+5, points=points, future=future))
+    return future
+# --End series_snapshot function
+
+# --Define a function to end a simulation after Simduration virtual seconds, in its own thread
+def end_simulation():
+    Clock.sleep(Simduration)
+    fastevent.post(pygame.event.Event(QUIT)) # quit the same way as closing the window
+# --End end_simulation function
+
+# --Define a class to hold the recorded times and temperatures compactly
+# Note: values are kept in preallocated NumPy buffers that double in size as needed,
+#  up to Seriesmax points. When full, Seriesretain decides what to keep, so memory use
+#  is bounded for long sessions. times() and temps() are views, not copies.
+# Each point has a time and a temperature for each probe, which are kept as
+#  columns of one buffer, so all of the probes are handled together.
+# A pyramid of min/max/mean buckets of 2, 4, 8 ... points is kept up to date as
+#  points are added, so view() can give about one bucket per pixel for graphs,
+#  however long the session is, while spikes still show in the min/max envelope.
+class TimeSeries(object):
+    def __init__(self, maxpoints, probes=1, capacity=1024):
+        self.maxpoints = max(maxpoints, 2) # need room for at least a line
+        capacity = min(capacity, self.maxpoints) # start small
+        self.probes = probes # number of temperatures for each time
+        self.timebuf = np.empty(capacity) # times in minutes
+        self.tempbuf = np.empty((capacity, probes)) # temperatures in F, a column for each probe
+        self.count = 0 # number of points in use
+        self.levels = [] # the bucket pyramid, levels[0] has buckets of 2 points
+        self.version = 0 # counted up by every change, so cached graphs can tell they're out of date
+
+    def __len__(self):
+        return self.count
+
+    def append(self, minutes, tempf): # add a point to the end, tempf has a temperature for each probe
+        if self.count == len(self.timebuf): # make room if it's full
+            if self.count < self.maxpoints:
+                self.grow()
+            else:
+                self.retain()
+        self.timebuf[self.count] = minutes
+        self.tempbuf[self.count] = tempf
+        self.count = self.count + 1
+        self.version = self.version + 1
+# Add a bucket for each level that this point completes, amortised O(1)
+        index = self.count - 1 # the point just added
+        level = 0
+        while index % 2 == 1: # check if this completes a pair at this level
+            if level == len(self.levels): # start a new level
+                self.levels.append(SeriesLevel(2 + self.probes * 3))
+            self.levels[level].append(self.pair(level, index - 1)[0])
+            index = len(self.levels[level]) - 1 # the bucket just added
+            level = level + 1
+
+    def rows(self, level, start, stop): # rows of buckets from the level below 'level'
+        if level == 0: # the points themselves, as single point buckets
+            times = self.timebuf[start:stop]
+            temps = self.tempbuf[start:stop]
+            return np.column_stack((times, times, temps, temps, temps))
+        return self.levels[level-1].buf[start:stop]
+
+    def pair(self, level, start, stop=None): # build level buckets from pairs below, from start
+        if stop == None: # just the one pair
+            stop = start + 2
+        below = self.rows(level, start, stop)
+        return pair_buckets(below[0::2], below[1::2])
+
+    def rebuild(self): # rebuild the whole bucket pyramid after points have been moved
+        self.levels = []
+        level = 0
+        below = self.count # number of rows in the level below
+        while below >= 2:
+            self.levels.append(SeriesLevel(2 + self.probes * 3, self.pair(level, 0, below - below % 2)))
+            below = len(self.levels[level])
+            level = level + 1
+
+    def view(self, width, start=None, envelope=True): # times and temps (a column per probe) to draw 'width' pixels
+        first = 0 # index of the first point to show
+        if start != None: # only show from the start time (min), plus the point just before
+            first = max(np.searchsorted(self.times(), start) - 1, 0)
+        shown = self.count - first
+        level = 0 # pick the level with no more than 'width' buckets, if points won't do
+        if shown > width * 2: # the envelope has two values per bucket
+            while level < len(self.levels) and shown >> (level + 1) > width:
+                level = level + 1
+            level = level + 1 # levels[level-1] has buckets of 2**level points
+            if level > len(self.levels): # not enough points for that yet
+                level = len(self.levels)
+        if level == 0: # just show the points
+            return self.times()[first:], self.temps()[first:]
+        buckets = self.levels[level-1]
+        rows = buckets.buf[first >> level:buckets.count] # complete buckets in view
+        tail = max(buckets.count << level, first) # points not yet in a complete bucket
+        probes = self.probes
+        if envelope == True: # minimum and maximum for each bucket
+            times = rows[:, 0:2].ravel()
+            temps = np.stack((rows[:, 2:2+probes], rows[:, 2+probes:2+probes*2]), axis=1).reshape(-1, probes)
+        else: # mean for each bucket
+            times = (rows[:, 0] + rows[:, 1]) / 2
+            temps = rows[:, 2+probes*2:]
+        return (np.concatenate((times, self.timebuf[tail:self.count])),
+                np.concatenate((temps, self.tempbuf[tail:self.count])))
+
+    def grow(self): # double the buffer sizes, up to maxpoints
+        capacity = min(len(self.timebuf) * 2, self.maxpoints)
+        for name in ('timebuf', 'tempbuf'):
+            buf = getattr(self, name)
+            newbuf = np.empty((capacity,) + buf.shape[1:])
+            newbuf[:self.count] = buf[:self.count]
+            setattr(self, name, newbuf)
+
+    def retain(self): # free up half of the buffer, following Seriesretain
+        half = self.count // 2
+        if Seriesretain == 'drop': # keep the most recent half
+            keep = slice(self.count - half, self.count)
+        else: # keep every other point over the whole session
+            keep = slice(self.count % 2, self.count, 2)
+        for buf in (self.timebuf, self.tempbuf):
+            kept = buf[keep].copy()
+            buf[:len(kept)] = kept
+        self.count = len(kept)
+        self.rebuild() # the buckets no longer match the points
+
+    def extend(self, times, temps): # add arrays of points at once, e.g. when resuming, temps has a column per probe
+        times = np.concatenate((self.times(), times))
+        temps = np.concatenate((self.temps(), temps))
+        if len(times) > self.maxpoints: # too many, so keep what Seriesretain says
+            if Seriesretain == 'drop': # the most recent
+                keep = slice(len(times) - self.maxpoints, len(times))
+            else: # evenly spaced points over the whole session, including the last
+                step = -(-len(times) // self.maxpoints) # rounded up
+                keep = slice((len(times) - 1) % step, len(times), step)
+            times = times[keep]
+            temps = temps[keep]
+        capacity = len(self.timebuf)
+        while capacity < len(times): # grow the buffers by doubling, up to maxpoints
+            capacity = min(capacity * 2, self.maxpoints)
+        self.timebuf = np.empty(capacity)
+        self.tempbuf = np.empty((capacity, self.probes))
+        self.count = len(times)
+        self.timebuf[:self.count] = times
+        self.tempbuf[:self.count] = temps
+        self.version = self.version + 1
+        self.rebuild() # rebuild the bucket pyramid in one go
+
+    def reset(self): # forget all of the points, but keep the buffers
+        self.count = 0
+        self.levels = []
+        self.version = self.version + 1
+
+    def times(self): # a view of the times in use
+        return self.timebuf[:self.count]
+
+    def temps(self): # a view of the temperatures in use, a column per probe
+        return self.tempbuf[:self.count]
+# --End TimeSeries class
+
+# --Define a function to get the main probe's latest temperature from the acquisition thread
+# Note: this doesn't touch the MAX31855 boards, so it's quick and can be used anywhere
+@Metrics.timed('get_temp')
 def get_temp():
-# Get the external probe and internal chip temperatures in Celsius
-    tempc = sensor.readTempC() + Tempadj # get the termperature and adjust for calibration
-    itempc = sensor.readInternalC() # Debug
+    tempc = float(Latest[1][0]) + Probeadj[0] # get the latest termperature and adjust for calibration
 #    if Debugprt == True:
-#        print ('Ctemp=',tempc, 'Itemp=',itempc) # track results against observed
+#        print ('Ctemp=',tempc, 'Itemp=',Latest[2]) # track results against observed
     return tempc; # Return the temperature in Celsius only, for now
 # --End get_temp function
+
+# --Define a function to get all of the probes' latest temperatures, as an array in Celsius
+def get_temps():
+    return Latest[1] + np.asarray(Probeadj) # adjust each one for calibration
+# --End get_temps function
+
+# --Define a function to read all of the MAX31855 boards once and publish the result
+# Note: this runs in the acquisition thread, apart from the first reading at startup
+# Each pass reads every probe once, and the readings go into a ring buffer with
+#  a column per probe. The averages of the last Oversample readings are published
+#  in Latest as (time, probe C, internal chip C, fault flags), each an array by probe.
+# The ring buffer has a single writer, and Latest is replaced in one assignment,
+#  so no locking is needed by the readers.
+@Metrics.timed('read_probe')
+def read_probe():
+    global Latest, Ringindex # declare globals as needed
+    readtime = Clock.monotonic() # timestamp the reading
+    tempc, itempc, fault = Probebus.read() # get the probe temperatures, NaN if there's a fault, chip temperatures and faults
+    Ringtemps[Ringindex % Ringsize] = tempc # add them to the ring buffer
+    Ringindex = Ringindex + 1
+# Average the most recent readings, skipping any NaN values from faults
+    recent = Ringtemps[np.arange(Ringindex - min(Oversample, Ringindex), Ringindex) % Ringsize]
+    valid = recent == recent
+    counts = valid.sum(axis=0)
+    averages = np.where(valid, recent, 0.0).sum(axis=0) / np.maximum(counts, 1)
+    tempc = np.where(counts > 0, averages, tempc) # NaN if there are no good readings
+    Latest = (readtime, tempc, itempc, fault) # publish it
+# --End read_probe function
+
+# --Define a function to keep reading the probe at Samplerate, in its own thread
+def acquire():
+    period = 1.0 / Samplerate # time between readings in seconds
+    nextread = Clock.monotonic() + period # when the next reading is due
+    while True:
+        Watchdog.beat('acquire') # still reading, or at least trying to
+        delay = nextread - Clock.monotonic()
+        if delay > 0: # wait until the next reading is due
+            Clock.sleep(delay)
+        else: # we fell behind, so don't try to catch up
+            nextread = Clock.monotonic()
+        nextread = nextread + period
+        try:
+            read_probe()
+        except Exception as error: # keep going, but say what happened
+            if Debugprt == True:
+                print ("Probe read failed:", error)
+# --End acquire function
+
+# --Define a function to post the timer events at their deadlines, in its own thread
+# Note: the deadlines are fixed times on Clock, every Tinterval (recording) and
+#  Updinterval (display) seconds from Sessionstart, so they don't drift however
+#  late the events are handled. If the thread wakes up after more than one
+#  deadline has passed, only one event is posted, with the number missed.
+def ticker():
+    while True:
+        events = []
+        with Ticklock: # the deadlines may be moved by rearm_ticker
+            now = Clock.monotonic()
+            for index, (eventtype, interval) in enumerate(((USEREVENT+1, Tinterval), (USEREVENT+2, Updinterval))):
+                if Tickdeadlines[index] <= now: # due, or overdue
+                    missed = int((now - Tickdeadlines[index]) // interval) # deadlines passed since this one
+                    deadline = Tickdeadlines[index] + missed * interval
+                    events.append(pygame.event.Event(eventtype, deadline=deadline, missed=missed))
+                    Tickdeadlines[index] = deadline + interval
+            delay = min(Tickdeadlines) - now
+        try:
+            for event in events:
+                fastevent.post(event)
+        except pygame.error: # the display has gone, so we're exiting
+            break
+        if len(events) == 0: # sleep until the next deadline, or until the deadlines are moved
+            Tickerwake.wait(delay / Simspeed) # in real seconds
+            Tickerwake.clear()
+# --End ticker function
+
+# --Define a function to set the next timer deadlines from Sessionstart
+# Note: call this after changing Sessionstart, Tinterval or Updinterval
+def rearm_ticker():
+    with Ticklock:
+        elapsed = Clock.monotonic() - Sessionstart
+        Tickdeadlines[0] = Sessionstart + (elapsed // Tinterval + 1) * Tinterval # the next recording time
+        Tickdeadlines[1] = Sessionstart + (elapsed // Updinterval + 1) * Updinterval # the next display time
+    Tickerwake.set() # the ticker works out its new sleep
+# --End rearm_ticker function
+
+# --Define a function to get the seconds since the recording session started
+def session_time():
+    return Clock.monotonic() - Sessionstart
+# --End session_time function
+
+# --Define a class to watch the event loop and the probe reading for stalls, and flash the activity LED
+# Note: each watched thread calls beat() every time round its loop. If one
+#  hasn't for more than 'limit' real seconds, its stack is printed and added to
+#  the log file with what the event loop was handling, and the LED blinks
+#  quickly until it beats again, when the length of the stall is reported too.
+# The LED blinks slowly while all is well, and with a double flash while a
+#  probe has had no good readings, so a glance shows which it is.
+# This is a Python thread, so it can't run while another thread holds the GIL,
+#  e.g. in a long C call. faulthandler's timer doesn't need the GIL, so with a
+#  log file it's also armed by the event loop's beats, to dump every thread's
+#  stack if the loop stalls, whatever it's doing. SIGUSR1 dumps them too.
+class StallWatchdog(object):
+    ALIVE = ((True, 1.0), (False, 1.0)) # a slow, even blink, as (LED on, seconds) steps
+    STALLED = ((True, 0.1), (False, 0.1)) # a fast blink
+    FAULT = ((True, 0.15), (False, 0.15), (True, 0.15), (False, 1.05)) # a double flash
+
+    def __init__(self, limit):
+        self.limit = limit # real seconds without a beat before it's a stall
+        self.beats = {} # [last beat on time.monotonic(), thread id] by name, each only changed by its own thread
+        self.stalls = {} # when each current stall started, by name
+        self.counts = {} # the number of stalls so far, by name
+        self.armed = 0.0 # when faulthandler's timer was last armed
+        self.logfile = None
+        self.thread = None # the watchdog thread, once it's started
+        self.stop = threading.Event() # set by close()
+
+    def start(self, logname=''): # start watching, and flashing the LED, with a log file if a name is given
+        if logname != '':
+            try:
+                self.logfile = open(logname, 'a', buffering=1) # line buffered, since faulthandler writes to it too
+            except Exception as error: # carry on without it
+                print ("Can't write", logname, error)
+        if self.logfile != None:
+            faulthandler.enable(self.logfile, all_threads=True) # a crash in a C library dumps the stacks too
+            if hasattr(faulthandler, 'register'): # not on Windows
+                faulthandler.register(signal.SIGUSR1, self.logfile, all_threads=True)
+        self.thread = threading.Thread(target=self.run, name='watchdog')
+        self.thread.daemon = True # close() is used to finish up
+        self.thread.start()
+
+    def beat(self, name): # the named thread is still going
+        now = time.monotonic()
+        beat = self.beats.get(name)
+        if beat == None: # the first beat
+            self.beats[name] = [now, threading.get_ident()]
+        else:
+            beat[0] = now
+        if name == 'eventloop' and self.logfile != None and now - self.armed > self.limit / 10.0:
+            faulthandler.dump_traceback_later(self.limit, file=self.logfile) # restarts it, so not every beat
+            self.armed = now
+
+    def run(self): # the watchdog thread, checking the beats each time round the LED pattern
+        while True:
+            for on, seconds in self.check():
+                GPIO.output(Ledgpio, GPIO.HIGH if on == True else GPIO.LOW)
+                if self.stop.wait(seconds): # close() was called
+                    return
+
+    def check(self): # look for stalls, and give the LED pattern to show
+        now = time.monotonic()
+        stalled = False
+        for name in list(self.beats):
+            last, ident = self.beats[name]
+            if now - last > self.limit:
+                stalled = True
+                if name not in self.stalls: # a new stall
+                    self.stalls[name] = last
+                    self.counts[name] = self.counts.get(name, 0) + 1
+                    self.report(name, now - last, ident)
+            elif name in self.stalls: # it's going again
+                seconds = last - self.stalls.pop(name)
+                Metrics.histogram('stall_seconds', "Seconds that each thread was stalled for",
+                                  'thread="%s"' % name).observe(seconds)
+                self.log("Recovered: the %s thread was stalled for %.1f sec" % (name, seconds))
+        if stalled == True:
+            return StallWatchdog.STALLED
+        if np.isnan(Latest[1]).any(): # a probe with no good readings
+            return StallWatchdog.FAULT
+        return StallWatchdog.ALIVE
+
+    def report(self, name, seconds, ident): # describe a stall, with the thread's stack
+        elapsed = int(session_time())
+        lines = ["Stall: the %s thread hasn't beaten for %.1f sec, at %d:%02d into the session" % (
+            name, seconds, elapsed // 60, elapsed % 60)]
+        handling = Handling # what the event loop is doing, if anything
+        if name == 'eventloop' and handling != None:
+            lines.append("  handling %s for %.1f sec" % (handling[0], time.perf_counter() - handling[1]))
+        lines.append("  " + tick_stats())
+        frame = sys._current_frames().get(ident)
+        if frame == None:
+            lines.append("  the thread has gone")
+        else:
+            lines.append("  its stack, most recent call last:")
+            lines.append("".join(traceback.format_stack(frame)).rstrip())
+        self.log("\n".join(lines))
+
+    def log(self, text): # print something, and add it to the log file with the date and time
+        print (text)
+        if self.logfile != None:
+            self.logfile.write(time.strftime("%Y-%m-%d %H:%M:%S ") + text + "\n")
+
+    def close(self): # stop watching, e.g. so the LED can be turned off
+        self.stop.set()
+        if self.thread != None:
+            self.thread.join(1)
+        if self.logfile != None:
+            faulthandler.cancel_dump_traceback_later()
+# --End StallWatchdog class
     
-# --Define  a function to plot a graph to a file
-def make_graph(): 
-#    if Debugprt == True: # print the timing in debug mode        
-#        print (pygame.time.get_ticks()/1000,Timex, 'make_graph start') #debug
-    fig, ax = plt.subplots() # define the
-    fig.subplots_adjust(left=0.11, right=0.97, top=0.94, bottom=0.11) # reduce margin size
-    if Curtemp > 0: # check if current temperature is above freezing
-        ax.plot(Timelist, Templist, 'red') # if so, plot the graph in red
-    else: # for temperatures at or below freezing
-        ax.plot(Timelist, Templist, 'blue') # if so, plot the graph in blue        
-    ax.set(xlabel='Time (min)', ylabel='Temp (F)',title='Temperature') # add axis labels
-    ax.grid() #show with default grid for major axes
-# The following creates a 320 x 240 pixel (for now) graph image file
-#   after experimenting with 'dpi' values.
-    fig.savefig(Graphfile, bbox="tight", dpi=50.1) # save graph
-    plt.close('all') # free up memory from graph creation
-#    if Debugprt == True: # print the timing in debug mode        
-#        print (pygame.time.get_ticks()/1000,Timex, 'make_graph end') #debug
+# --Define a function to load matplotlib in the background, at low priority
+def prewarm_plotting():
+    try: # on Linux, this lowers the priority of just this thread
+        os.nice(10)
+    except Exception:
+        pass
+    WGOTrender.load_plotting(Debugprt)
+# --End prewarm_plotting function
+
+# --Define a function to record how long startup is taking
+# Note: each mark is the time since the programme started. When the first
+#  frame is shown, the marks are printed in debug mode and added to Startlog.
+def startup_mark(name):
+    if name in Startmarks: # only the first time counts
+        return
+    Startmarks[name] = time.time() - Starttime
+    if name == 'first frame': # startup is done
+        summary = ', '.join(["%s %.2f sec" % (mark, Startmarks[mark]) for mark in Startmarks])
+        if Debugprt == True:
+            print ("Startup:", summary)
+        if Startlog != '':
+            try: # add it to the startup log, with the date
+                with open(Startlog, 'a') as startfile:
+                    startfile.write(time.strftime('%Y-%m-%d %H:%M:%S') + ', ' + summary + '\n')
+            except Exception as error: # not worth stopping for
+                if Debugprt == True:
+                    print ("Can't write", Startlog, error)
+        if Prewarm == True and Graphrenderer != None: # now load matplotlib, the render worker does its own
+            prewarmer = threading.Thread(target=prewarm_plotting, name='prewarm')
+            prewarmer.daemon = True # don't keep the programme alive on exit
+            prewarmer.start()
+# --End startup_mark function
+
+# --Define a function to check if it's time for another Graphfile export
+def export_due():
+    if Graphexport <= 0: # check if exports are turned off
+        return False
+    return pygame.time.get_ticks()/1000 - Graphexported >= Graphexport
+# --End export_due function
+
+# --Define a function to give the key of the graph that would be drawn now
+# Note: a graph with the same key looks the same, so a cached one can be reused.
+#  live is the pygame graph's live temperature, which moves on every second.
+def graph_key(live=False):
+    colours = tuple([probe_colour(probe) for probe in range(Series.probes)])
+    key = (Series.version, colours, Graphwindow)
+    if live == True:
+        key = key + (Updtimex,)
+    return key
+# --End graph_key function
+
+# --Define a function to forget the cached graphs, so the next ones are drawn afresh
+# Note: the keys cover the recorded data and how it's shown, but this makes sure
+#  of it when the data is restarted or the temperature adjustment is changed
+def invalidate_graph():
+    global Graphkey, Graphrequested, Lcdgraphkey # declare globals as needed
+    Graphkey = Graphrequested = Lcdgraphkey = None
+# --End invalidate_graph function
+
+# --Define a function to give the Graphfile name, if it's time for an export
+# Note: this is throttled by Graphexport, to save time and wear on the SD card
+def export_file():
+    global Graphexported # the time (sec) of the last export
+    if export_due() == False:
+        return None
+    Graphexported = pygame.time.get_ticks()/1000 # record this export
+    return Graphfile
+# --End export_file function
+
+# --Define  a function to update the graph and draw it into memory
+# Note: with a render worker, this only asks for the graph, and Graphsurface
+#  is updated by frame_event when it's been drawn
+# Note: nothing is drawn if the graph wouldn't change, so show_graph can
+#  show the cached Graphsurface straight away, e.g. after a flip or the menu.
+#  Graphkey says what Graphsurface shows, so an export of the same graph
+#  doesn't draw a new Graphsurface.
+@Metrics.timed('make_graph')
+def make_graph(frame=True): # frame=False only exports the graph, if it's time
+    global Graphsurface, Graphframe, Graphkey, Graphrequested # declare globals as needed
+    key = graph_key()
+    if frame == True and key == Graphrequested and export_due() == False: # drawn already, or being drawn
+        Graphcachestats[0] = Graphcachestats[0] + 1
+        return
+    if frame == True and key == Graphkey: # Graphsurface shows it already, so don't draw it again
+        Graphrequested = key
+        if export_due() == False:
+            Graphcachestats[0] = Graphcachestats[0] + 1
+            return
+        frame = False # only export it
+    Graphcachestats[1] = Graphcachestats[1] + 1
+    times, temps = Series.view(Graphpixels)
+    colours = list(key[1])
+    if frame == True:
+        Graphrequested = key
+    if Renderworker != None: # copies, since the request may be held back for a while
+        Renderworker.request(times=times.copy(), temps=temps.copy(), colours=colours, export=export_file(), frame=frame, tag=key)
+        return
+    try:
+        Graphframe = Graphrenderer.render(times, temps, colours, export_file(), frame) # draw it here and now
+    except Exception as error: # e.g. Graphfile can't be written, so say so, and draw it again next time
+        print ("Graph failed:", error)
+        Graphrequested = None
+        return
+    if frame == True: # hand the RGBA pixels straight to pygame - no file round-trip
+        Graphsurface = pygame.image.frombuffer(Graphframe, Graphrenderer.size, 'RGBA')
+        Graphkey = key
+        publish_graph(Graphframe, Graphrenderer.size)
 # --End make_graph function
 
-# --Define a function to show a graph from a file onto the screen
+# --Define a function to send a new graph to the web server, if there is one
+def publish_graph(frame, size): # the RGBA pixels and (width, height)
+    global Graphversion # declare globals as needed
+    if Liveserver != None:
+        Graphversion = Graphversion + 1 # so browsers know to fetch it
+        Liveserver.publish_frame(frame, size, Graphversion)
+# --End publish_graph function
+
+# --Define a function to show the graph from memory onto the screen
+@Metrics.timed('show_graph')
 def show_graph():
 # Will show the graph on the PiTFT (or X11) with PyGame
-# Show an image (320x240) - created previously by matplotlib
+# Show an image (320x240) - created previously by make_graph
+    invalidate_screen() # the text screen is being replaced
     Lcd.fill (BLACK) # Blank the display  
-    graph = pygame.image.load(Graphfile)
-    Lcd.blit(graph, (0,0)) # place in upper left corner
+    if Graphsurface == None: # the render worker hasn't drawn one yet
+        message = render_text('Drawing the graph...', None, 30, WHITE, BLACK)
+        Lcd.blit(message, ((LCD_WIDTH - message.get_width())//2, (LCD_HEIGHT - message.get_height())//2))
+    else:
+        Lcd.blit(Graphsurface, (0,0)) # place in upper left corner
     pygame.display.update() # Show it
 # --End show graph function
 
+# --Define a function to pick tidy axis values for the pygame graph
+# Returns the start value and step so that 'ticks' steps cover low to high,
+#  with the step being 1, 2 or 5 times a power of ten
+def nice_axis(low, high, ticks):
+    if not high - low < float('inf'): # a probe fault can give NaN values
+        low, high = 0.0, 1.0
+    if high - low <= 0: # avoid a zero range with only one value
+        low = low - 0.5
+        high = high + 0.5
+    stepexp = math.floor(math.log10((high - low) / ticks)) # power of ten for the step
+    while True: # try 1, 2 and 5 times each power of ten until it fits
+        for mult in (1, 2, 5):
+            step = mult * 10.0 ** stepexp
+            start = math.floor(low / step) * step
+            if start + step * ticks >= high: # check if this step covers the range
+                return start, step
+        stepexp = stepexp + 1
+# --End nice_axis function
+
+# --Define a function to get a tick label surface for the pygame graph
+# Note: labels come from the text cache, since the same few values are shown over and over
+def graph_label(text):
+    return render_text(text, None, 16, WHITE, BLACK)
+# --End graph_label function
+
+# --Define a function to build the static background of the pygame graph, once only
+# Note: the axes, grid and titles never change, so only the data is drawn every time
+def make_lcd_graph():
+    global Lcdgraphbg # declare globals as needed
+    labelfont = get_font(None, 16) # small font for labels
+    Lcdgraphbg = pygame.Surface(LCD_SIZE) # the background surface to reuse
+    Lcdgraphbg.fill(BLACK)
+    left, top, width, height = Lcdgraphrect # unpack the plot area
+    for gridx in range(Lcdgridx+1): # draw the vertical grid lines
+        x = left + width * gridx // Lcdgridx
+        pygame.draw.line(Lcdgraphbg, GREY, (x, top), (x, top+height))
+    for gridy in range(Lcdgridy+1): # draw the horizontal grid lines
+        y = top + height * gridy // Lcdgridy
+        pygame.draw.line(Lcdgraphbg, GREY, (left, y), (left+width, y))
+    pygame.draw.rect(Lcdgraphbg, WHITE, Lcdgraphrect, 1) # frame the plot area
+# Add the titles
+    title = get_font(None, 22).render('Temperature', False, WHITE, BLACK)
+    Lcdgraphbg.blit(title, (left + (width - title.get_width())//2, 2)) # centred at the top
+    xlabel = labelfont.render('Time (min)', False, WHITE, BLACK)
+    Lcdgraphbg.blit(xlabel, (left + (width - xlabel.get_width())//2, LCD_HEIGHT-14)) # centred at the bottom
+    ylabel = pygame.transform.rotate(labelfont.render('Temp (F)', False, WHITE, BLACK), 90)
+    Lcdgraphbg.blit(ylabel, (2, top + (height - ylabel.get_height())//2)) # sideways on the left
+# --End make_lcd_graph function
+
+# --Define a function to draw the graph directly on the screen with pygame
+# Note: this is cheap enough to be used every second, with the live temperature added.
+#  The last graph drawn is kept, and shown again if the graph wouldn't change.
+@Metrics.timed('show_lcd_graph')
+def show_lcd_graph(live=False): # live=True adds the current temperature to the end
+    global Lcdgraphcache, Lcdgraphkey # declare globals as needed
+    key = graph_key(live)
+    if key == Lcdgraphkey: # nothing has changed, so show the last one again
+        Graphcachestats[0] = Graphcachestats[0] + 1
+        invalidate_screen() # the text screen is being replaced
+        Lcd.blit(Lcdgraphcache, (0, 0))
+        pygame.display.update() # Show it
+        return
+    Graphcachestats[1] = Graphcachestats[1] + 1
+    if Lcdgraphbg == None: # build the background the first time through
+        make_lcd_graph()
+    latest = Series.times()[-1] # the latest time in minutes
+    if live == True: # the current time is the latest
+        latest = max(latest, Updtimex/60.0)
+# Work out the time window to show, scrolling if Graphwindow is set
+    if Graphwindow > 0 and latest > Graphwindow: # check if we need to scroll
+        xstart = latest - Graphwindow # scroll to keep the latest time on the right
+        xstep = Graphwindow / float(Lcdgridx)
+        times, temps = Series.view(Lcdgraphrect.width, xstart) # about a point per pixel
+    else: # fit the whole session in
+        xstart, xstep = nice_axis(0, max(latest, Graphwindow, 1), Lcdgridx)
+        times, temps = Series.view(Lcdgraphrect.width) # about a point per pixel
+    if live == True: # add the current temperatures at the current time
+        times = np.append(times, Updtimex/60.0)
+        temps = np.vstack((temps, c_to_f(get_temps())))
+    ystart, ystep = nice_axis(np.nanmin(temps), np.nanmax(temps), Lcdgridy)
+# Put the background and tick labels on the screen
+    invalidate_screen() # the text screen is being replaced
+    Lcd.blit(Lcdgraphbg, (0, 0))
+    left, top, width, height = Lcdgraphrect # unpack the plot area
+    decimals = max(0, -int(math.floor(math.log10(xstep)))) # enough decimals to tell the ticks apart
+    for gridx in range(Lcdgridx+1): # label the time axis
+        label = graph_label('%.*f' % (decimals, xstart + xstep * gridx))
+        Lcd.blit(label, (left + width*gridx//Lcdgridx - label.get_width()//2, top+height+2))
+    for gridy in range(Lcdgridy+1): # label the temperature axis
+        label = graph_label('%g' % (ystart + ystep * gridy))
+        Lcd.blit(label, (left - label.get_width() - 2, top + height - height*gridy//Lcdgridy - 6))
+# Scale the data to pixels and draw the line
+    xscale = width / (xstep * Lcdgridx)
+    yscale = height / (ystep * Lcdgridy)
+    xpixels = left + (times - xstart) * xscale # the same for every probe
+    ypixels = top + height - (temps - ystart) * yscale
+    Lcd.set_clip(Lcdgraphrect) # keep the lines inside the plot area
+    for probe in range(Series.probes): # draw a line for each probe
+        valid = ypixels[:, probe] == ypixels[:, probe] # skip NaN values from probe faults
+        points = np.column_stack((xpixels[valid], ypixels[valid, probe])).tolist()
+        colour = probe_colour(probe)
+        if len(points) > 1: # need two points to make a line
+            pygame.draw.lines(Lcd, colour, False, points)
+        elif len(points) == 1: # otherwise just show the one point
+            Lcd.set_at((int(points[0][0]), int(points[0][1])), colour)
+    Lcd.set_clip(None)
+    Lcdgraphcache = Lcd.copy() # keep it, in case nothing changes before it's shown again
+    Lcdgraphkey = key
+    pygame.display.update() # Show it
+# --End show_lcd_graph function
+
+# --Define a function to pick the graph line colour for a probe
+def probe_colour(probe):
+    if probe == 0 and Curtemp <= 0: # the main probe is blue at or below freezing
+        return BLUE
+    return Probecolours[probe % len(Probecolours)] # otherwise each probe has its own colour
+# --End probe_colour function
+
+# --Define a function to update and show the graph with the selected backend
+def update_graph(live=False): # live only applies to the pygame backend
+    if Graphbackend == 'matplotlib': # the full matplotlib graph
+        make_graph() # build the graph
+        show_graph() # show the graph
+    else: # the quick pygame graph
+        show_lcd_graph(live)
+        if export_due(): # still use matplotlib for the Graphfile export, if required
+            make_graph(False) # without the pixels
+# --End update_graph function
+
+# --Define a function to get a font, loading each font name and size only once
+# Note: SysFont looks up the font file and loads it every time, which is slow
+def get_font(name, size):
+    if (name, size) not in Fontcache: # load it the first time only
+        Fontcache[(name, size)] = pygame.font.SysFont(name, size)
+    return Fontcache[(name, size)]
+# --End get_font function
+
+# --Define a function to render text, reusing a surface if it was rendered recently
+# Note: the least recently used surface is dropped when there are Textcachemax of them
+def render_text(text, name, size, fg, bg):
+    global Textcachehits, Textcachemisses # declare globals as needed
+    key = (text, name, size, fg, bg) # everything that affects the rendered surface
+    surface = Textcache.get(key)
+    if surface == None: # not rendered recently, so render it now
+        Textcachemisses = Textcachemisses + 1
+        surface = get_font(name, size).render(text, False, fg, bg)
+        Textcache[key] = surface
+        if len(Textcache) > Textcachemax: # drop the least recently used surface
+            Textcache.popitem(last=False)
+    else: # reuse it and mark it as recently used
+        Textcachehits = Textcachehits + 1
+        Textcache.move_to_end(key)
+    return surface
+# --End render_text function
+
+# --Define a function to describe the text cache performance, for debugging
+def text_cache_stats():
+    lookups = max(Textcachehits + Textcachemisses, 1) # avoid dividing by zero
+    return "Text cache: {0} hits, {1} misses ({2:.0%} hits), {3} surfaces, {4} fonts".format(
+        Textcachehits, Textcachemisses, Textcachehits/float(lookups), len(Textcache), len(Fontcache))
+# --End text_cache_stats function
+
 # --Define a function to show a screen of text with button labels
 # Note: text items in the screen dictionary can be changed before displaying
+# Note: if the same screen is already showing, only the lines whose text has changed
+#  are redrawn and only their rectangles are sent to the display, which saves
+#  a full frame push to the PiTFT every second
+@Metrics.timed('show_text_menu')
 def show_text_menu(menuname, highlite, buttons): # buttons can be None
-    Lcd.fill(BLACK) # blank the display
+    global Screennow, Screenitems # declare globals as needed
+    items = [] # (key, state, surface, rect) for each line, in drawing order
 # Build button labels first, so menu can overlap on leading blanks
     if buttons != None: # see if there are buttons to show
-        line = 0 # reset our line count for the labels
         for line in buttons: # go through the  button line vslues
             linedata = buttons[line]
-            myfont = pygame.font.SysFont(linedata[3], linedata[1]) # use the font selected        
-            textsurface = myfont.render(linedata[4], False,WHITE,BLACK) # write the text
-            Lcd.blit(textsurface,(linedata[2],linedata[1]*linedata[0])) # show the text
-            line = line + 1 # go to the next line    
+            textsurface = render_text(linedata[4], linedata[3], linedata[1], WHITE, BLACK) # write the text
+            textrect = textsurface.get_rect(topleft=(linedata[2],linedata[1]*linedata[0])) # position it
+            items.append((('button', line), (linedata[4], WHITE), textsurface, textrect))
 # Build the rest of the menu
-    line = 0 # start showing at line zero
     for line in menuname: # go through the line values
         linedata = menuname[line] # get the value list from the menu dictionary
-        myfont = pygame.font.SysFont(linedata[3], linedata[1]) # use the font selected
 # Build text and position & highlighting a line, if within range
         if line == highlite: # check if we should highlight this line
-            textsurface = myfont.render(linedata[4], False, BLACK,WHITE) # highlight it
+            textcolour = BLACK # highlight it
+            textsurface = render_text(linedata[4], linedata[3], linedata[1], BLACK, WHITE)
         else:
-            textsurface = myfont.render(linedata[4], False, WHITE,BLACK)  # no highlight           
-        Lcd.blit(textsurface,(linedata[2],linedata[1]*linedata[0])) # add the line to the screen        
-        line=line+1
+            textcolour = WHITE # no highlight
+            textsurface = render_text(linedata[4], linedata[3], linedata[1], WHITE, BLACK)
+        textrect = textsurface.get_rect(topleft=(linedata[2],linedata[1]*linedata[0])) # position it
+        items.append((('menu', line), (linedata[4], textcolour), textsurface, textrect))
+# Check if this screen is already showing, so only the changes need to be drawn
+    if Screennow != None and Screennow[0] is menuname and Screennow[1] is buttons:
+        dirty = [] # rectangles that need to be redrawn
+        for key, state, textsurface, textrect in items: # compare each line with what's shown
+            shown = Screenitems.pop(key, None)
+            if shown == None: # a new line
+                dirty.append(textrect)
+            elif shown[0] != state: # a changed line, so clear the old text too
+                dirty.append(textrect.union(shown[1]))
+        for shown in Screenitems.values(): # lines that have gone away
+            dirty.append(shown[1])
+        if len(dirty) > 0: # check if there's anything to do
+            for rect in dirty: # blank the changed areas
+                Lcd.fill(BLACK, rect)
+            for key, state, textsurface, textrect in items: # redraw anything in those areas
+                if textrect.collidelist(dirty) != -1: # in the original order, for overlaps
+                    Lcd.blit(textsurface, textrect)
+            pygame.display.update(dirty) # show just the changes
+    else: # a different screen, so draw it all
+        Lcd.fill(BLACK) # blank the display
+        for key, state, textsurface, textrect in items:
+            Lcd.blit(textsurface, textrect) # add the line to the screen
 # Show the new screen
-    pygame.display.update() # show it all
+        pygame.display.update() # show it all
+# Remember what's on the screen now, for next time
+    Screennow = (menuname, buttons)
+    Screenitems = dict((key, (state, textrect)) for key, state, textsurface, textrect in items)
 # --End show_text_menu function
 
+# --Define a function to forget what text is on the screen
+# Note: call this after drawing anything else, so the next text screen is drawn in full
+def invalidate_screen():
+    global Screennow # declare globals as needed
+    Screennow = None
+# --End invalidate_screen function
+
 # --Define a function to show the temperatures/times in text
+@Metrics.timed('show_temp')
 def show_temp(): # shows hold temperatures too
 #    if Debugprt == True: # print the event in debug mode
 #        print ('show_temp', Updtimex, Updinterval, Minx, Secx) #debug 
-    Lcd.fill (BLACK) # blank the display
     curtemp = get_temp() # get the current temperature in a local variable
     tempf = c_to_f(curtemp) #calulate temperature in F
 # Update the dictionary for this screen with new temperature/time values
@@ -251,6 +1444,7 @@ def show_temp(): # shows hold temperatures too
     temp_screen[6][4] = str.format("%.1f" % Htempf +" F") # change the text content
     temp_screen[7][4] = str.format("Time (min:sec) = "+str(Hminx)+":"+str(Hsecx).zfill(2)) # change the text content
     show_text_menu(temp_screen, None, button_menu1) # Put it on the screen
+    startup_mark('first frame') # for the startup profile
 # --End show_temp function
 
 # --Define a function to flip between temperature and graph displays
@@ -258,8 +1452,7 @@ def show_flip():
     global Displayshow # make this global
     if Displayshow == Displaytemp: # if showing the temps, 
         Displayshow = Displaygraph # switch to showing a graph
-        make_graph() # get a current graph right now
-        show_graph() # put it on the screen
+        update_graph() # get a current graph on the screen right now
     else: # otherwise,
         Displayshow = Displaytemp # switch to showing temps
         show_temp() # show the temps right now
@@ -267,46 +1460,647 @@ def show_flip():
 
 # --Define a function to do time/temp display updates on a timer 2 pop
 # Note: this only affects the temperature/time display and activity LED
-def Do_ttimer_updates(): # 
-    global Led, Updtimex, Minx, Secx # declare globals as needed
+def Do_ttimer_updates():
+    global Led, Updtimex, Minx, Secx, Metricsdue # declare globals as needed
 # Perform common timer 2 pop updates
-    Updtimex=Updtimex + Updinterval # update increment to seconds
+    lastminute = Updtimex // 60 # for the debug stats
+    Updtimex = int(session_time()) # whole seconds since the start, from the clock
     Minx = Updtimex // 60 # get elapsed time in minutes
     Secx = Updtimex % 60 # get remainder secs elapsed
 # Toggle a basic LED activity indicator, since this timer never changes
-    if Led == True: # check if the LED is on
-        GPIO.output(Ledgpio, GPIO.LOW) # if so, then turn it off
-        Led = False # record that it is off
-    else:
-        GPIO.output(Ledgpio,GPIO.HIGH) # otherwise, turn on the LED
-        Led = True # record that it is on           
+# Note: if the watchdog is running, it flashes the LED instead
+    if Watchdog.thread == None:
+        if Led == True: # check if the LED is on
+            GPIO.output(Ledgpio, GPIO.LOW) # if so, then turn it off
+            Led = False # record that it is off
+        else:
+            GPIO.output(Ledgpio,GPIO.HIGH) # otherwise, turn on the LED
+            Led = True # record that it is on
+    if Debugprt == True and Updtimex // 60 != lastminute: # print the cache, event and timing performance every minute
+        print (text_cache_stats())
+        print (dispatch_stats())
+        print (tick_stats())
+        print ("Graph cache: {0} hits, {1} misses".format(Graphcachestats[0], Graphcachestats[1]))
+        if Renderworker != None:
+            print (render_stats())
+    if Metricsinterval > 0 and Clock.monotonic() >= Metricsdue: # time for a performance summary
+        Metricsdue = Clock.monotonic() + Metricsinterval
+        report_metrics()
 # --End of ttimer_updates updates function for timer 2
     
+# --Define a function to add a point to the recorded series, filtered
+# Note: the graphs show Series, which is filtered by Filters, and the logs are
+#  never filtered, so they have the raw values. 'filtered' is given if the temperatures have already been through Filter.
+def record_point(timex, temps, filtered=None): # time in seconds and an array of probe temperatures in Celsius
+    if filtered is None: # filter them now
+        filtered = Filter.update(temps)
+    Series.append(timex/60.0, c_to_f(filtered)) # time in minutes, temps in F
+# --End record_point function
+
+# --Define a function to pick the samples to record in adaptive recording
+# Note: every Adaptfast seconds a sample is checked, and it's recorded if any
+#  probe has moved more than Deadband from the last recorded sample, or has
+#  gone to or from a fault, or Maxgap seconds have passed since. So a ramp is
+#  recorded every Adaptfast seconds, and a steady hold every Maxgap seconds.
+# The last sample that wasn't recorded is held back, and recorded just before
+#  the one that moved, so a change starts where it really did. Then a straight
+#  line between the recorded samples stays within about 2 x Deadband of every
+#  sample checked, and the graphs and analysis tools can interpolate them.
+# Every sample goes through Filter, recorded or not, so the filters see a
+#  steady rate. Adaptstats has the samples checked and recorded.
+# Returns a list of (time, temps, filtered temps, probe reading) to record, in order
+def adaptive_samples(timex, temps):
+    global Adaptlast, Adaptpending # declare globals as needed
+    sample = (timex, temps, Filter.update(temps), Latest)
+    Adaptstats[0] = Adaptstats[0] + 1
+    if Adaptlast != None and timex - Adaptlast[0] < Maxgap: # check if anything has moved
+        moved = (np.abs(temps - Adaptlast[1]) > Deadband) | ((temps == temps) != (Adaptlast[1] == Adaptlast[1]))
+        if not moved.any(): # hold it back, in case the next one moves
+            Adaptpending = sample
+            return []
+    samples = [sample]
+    if Adaptpending != None: # the last steady sample first
+        samples.insert(0, Adaptpending)
+        Adaptpending = None
+    Adaptlast = (timex, temps)
+    Adaptstats[1] = Adaptstats[1] + len(samples)
+    return samples
+# --End adaptive_samples function
+
+# --Define a function to start adaptive recording again, e.g. after a restart
+def reset_adaptive():
+    global Adaptlast, Adaptpending # declare globals as needed
+    Adaptlast = None # so the next sample is recorded
+    Adaptpending = None
+# --End reset_adaptive function
+
+# --Define a function to log the last sample adaptive recording held back, at the end of a session
+# Note: the graphs don't need it, since the session is over, but the logs
+#  should run to the end, so the analysis tools see the whole session
+def finish_adaptive():
+    if Adaptpending != None:
+        log_sample(Adaptpending[0], Adaptpending[1], Adaptpending[3])
+    reset_adaptive()
+# --End finish_adaptive function
+
+# --Define a function to give the recording interval for a Time Interval choice
+def record_interval(choice): # seconds, 0 for adaptive recording
+    if choice == 0: # adaptive, so check often and let adaptive_samples pick
+        return Adaptfast
+    return choice
+# --End record_interval function
+
+# --Define a function to give the text for a Time Interval choice, for the menu
+def interval_text(choice):
+    if choice == 0:
+        return 'Auto'
+    return str(choice)
+# --End interval_text function
+
 # --Define a function to perform common timer 1 pop updates for all modes
-# Note: this affects data saving/recording and graphs
-def Do_rectimer_updates():
+# Note: this affects data saving/recording and graphs. The sample is timed by
+#  when the probes were read, on the same clock as the deadlines.
+#  In adaptive recording only the samples adaptive_samples picks are recorded.
+# Returns True if anything was recorded
+def Do_rectimer_updates(tick): # tick is the timer 1 pop event, with its deadline
     global Timex, Minx, Secx, Curtemp # declare global variables required    
+# Ignore a timer pop from before a restart, which was still queued when the session started again
+    if tick.deadline < Sessionstart:
+        return False
+# Check the deadline, and log any that were missed
+    check_deadline(tick)
 # Perform common timer 1 pop updates
-    Timex = Timex + Tinterval # update increment in seconds
+    Timex = max(Latest[0] - Sessionstart, Timex) # the time of the reading, in seconds, never going back if the probes fall behind
     Curtemp=get_temp() # get current temp
-    Templist.append(c_to_f(Curtemp)) # add to list
-    Timelist.append(Timex/60.0) # add the new value, but in mintes
-# Filter out one-time temperature glitches - works only in steady state for now.
-# This is a cheat for cosmetic purpose for now. Still get bumpy graphs.
-    if Glitchless == True and len(Templist) >2: # see if we want to reduce temp glitches
-        if Templist[-3] == Templist[-1] and Templist[-2] != Templist[-1]: # chk glitch
-            Templist[-2]=Templist[-1] # smooth over the glitch
-# Write data to log
-    Csvlog.write("{0},{1},{2}\n".format(str(int(Timex)),str(Curtemp),str(c_to_f(Curtemp)))) # write time (sec) and temp (F)
-    Csvlog.flush() # make sure the file is updated immediately     
+    curtemps = get_temps() # and all of the probes' temps
+    if Adapting == True: # only the samples that matter
+        samples = adaptive_samples(Timex, curtemps)
+    else: # every one, after any sample held back before adaptive recording was turned off
+        samples = [(Timex, curtemps, None, Latest)]
+        if Adaptpending != None:
+            samples.insert(0, Adaptpending)
+            reset_adaptive()
+    for timex, temps, filtered, latest in samples:
+        record_point(timex, temps, filtered) # add the new values, filtered for the graph
+# Write data to log, unfiltered
+        log_sample(timex, temps, latest) # write time (sec) and temps to the log
+    if Liveserver != None: # and send it to any browsers, with a new graph if they're watching
+        Liveserver.publish_sample(Timex, curtemps) # the live temperature, even if it wasn't recorded
+        if len(samples) > 0 and len(Liveserver.clients) > 0:
+            make_graph()
+    return len(samples) > 0
 # --End of Do_rectimer_updates function    
 
+# --Define a function to check a recording deadline, and record any that were missed
+# Note: a deadline is missed if the ticker slept through it, or its timer pop
+#  was still queued when a later one arrived, see dispatch_events. No sample is
+#  made up for it, since there's no reading for that time, so it's a gap in the logs.
+#  Tickstats has the samples, missed deadlines, total and worst lateness (sec).
+def check_deadline(tick):
+    lateness = Clock.monotonic() - tick.deadline
+    Recordlateness.observe(lateness)
+    Tickstats[0] = Tickstats[0] + 1
+    Tickstats[2] = Tickstats[2] + lateness
+    Tickstats[3] = max(Tickstats[3], lateness)
+    missed = tick.missed + Recskipped # slept through, or superseded in the queue
+    if missed > 0:
+        Tickstats[1] = Tickstats[1] + missed
+        log_missed([tick.deadline - Tinterval * count for count in range(missed, 0, -1)])
+        if Debugprt == True:
+            print ("Missed", missed, "recording deadline(s) before", round(tick.deadline - Sessionstart, 2), "sec")
+# --End check_deadline function
+
+# --Define a function to describe the recording deadlines, for debugging
+def tick_stats():
+    samples = max(Tickstats[0], 1) # avoid dividing by zero
+    stats = "Deadlines: {0} samples, {1} missed, {2:.2f} ms average lateness, {3:.2f} ms worst".format(
+        Tickstats[0], Tickstats[1], Tickstats[2]*1000/samples, Tickstats[3]*1000)
+    if Adaptstats[0] > 0: # how many adaptive recording kept
+        stats = stats + ", {0} of {1} adaptive samples recorded".format(Adaptstats[1], Adaptstats[0])
+    return stats
+# --End tick_stats function
+
+########################################
+# ----- Event handlers, looked up by dispatch_events in Eventhandlers and Buttonhandlers
+########################################
+
+# --Define a function to handle Quit if the window is closed - in X11 display mode only
+def quit_event(event):
+    if Debugprt == True:
+        print ("Quit Selected")
+    exit_programme() # close the log, turn off the LED and exit
+# --End quit_event function
+
+# --Define a function to handle a recording timer pop 1 in menu mode, to keep recording data up to date
+def record_tick(event):
+    Do_rectimer_updates(event) # update record variables and log
+# --End record_tick function
+
+# --Define a function to handle a recording timer pop 1 in non-menu mode
+# Note: the graph isn't drawn here. dispatch_events draws it once after all of
+#  the queued events, however many timer pops there were.
+def record_tick_show(event):
+    global Graphdue # declare globals as needed
+    recorded = Do_rectimer_updates(event) # update variables and log
+    if Displayshow == Displaygraph and recorded == True: # show a graph, if required and there's anything new
+        Graphdue = True
+# --End record_tick_show function
+
+# --Define a function to handle the time/temp/LED display update timer pop 2 in menu mode
+def display_tick(event):
+    Do_ttimer_updates() # Update the LED & time/temp display values
+# --End display_tick function
+
+# --Define a function to handle the time/temp/LED display update timer pop 2 in non-menu mode
+def display_tick_show(event):
+    Do_ttimer_updates() # Update the time/temp display values
+    if Displayshow == Displaytemp: # if we're supposed to be showing the temp
+        show_temp() # Show the new time/temp screen
+    elif Displayshow == Displaygraph and Graphbackend != 'matplotlib' and Graphdue == False: # quick graph
+        show_lcd_graph(True) # refresh the graph with the live temperature, unless it was just drawn
+# --End display_tick_show function
+
+# --Define a function to handle a graph drawn by the render worker, in any mode
+def frame_event(event):
+    global Graphsurface, Graphframe, Graphkey, Graphrequested, Renderworker, Graphrenderer # declare globals as needed
+    if event.gone == True: # the worker has stopped, so draw the graphs here from now on
+        print ("Graph failed:", event.error, "- drawing graphs in this process instead")
+        Renderworker.close()
+        Renderworker = None
+        Graphrenderer = WGOTrender.GraphRenderer(LCD_SIZE, Graphdpi, len(Probecs), Debugprt)
+        Graphrequested = None # draw it again
+        if Menumode == False and Displayshow == Displaygraph: # show it now
+            update_graph()
+        return
+    Renderworker.done() # so it can start on the next graph, if one is waiting
+    Renderstats[0] = Renderstats[0] + 1
+    Renderstats[1] = Renderstats[1] + event.seconds
+    Renderstats[2] = Renderstats[2] + event.skipped
+    Rendertime.observe(event.seconds) # the time the worker took, in the metrics
+    if event.error != None: # it couldn't be drawn, e.g. Graphfile can't be written
+        print ("Graph failed:", event.error)
+        if Graphrequested == event.tag: # draw it again next time
+            Graphrequested = None
+        return
+    if event.frame == None: # only exported
+        return
+    if event.tag == Graphkey: # the same as Graphsurface, so keep that
+        return
+    Graphframe = event.frame # keep the pixels, the surface uses them
+    Graphsurface = pygame.image.frombuffer(Graphframe, event.size, 'RGBA')
+    publish_graph(Graphframe, event.size)
+    Graphkey = event.tag # what it shows, unless it was invalidated meanwhile
+    if Graphrequested == None:
+        Graphkey = None
+    if Menumode == False and Displayshow == Displaygraph and Graphbackend == 'matplotlib': # show it now
+        show_graph()
+# --End frame_event function
+
+# --Define a function to handle a series snapshot asked for by the web server, in any mode
+def snapshot_event(event):
+    if event.points > 0: # about this many points, like the graphs
+        times, temps = Series.view(event.points)
+    else: # all of them
+        times, temps = Series.times(), Series.temps()
+    event.future.set_result((Series.version, times.copy(), temps.copy())) # copies, since Series carries on
+# --End snapshot_event function
+
+# --Define a function to handle a PiTFT button press - driven by the gpiobut GPIO callback function thread
+def button_event(event):
+    if Debugprt == True:
+        if Menumode == True:
+            print ("menu button =", event.button) # debug
+        else:
+            print ("button =", event.button) # debug
+    handler = Buttonhandlers.get((Menumode, event.button)) # what the button does in this mode
+    if handler != None:
+        handler()
+# --End button_event function
+
+# --Define a function to handle touchscreen events in non-menu mode
+# Switches display show type (graph or temp) if the screen is clicked/touched
+#   because it frees up a GPIO button for other uses
+def touch_event(event):
+    global Mousetimer # declare globals as needed
+# -Cleanup for noisy MOUSEBUTTON events on PiTFT, which causes problems
+# Note: Mouse position info for the touchscreen is currently useless on Stretch.
+# SDL TSLIB support used to do this stuff
+    if event.button == 1: # only watch for button 1 - touch screen filter #1
+        mousetime = pygame.time.get_ticks()/1000 # get the relative time in sec
+# Ignore too many MOUSEDOWN events together - touch screen filter #2
+        if mousetime - Mousetimer > Mousewait: # check if enough time has passed
+            Mousetimer = mousetime # if so, record this last touch/click
+            show_flip() #switch between temp and latest graph display
+            if Debugprt == True:
+                if Displayshow == Displaygraph:
+                    displayshow = 'Graph'
+                else: displayshow = 'Temperature'
+                print ("Touch to flip display selected. Now", displayshow)
+# --End touch_event function
+
+# --Define a function to handle keyboard events - replicate PiTFT buttons on keyboard for testing
+# Note: Keybuttons has the keys for each mode, and "x" is the emergency exit key in any mode
+def key_event(event):
+    if Debugprt == True:
+        if Menumode == True:
+            print ("Menu mode Key Pressed ", event.unicode)
+        else:
+            print ("Key Pressed ", event.unicode)
+# Turn keys into button events, as if they were GPIO events
+    if event.unicode in Keybuttons[Menumode]:
+        fastevent.post(pygame.event.Event(pygame.USEREVENT+3, button=Keybuttons[Menumode][event.unicode]))
+    elif event.unicode == "x": # x key will exit the programme
+        if Debugprt == True:
+            print ("Keyboard Exit Selected")
+        exit_programme() # close the log, turn off the LED and exit
+# --End key_event function
+
+########################################
+# ----- Non-Menu Mode button handlers
+########################################
+
+# --Define a function for button 2 - Capture Hold data
+def hold_button():
+    global Htimex, Hminx, Hsecx, Htemp, Htempf # declare globals as needed
+    if Debugprt == True:
+        print ("Button 2 captures a Hold event")
+# Capture Hold data
+    Htimex = Updtimex # Capture the time in seconds
+    Hminx = Minx # capture minutes ...
+    Hsecx = Secx # and in seconds too
+    Htemp = Curtemp # Capture the current temp in Celsius
+    Htempf = c_to_f(Htemp) # Capture the temp in Farenheit
+    log_hold(Htemp) # record it, so it can be resumed
+# Update the display immediately, to show we've got it
+    if Displayshow == Displaytemp: # Update the display, if showing temps
+        show_temp() # show the temperatures again
+# --End hold_button function
+
+# --Define a function for button 3 - Restart data capture
+def restart_button():
+    global Timex, Minx, Secx, Updtimex, Curtemp, Displayshow # declare globals as needed
+    global Htemp, Htempf, Htimex, Hminx, Hsecx, Session, Sessionstart
+    if Debugprt == True:
+        print ("Button 3 resets the time, temperature and graph")
+    finish_adaptive() # the last session's logs run to its end, before the restart is logged
+# Initialize variables all over again and show temperatures to start
+    Sessionstart = Clock.monotonic() # the session starts again now
+    rearm_ticker() # with the timer deadlines from now
+    Timex=0 # total time since execution started in seconds
+    Minx=0 # total time since execution started in minutes
+    Secx=0 # leftover seconds for Minx:Secx display
+    Updtimex = 0 # Total time since execution started, for temp display
+    Curtemp=get_temp() # get new current temperature
+    Series.reset() # forget the recorded times and temperatures
+    Filter.reset() # and start the filters again
+    invalidate_graph() # and the graphs of them
+    record_point(Timex, get_temps()) # time-zero entry for make_graph
+    Displayshow=Displaytemp # default to show temperature again
+    Htemp = Curtemp # restart hold data too
+    Htempf = c_to_f(Curtemp) # get this in Farenheit
+    Htimex = 0 # init hold time
+    Hminx = 0 # init hold time min
+    Hsecx = 0 # init hold time sec
+    Session = Session + 1 # a new session id for the binary log
+    if Logrotatesession == True: # start new logs for the new session
+        Csvlog.rotate()
+        if Binlog != None:
+            Binlog.rotate()
+    else: # record the restart in the logs
+        log_restart()
+    log_sample(Timex, get_temps()) # write time (sec) and temps to the log
+    show_temp() # show the temperature and time
+# --End restart_button function
+
+# --Define a function for button 4 --- switch to Menu mode
+def menu_button():
+    global Menumode, Mmenuline, Menunow # declare globals as needed
+    if Debugprt == True:
+        print ("Button 4 switches to Menu mode")
+    Menumode = True # Turn on Menu Mode for future events
+    Mmenuline = 1 # start main menu with line 1 highlighted
+# Note: Menunow is just a reference to a menu and not the contents of the menu itself
+# This makes for easy, efficient checks for the current menu
+    Menunow = main_menu # set the current menu, for the record
+    show_text_menu(main_menu,Mmenuline,button_menu2) # Show the main menu, 1st line highlighted
+# --End menu_button function
+
+########################################
+# ---- Menu Mode button handlers
+########################################
+
+# --Define a function for button 2 - Menu mode - Up
+def up_button():
+    global Mmenuline, Ttempadj, Ttimeval # declare globals as needed
+    if Debugprt == True:
+        print ("Button 2 is Up")
+# -Handle Up on the main menu
+    if Menunow == main_menu: # Check if we're on the main menu
+        if Mmenuline == 1: # if we're at the top
+            Mmenuline = Mmenumax # roll to the bottom line
+        else:
+            Mmenuline = Mmenuline-1 # otherwise, just go up a line
+        show_text_menu(main_menu,Mmenuline,button_menu2) # show the new highlighted menu line
+# -Handle Up in the Temperature Adjustment menu
+# Note: the following is a reference comparison and not a content comparison
+# i.e. Even if the contents of the tempadj_menu have changed it can be True
+    elif Menunow == tempadj_menu: # check if we're in the temp adjust menu
+        if Ttempadj <10: # upper limit is 10 for now
+            Ttempadj = round(Decimal(Ttempadj) + Decimal(0.1),1) # increment Temperature adjustment
+        tempadj_menu[2][4] = str(Ttempadj) #show current temperature adjustment
+        show_text_menu(tempadj_menu,2,button_menu2) # show updated menu
+# -Handle Up in the Time Adjustment menu
+    elif Menunow == timeadj_menu and Ttimeval < len(Timevals)-1: # chk if we're in the time adjust menu
+        Ttimeval = Ttimeval + 1 # move to the next highest value
+        timeadj_menu[2][4] = interval_text(Timevals[Ttimeval]) #show current time adjustment
+        show_text_menu(timeadj_menu,2,button_menu2) # show new menu
+# --End up_button function
+
+# --Define a function for button 3 --- Down - in menu mode
+def down_button():
+    global Mmenuline, Ttempadj, Ttimeval # declare globals as needed
+    if Debugprt == True:
+        print ("Button 3 is Down")
+# -Handle Down on main menu
+    if Menunow == main_menu: # Check if we're on the main menu
+        if Mmenuline == Mmenumax: # if we're at the bottom
+            Mmenuline = 1 # roll to the top line (line 0 is the title)
+        else:
+            Mmenuline = Mmenuline+1 # Otherwise just go to the next line
+        show_text_menu(main_menu,Mmenuline,button_menu2) # show the new highlighted menu line
+# -Handle Down on the Temperature Adjustment menu - in decimal
+    elif Menunow == tempadj_menu: # Check if we're on the temp adjust menu
+        if Ttempadj > -10.0: # lower limit is -10 for now
+            Ttempadj = round(Decimal(Ttempadj) - Decimal(0.1),1) # increment Temperature adjustment
+        tempadj_menu[2][4] = str(Ttempadj) #show current temperature adjustment
+        show_text_menu(tempadj_menu,2,button_menu2) # show new menu
+# -Handle Down in Time adjustment menu
+    elif Menunow == timeadj_menu and Ttimeval > 0: # chk if we're in the time adjust menu
+        Ttimeval = Ttimeval - 1 # go down one item if not at the first value
+        timeadj_menu[2][4] = interval_text(Timevals[Ttimeval]) #show current time adjustment
+        show_text_menu(timeadj_menu,2,button_menu2) # show updated menu
+# --End down_button function
+
+# --Define a function for button 4 --- Select, in menu mode
+def select_button():
+    global Menumode, Menunow, Ttempadj, Ttimeval, Timeval, Tinterval, Adapting # declare globals as needed
+    if Debugprt == True:
+        print ("Button 4 is Select")
+# ---- Handle Select on the main menu
+    if Menunow == main_menu: # check if we're on the main menu
+# -Handle 'Exit' selected from main menu  - always first, for debugging
+        if Mmenuline == 4: # check for line 4 select - Exit programme
+            if Debugprt == True:
+                print ("Exit Selected")
+            exit_programme() # close the log, turn off the LED and exit
+# -Handle Temp Adjust selected from main menu menu
+        elif Mmenuline == 1: # Check for Temp Adj
+            if Debugprt == True:
+                print ("Selected Temp Adj menu")
+            Menunow = tempadj_menu # update what menu we're in now
+            Ttempadj = Probeadj[0] # Get the current adjustment for the menu
+            tempadj_menu[2][4] = str(Ttempadj) #show current temperature adjustment
+            show_text_menu(tempadj_menu,2,button_menu2) # show new menu
+# -Handle Time Adjust selected from main menu
+        elif Mmenuline == 2: # Check for Time Adj
+            if Debugprt == True:
+                print ("Selected Time Adj menu")
+            Menunow = timeadj_menu # update what menu we're in now
+            Ttimeval = Timeval # Set a temporary index for menu purposes
+            timeadj_menu[2][4] = interval_text(Timevals[Ttimeval]) #show current time adjustment
+            show_text_menu(timeadj_menu,2,button_menu2) # show new menu
+# -Handle 'Return' selected from main menu
+        elif Mmenuline == 3: # check for Return selected
+            if Debugprt == True:
+                print ("Return Selected")
+# Show updated display now, as appropriate to the mode we were in before menu mode
+            if Displayshow==Displaytemp: # if we were showing the temperature
+                show_temp() # show current temperature
+# Show graph, if that's the mode we were in
+            elif Displayshow == Displaygraph: # show a graph, if required
+                update_graph()
+            Menumode = False # Turn off menu mode for now, as if 'Return' was selected
+# ---- Handle Select in Temperature Adjustment menu
+    elif Menunow == tempadj_menu: # check if we're on the temp adjust menu
+        Probeadj[0] = float(Ttempadj) # Put the new adjustment value into effect, for the main probe
+        invalidate_graph() # the live temperature and colour may change
+# Note: it might be good to also reset values, but there might be a need not to do this
+        Menunow = main_menu # Update current menu to main_menu
+        show_text_menu(main_menu,Mmenuline,button_menu2) # show it
+        if Debugprt == True:
+            print ("Temp Adjust Value Selected =",Probeadj[0])
+# ---- Handle Select in Time Adjustment menu
+    elif Menunow == timeadj_menu: #check if we're in the time adj menu
+        Timeval = Ttimeval # the new choice, for the next time the menu is shown
+        Tinterval = record_interval(Timevals[Timeval]) # set the new timer interval in sec
+        if Adapting == False and Timevals[Timeval] == 0: # start adaptive recording from the next sample
+            reset_adaptive()
+        Adapting = Timevals[Timeval] == 0
+        rearm_ticker() # the next recording deadline is on the new interval, from the session start
+        Menunow = main_menu # Update current menu to the main_menu
+        show_text_menu(main_menu,Mmenuline,button_menu2) # show it
+        if Debugprt == True:
+            print ("Time Adjust Selected =",interval_text(Timevals[Timeval]))
+# --End select_button function
+
+########################################
+# ----- Event dispatcher
+########################################
+
+# --Define a function to call a handler, timing it for the dispatcher stats
+# Note: Handlerstats has [calls, total sec, slowest sec] for each handler, by name,
+#  and Handling has the name and start time of the handler being called, if any
+def timed_call(handler, event):
+    global Handling # declare globals as needed
+    start = time.perf_counter() # real time, even in a simulation
+    Handling = (handler.__name__, start) # for the watchdog, if this stalls
+    handler(event)
+    Handling = None
+    elapsed = time.perf_counter() - start
+    stats = Handlerstats.get(handler.__name__)
+    if stats == None: # the first call
+        stats = Handlerstats[handler.__name__] = [0, 0.0, 0.0]
+    stats[0] = stats[0] + 1
+    stats[1] = stats[1] + elapsed
+    stats[2] = max(stats[2], elapsed)
+# --End timed_call function
+
+# --Define a function to handle a batch of events, all that were waiting in the queue
+# Note: only the newest recording timer pop is sampled, since the older ones
+#  would all record the same latest reading at the wrong times, and they're
+#  counted as missed deadlines instead. The graph is drawn once at the end, and
+#  queued display timer pops are handled as one, so a slow frame isn't followed
+#  by a burst of redraws to catch up.
+#  Other events are handled in order by Eventhandlers, for the current mode.
+def dispatch_events(events):
+    global Displayticks, Graphdue, Recskipped # declare globals as needed
+    Queuestats[0] = Queuestats[0] + 1 # batches
+    Queuestats[1] = Queuestats[1] + len(events) # events
+    Queuestats[2] = max(Queuestats[2], len(events)) # deepest queue
+    Batchsizes.observe(len(events))
+    Displayticks = 0 # display timer pops in this batch
+    Graphdue = False # set if a recording timer pop needs the graph drawn
+    tick = None # the last display timer pop
+    record = None # the last recording timer pop, the only one that's sampled
+    for event in events:
+        if event.type == USEREVENT+1:
+            record = event
+    Recskipped = 0 # older recording timer pops in this batch, i.e. missed deadlines
+    for event in events:
+        if event.type == USEREVENT+2: # display timer pop, coalesced
+            Displayticks = Displayticks + 1
+            tick = event
+            continue
+        if event.type == USEREVENT+1 and event is not record: # there's a newer reading to record
+            Recskipped = Recskipped + 1
+            continue
+        handler = Eventhandlers.get((Menumode, event.type))
+        if handler != None: # other events are ignored
+            timed_call(handler, event)
+    if Displayticks > 1:
+        Queuestats[3] = Queuestats[3] + Displayticks - 1 # redraws saved
+    if Graphdue == True and Menumode == False and Displayshow == Displaygraph: # the mode may have changed
+        timed_call(draw_graph, tick) # live, if there's a display timer pop too
+    if tick != None:
+        Displaylateness.observe(Clock.monotonic() - tick.deadline)
+        timed_call(Eventhandlers[(Menumode, USEREVENT+2)], tick)
+# --End dispatch_events function
+
+# --Define a function to draw the graph once for a batch of recording timer pops
+def draw_graph(tick): # tick is the display timer pop, if there is one
+    update_graph(tick != None) # with the live temperature for a display timer pop
+# --End draw_graph function
+
+# --Define a function to describe the render worker's performance, for debugging
+def render_stats():
+    frames = max(Renderstats[0], 1) # avoid dividing by zero
+    return "Render worker: {0} graphs, {1:.1f} ms average to draw, {2} requests dropped".format(
+        Renderstats[0], Renderstats[1]*1000/frames, Renderstats[2] + Renderworker.dropped)
+# --End render_stats function
+
+# --Define a function to describe the queue depths and handler times, for debugging
+def dispatch_stats():
+    batches = max(Queuestats[0], 1) # avoid dividing by zero
+    text = "Events: {0} in {1} batches, {2:.2f} per batch, {3} deepest, {4} redraws coalesced".format(
+        Queuestats[1], Queuestats[0], Queuestats[1]/float(batches), Queuestats[2], Queuestats[3])
+    for name in sorted(Handlerstats): # calls, average and slowest times
+        calls, total, slowest = Handlerstats[name]
+        text = text + "\n  {0:18s} {1:7d} calls {2:8.2f} ms avg {3:8.2f} ms max".format(
+            name, calls, total*1000/calls, slowest*1000)
+    return text
+# --End dispatch_stats function
+
+# --Define a function to add the thermometer's counters to the metrics
+# Note: each is a function, read when the metrics are given out, so the
+#  counters are kept where they are and cost nothing more in the event loop
+def register_metrics():
+    Metrics.gauge('samples_total', "Samples recorded", lambda: Tickstats[0], kind='counter')
+    Metrics.gauge('missed_deadlines_total', "Recording deadlines missed", lambda: Tickstats[1], kind='counter')
+    Metrics.gauge('probe_readings_total', "Readings of all of the probes by the acquisition thread", lambda: Ringindex, kind='counter')
+    Metrics.gauge('events_total', "Events handled by the event loop", lambda: Queuestats[1], kind='counter')
+    Metrics.gauge('event_batches_total', "Batches of events handled together", lambda: Queuestats[0], kind='counter')
+    Metrics.gauge('redraws_coalesced_total', "Display updates saved by handling queued timer pops as one", lambda: Queuestats[3], kind='counter')
+    Metrics.gauge('cache_hits_total', "Cache lookups that were reused", lambda: Textcachehits, 'cache="text"', 'counter')
+    Metrics.gauge('cache_hits_total', "Cache lookups that were reused", lambda: Graphcachestats[0], 'cache="graph"', 'counter')
+    Metrics.gauge('cache_misses_total', "Cache lookups that had to be drawn", lambda: Textcachemisses, 'cache="text"', 'counter')
+    Metrics.gauge('cache_misses_total', "Cache lookups that had to be drawn", lambda: Graphcachestats[1], 'cache="graph"', 'counter')
+    Metrics.gauge('series_points', "Recorded points kept in memory for the graphs", lambda: len(Series))
+    Metrics.gauge('adaptive_checked_total', "Samples checked by adaptive recording", lambda: Adaptstats[0], kind='counter')
+    Metrics.gauge('adaptive_recorded_total', "Samples recorded by adaptive recording", lambda: Adaptstats[1], kind='counter')
+    for log in [Csvlog, Binlog]:
+        if log != None:
+            labels = 'log="%s"' % log.kind
+            Metrics.gauge('log_queue_depth', "Lines waiting for the log writer thread", log.queue.qsize, labels)
+            Metrics.gauge('log_stalls_total', "Times the event loop waited for a full log queue", (lambda log=log: log.stalls), labels, 'counter')
+            Metrics.gauge('log_dropped_total', "Log writes lost to write errors, or with no writer thread", (lambda log=log: log.dropped), labels, 'counter')
+    if Renderworker != None:
+        Metrics.gauge('render_dropped_total', "Graph requests replaced before they were drawn",
+                      lambda: Renderstats[2] + Renderworker.dropped, kind='counter')
+    for name in ('eventloop', 'acquire'):
+        Metrics.gauge('stalls_total', "Stalls found by the watchdog", (lambda name=name: Watchdog.counts.get(name, 0)),
+                      'thread="%s"' % name, 'counter')
+    if Liveserver != None:
+        Metrics.gauge('web_clients', "Browsers watching the live samples", lambda: len(Liveserver.clients))
+        Metrics.gauge('web_dropped_total', "Live samples dropped for slow browsers", lambda: Liveserver.stats['dropped'], kind='counter')
+# --End register_metrics function
+
+# --Define a function to print a performance summary, and save the metrics file if there is one
+# Note: the stage times are the median and the slowest 1% since the last
+#  summary, and the cache hit rates are since the start
+def report_metrics():
+    text = "Performance: " + Metrics.summary()
+    for name, hits, misses in (('text', Textcachehits, Textcachemisses), ('graph', Graphcachestats[0], Graphcachestats[1])):
+        text = text + ", {0} cache {1:.0%}".format(name, hits / float(max(hits + misses, 1)))
+    print (text + ", {0} missed".format(Tickstats[1]))
+    if Metricsfile != '':
+        try:
+            Metrics.write(Metricsfile)
+        except Exception as error: # carry on, but say what happened
+            print ("Can't write", Metricsfile, error)
+# --End report_metrics function
+
 #---------------End Function Definitions-----------
 ########################################
 #----- Begin Main Programme
 ########################################
 #---------------Initialization---------------------
 
+# --Read the command line options and choose the clock
+read_options()
+if Hardware == 'sim': # virtual time, which may run faster than real time
+    import WGOTsim # simulated hardware, for testing without a Pi, only imported when it's needed since it brings NumPy in
+    Clock = WGOTsim.SimClock(Simspeed)
+else: # real time, at the real speed
+    Clock = time
+    Simspeed = 1.0
+Profiler = None # the main thread profiler, if Profilefile is set
+if Profilefile != '':
+    import cProfile # used to profile the main thread
+    import pstats # used to show the profile in debug mode
+    Profiler = cProfile.Profile()
+    Profiler.enable()
+# --End command line options
+
 # --Initialize the PiTFT LCD and touchscreen
 
 LCD_WIDTH = 320 # the width of the PiTFT in pixels
@@ -318,20 +2112,13 @@ os.putenv('SDL_MOUSEDRV', 'TSLIB') # TSLIB doesn't work too well with Stretch
 os.putenv('SDL_MOUSEDEV', '/dev/input/touchscreen') # Mouse is PiTFT touchscreen
 # The following checks whether to take the SDL default screen (usually X11) or not
 # Note: HDMI (X11) display will blank during this test on an actual PiTFT
-if Forcetft == True: # See if we want to force using the PiTFT
+if Hardware == 'sim': # no display at all for a simulation, so it can run anywhere
+    os.putenv('SDL_VIDEODRIVER','dummy')
+elif Forcetft == True: # See if we want to force using the PiTFT
 #    os.environ['SDL_VIDEODRIVER'] = 'fbcon' #test
     os.putenv('SDL_VIDEODRIVER','fbcon') # force PyGame display to the PiTFT, maybe
 # --End PiTFT Initialization
 
-# --Intialize MAX31855 configuration - from Adafruit sample code
-# Must run as Root (sudo) for this to work
-# Raspberry Pi software SPI configuration
-CLK = 5 # RSF - was 25 - avoid piTFT conflict
-CS  = 6 # RSF - was 24 - avoid piTFT conflict
-DO  = 16 # RSF - was 18 - avoid potential piTFT or PWM conflict
-sensor = MAX31855.MAX31855(CLK, CS, DO)
-# --End MAX31855 initialization
-
 # --Initialize Pygame
 pygame.init() #Initialize Pygame
 pygame.mouse.set_visible(False) # Hide the useless mouse pointer   
@@ -340,27 +2127,97 @@ fastevent.init() # Initialize fastevents for multithreaded GPIO detect
 pygame.event.set_blocked(pygame.MOUSEMOTION) # Block these from filling the event queue
 pygame.event.set_blocked(pygame.MOUSEBUTTONUP) # Block these from filling the event queue too
 pygame.font.init() # Required to use fonts
-
-# -Initialize pygame timer events
-# Initialize the pygame time event and variables for recording purposes
-Timeval = 0 # start sample rate at first entry in list
-Tinterval = Timevals[Timeval] # set the timer interval in msec
-# Define  a pygame user event for the recording timer
-pygame.time.set_timer(USEREVENT+1, Tinterval*1000) # create a timer event #1
-
-# -Initialize a pygame timer event to update the time/temperature display
+Fontcache = {} # fonts loaded so far, by (name, size)
+Textcache = OrderedDict() # rendered text surfaces, least recently used first
+Textcachehits = 0 # count of text renders saved by the cache
+Textcachemisses = 0 # count of text actually rendered
+Screennow = None # the (menu, buttons) text screen currently shown, if any
+Screenitems = {} # the text and position of each line currently shown
+Startmarks = OrderedDict() # startup profile times (sec), by name, in order
+
+# -Initialize the timer events, posted by the ticker thread once the initialization is done
+# Initialize the variables for recording purposes, timer event #1
+Timeval = 0 if Adaptive == True else 1 # start with adaptive recording, or at the first fixed rate in the list
+Tinterval = record_interval(Timevals[Timeval]) # set the timer interval in sec
+Adapting = Timevals[Timeval] == 0 # True while recording adaptively
+# Initialize the variables to update the time/temperature display, timer event #2
 Updinterval = 1 # Update interval in sec (may be longer for easier save/hold)
 Updtimex = 0 # Initialize update timer value since start
-pygame.time.set_timer(USEREVENT+2, Updinterval*1000) # create timer event #2
+Ticklock = threading.Lock() # stops the deadlines being read while they're moved
+Tickerwake = threading.Event() # wakes the ticker up when the deadlines are moved
+Tickdeadlines = [0.0, 0.0] # the next recording and display times on Clock, set by rearm_ticker
 # --End Pygame initialization
 
 # --Show a splash screen during initialization, in case it takes some time to start
 show_text_menu(splash_screen,None,None) # Show the splash screen - no buttons
+startup_mark('splash') # for the startup profile
 # --End show splash screen
 
+# --Import the hardware and data packages, now that the splash screen is showing
+if Hardware == 'sim': # stand-ins for the hardware
+    GPIO = WGOTsim.SimGPIO(Clock)
+else:
+    import RPi.GPIO as GPIO # GPIO is a shorthand name
+GPIO.setmode(GPIO.BCM) # use BCM chip's numbering scheme vs. pin numbers, before any pins are set up
+import numpy as np # np is a shorthand name
+# The following require prior s/w installations.
+# Follow the directions on the back of the box for details.
+import WGOTprobe # to talk to the MAX31855 boards
+import WGOTlog # log file formats, shared with the offline tools
+import WGOTfilter # temperature filters for the graphs, shared with the offline tools
+import WGOTrender # draws the matplotlib graph, in a worker process or here
+if Webserver != '': # only needed to serve browsers
+    import WGOTserver
+from WGOTlog import c_to_f # Celsius to Fahrenheit, the same as the offline tools use
+startup_mark('imports') # for the startup profile
+# --End hardware and data package imports
+
+# --Start the matplotlib graph render worker, if it's needed
+# Note: the worker is forked from this process, so it's started before any other threads.
+#  That's after the display and splash screen, but the worker never uses pygame.
+Graphdpi = 50.0 # dots per inch for the in-memory graph, 320x240 at 6.4x4.8 inches
+Graphrenderer = None # draws the graph in this process, if there's no worker
+Renderworker = None # draws the graph in its own process
+if Graphbackend == 'matplotlib' or Graphexport > 0 or Webserver != '': # the web server shows the matplotlib graph
+    if Graphworker == True:
+        Renderworker = WGOTrender.RenderWorker(LCD_SIZE, Graphdpi, len(Probecs), Prewarm, Debugprt)
+        Receiver = threading.Thread(target=receive_frames, name='frames')
+        Receiver.daemon = True # don't keep the programme alive on exit
+        Receiver.start()
+    else:
+        Graphrenderer = WGOTrender.GraphRenderer(LCD_SIZE, Graphdpi, len(Probecs), Debugprt)
+Renderstats = [0, 0.0, 0] # graphs drawn by the worker, total seconds to draw, requests skipped by the worker
+# --End graph render worker
+
+# --Intialize MAX31855 configuration - from Adafruit sample code
+# Must run as Root (sudo) for this to work
+# Raspberry Pi software SPI configuration, also the fallback for hardware SPI
+CLK = 5 # RSF - was 25 - avoid piTFT conflict
+DO  = 16 # RSF - was 18 - avoid potential piTFT or PWM conflict
+# Each probe's CS is in Probecs. RSF - the first was 24 - avoid piTFT conflict
+if Hardware == 'sim': # simulated probes, replaying a log or following heat curves
+    Probebus = WGOTsim.SimBus([WGOTsim.SimSensor(Clock, Simreplay or None, Simnoise, Simfaults,
+        setpoint=180.0 - 15.0 * probe, tau=600.0 + 120.0 * probe, seed=Simseed + probe, probe=probe)
+        for probe in range(len(Probecs))]) # each probe heats a little differently
+else: # hardware or software SPI, following Spibackend
+    Probebus = WGOTprobe.open_bus(Spibackend, CLK, DO, Probecs, GPIO, Spiport, Spidevice)
+if Debugprt == True:
+    print ("Reading", len(Probebus), "probe(s) with", Probebus.name)
+# Take the first reading now, then leave the rest to the acquisition thread
+Ringsize = 64 # number of recent probe readings kept
+Ringtemps = np.full((Ringsize, len(Probecs)), np.nan) # the ring buffer of recent readings in C, a column per probe
+Ringindex = 0 # total readings so far, the next ring buffer slot is this modulo Ringsize
+read_probe() # make sure there's a Latest reading to start with
+startup_mark('first sample') # for the startup profile
+Watchdog = StallWatchdog(Stallwatch) # takes the beats from here on, and starts watching once the LED is set up
+Handling = None # the event handler being called, and when it started, for the watchdog
+Acquirer = threading.Thread(target=acquire, name='acquire')
+Acquirer.daemon = True # don't keep the programme alive on exit
+Acquirer.start()
+# --End MAX31855 initialization
+
 # --Initialize GPIO for PiTFT 2.8" touchscreen P/N 2423 buttons and activity LED
 # Note: PiTFT buttons connect GPIO port to ground, hence pull them up when open
-GPIO.setmode(GPIO.BCM) # use BCM chip's numbering scheme vs. pin numbers
 # Note: Button 17 (top right) is assumed reserved for OS shutdown here
 #  by configuring it in /boot/config.txt with dtoverlay=gpio-shutdown,gpio_pin=17
 # Wiring it directly to GPIO 3 also makes it an OS revive button
@@ -371,20 +2228,30 @@ Ledgpio = 21 # pick a free GPIO for the activity LED, handy location on PiHat to
 GPIO.setup(Ledgpio, GPIO.OUT) # Define a pin for simple LED activity indicator
 GPIO.output(Ledgpio, GPIO.HIGH) # turn on the LED to show we're running
 Led = True # record the state of the LED
+if Stallwatch > 0: # the watchdog flashes the LED from now on
+    Watchdog.start(Stalllog)
 # Define GPIO button event handlers for the PiTFT 2423
 GPIO.add_event_detect(22, GPIO.FALLING, callback=gpiobut, bouncetime=300)
 GPIO.add_event_detect(23, GPIO.FALLING, callback=gpiobut, bouncetime=300)
 GPIO.add_event_detect(27, GPIO.FALLING, callback=gpiobut, bouncetime=300)
+if Hardware == 'sim': # start pressing the simulated buttons, and set the end of the simulation
+    GPIO.run_script(Simbuttons)
+    if Simduration > 0:
+        Ender = threading.Thread(target=end_simulation, name='endsim')
+        Ender.daemon = True # don't keep the programme alive on exit
+        Ender.start()
 # --End GPIO Initialization
 
 # --Initialize main variables
+Sessionstart = Clock.monotonic() # when the recording session started, on Clock
 Timex=0 # total time since execution started in seconds
 Minx=0 # total time since execution started in minutes
 Secx=0 # leftover seconds for Minx:Secx display
-Ttempadj = Tempadj # Set temporary timer interval to the same, for Time Adj menu
+Ttempadj = Probeadj[0] # Set temporary timer interval to the same, for Time Adj menu
 Curtemp=get_temp() # get current temperature to start
-Timelist=[Timex/60.0] # dummy list for make_graph
-Templist=[c_to_f(Curtemp)] # dummy list for make_graph
+Series = TimeSeries(Seriesmax, len(Probecs)) # the recorded times and temperatures for graphs, filtered
+Filter = WGOTfilter.FilterPipeline(Filters, len(Probecs)) # the graph filters for each probe
+record_point(Timex, get_temps()) # time-zero entry for make_graph
 Displaytemp=1 # value if we're showing temperature
 Displaygraph=2 # value if we're showing a graph
 Displayshow=Displaytemp # default to show temperature initially
@@ -397,368 +2264,128 @@ Mousetimer = pygame.time.get_ticks()/1000 # init timer (sec) for mouse/touch deb
 Mousewait = 2 # choose 2 sec between MOUSEDOWN events for touch debounce
 Menumode = False # Start without a menu
 Mmenuline = 1 # start with line 1 on main menu
+# The event handlers for each mode, by (Menumode, event type), see dispatch_events
+Eventhandlers = {(False, QUIT): quit_event, (True, QUIT): quit_event,
+                 (False, USEREVENT+1): record_tick_show, (True, USEREVENT+1): record_tick,
+                 (False, USEREVENT+2): display_tick_show, (True, USEREVENT+2): display_tick,
+                 (False, USEREVENT+3): button_event, (True, USEREVENT+3): button_event,
+                 (False, pygame.MOUSEBUTTONDOWN): touch_event, # no touch in menu mode
+                 (False, pygame.KEYDOWN): key_event, (True, pygame.KEYDOWN): key_event,
+                 (False, USEREVENT+4): frame_event, (True, USEREVENT+4): frame_event,
+                 (False, USEREVENT+5): snapshot_event, (True, USEREVENT+5): snapshot_event}
+# The PiTFT button handlers for each mode, by (Menumode, button)
+Buttonhandlers = {(False, 2): hold_button, (False, 3): restart_button, (False, 4): menu_button,
+                  (True, 2): up_button, (True, 3): down_button, (True, 4): select_button}
+Keybuttons = {False: {"h": 2, "r": 3, "m": 4}, # hold, restart and menu keys in non-menu mode
+              True: {"u": 2, "d": 3, "s": 4}} # up, down and select keys in menu mode
+Displayticks = 0 # display timer pops in the batch of events being handled
+Recskipped = 0 # older recording timer pops in the batch of events being handled
+Tickstats = [0, 0, 0.0, 0.0] # samples, missed deadlines, total and worst lateness (sec)
+Adaptstats = [0, 0] # samples checked and recorded by adaptive recording
+Adaptlast = None # the time (sec) and temps (C) of the last sample recorded adaptively
+Adaptpending = None # the last sample checked but held back by adaptive recording, see adaptive_samples
+Graphdue = False # set if the graph needs drawing after the batch of events
+Queuestats = [0, 0, 0, 0] # event batches, events, deepest queue and redraws coalesced
+Handlerstats = {} # [calls, total sec, slowest sec] for each event handler, by name
+Batchsizes = Metrics.histogram('event_batch_size', "Events handled together, i.e. the depth of the event queue",
+                               bounds=WGOTmetrics.DEPTH, short='batch')
+Recordlateness = Metrics.histogram('timer_lateness_seconds', "Seconds from each timer deadline until it was handled",
+                                   'timer="record"', short='record late')
+Displaylateness = Metrics.histogram('timer_lateness_seconds', "Seconds from each timer deadline until it was handled",
+                                    'timer="display"', short='display late')
+Rendertime = Metrics.stage('render_worker') # the time the render worker took to draw each graph
+Metricsdue = Clock.monotonic() + Metricsinterval # when the next performance summary is due
+Graphsurface = None # the graph from make_graph, as a pygame surface
+Graphframe = None # the RGBA pixels of Graphsurface
+Graphkey = None # the graph_key of Graphsurface
+Graphrequested = None # the graph_key of the latest graph asked for
+Graphcachestats = [0, 0] # graphs reused and graphs drawn, for both backends
+Graphversion = 0 # counts the graphs sent to the web server
+Liveserver = None # the web server, started after the logs
+Graphpixels = 275 # approximate width in pixels of the matplotlib graph's plot area
+Graphexported = -Graphexport # time (sec) of the last Graphfile export, so the first one happens
+Lcdgraphrect = pygame.Rect(44, 24, 266, 186) # the plot area of the pygame graph
+Lcdgridx = 5 # number of grid divisions along the time axis
+Lcdgridy = 4 # number of grid divisions along the temperature axis
+Lcdgraphbg = None # the pygame graph background is built on first use
+Lcdgraphcache = None # the last pygame graph drawn, with all of its data
+Lcdgraphkey = None # the graph_key of Lcdgraphcache
 # --End main variables initialization
 
-# --Intitialize a csv-format log file and save two previous ones
+# --Intitialize a csv-format log file and save previous ones
+# - Start the thread that compresses saved logs, at low priority
+Compressq = queue.Queue() # saved logs waiting to be compressed
+Rotatelock = threading.Lock() # stops renames and removals from overlapping
+Logfiles = [Csvfilename] # the live log files, for the disk budget
+if Binfilename != '':
+    Logfiles.append(Binfilename)
+Compressor = threading.Thread(target=compress_logs, name='compress')
+Compressor.daemon = True # don't keep the programme alive on exit
+Compressor.start()
+# - Carry on with the last session, if required and there is one
+Session = int(time.time()) # an id for this recording session, counted up by restarts
+Timeoffset = 0.0 # added to the monotonic clock, to carry on with resumed binary log times
+Resumed = None # the log we resumed from, if any
+if Resume == True:
+    Resumed = resume_session()
 # - Try to save some csv file to avoid data loss over reboot/restarts
-try: # only if it exists, remove the oldest save file
-    os.remove(Csvfilename+'save2') # remove oldest (save2) file first
-except: # if it's not there, we don't care
-    pass
-try: # only if it exists, rename the old save file to oldest
-    os.rename(Csvfilename+'save1',Csvfilename+'save2') # rename save1 to save2
-except: # if it's not there, we don't care
-    pass
-try: # only if it exists rename the last  csv log file to save1
-    os.rename(Csvfilename,Csvfilename+'save1') # rename the last to save1
-except: # if it's not there, we don't care
-    pass
+if Resumed == None: # if we're resuming, keep adding to the same log
+    rotate_log(Csvfilename)
 # - Open the new file, regardless of what happened just above   
-Csvlog = open(Csvfilename,"w") # open the csv log file fresh, for writing
-Csvlog.write("{0},{1},{2}\n".format(str(int(Timex)),str(Curtemp),str(c_to_f(Curtemp)))) # write time (sec) and temp (F)
-Csvlog.flush() # make sure the file is updated immediately 
+Csvlog = LogWriter(Csvfilename,"a") # open the csv log file for writing, fresh unless resuming
+atexit.register(Csvlog.close) # make sure it's written out, however we exit
+# - The same for the binary log, if there is one
+Binlog = None
+if Binfilename != '': # check if we want a binary log
+    if Resumed != 'bin': # if we resumed from it, keep adding to it
+        rotate_log(Binfilename)
+    Binlog = LogWriter(Binfilename,"ab", bin_header) # open the binary log for writing, fresh unless resuming
+    atexit.register(Binlog.close) # make sure it's written out, however we exit
+if Resumed == None: # a new session starts at time zero
+    log_sample(Timex, get_temps()) # write time (sec) and temps to the log
 # --End csv log file initialization
 
+# --Show the temperatures right away, rather than waiting for the first timer pop
+show_temp()
+
+# --Start the web server, if required
+if Webserver != '':
+    host, port = Webserver.rsplit(':', 1)
+    try:
+        Liveserver = WGOTserver.LiveServer(host, int(port), series_snapshot, Metrics.text)
+        Liveserver.start()
+        if Debugprt == True:
+            print ("Serving on http://" + Webserver + "/")
+    except Exception as error: # carry on without it
+        Liveserver = None
+        print ("Can't serve on", Webserver, error)
+# --End web server
+
+# --Add the thermometer's counters to the metrics, now that the logs and web server are going
+register_metrics()
+
+# --Start the timer events, on deadlines from the start of the session
+rearm_ticker()
+Ticker = threading.Thread(target=ticker, name='ticker')
+Ticker.daemon = True # don't keep the programme alive on exit
+Ticker.start()
+
 #------------End Initialization----------------
 
 ################################################
-# ----- Main code event loops - there are two:
-# ------  One for non-menu mode and one for menu mode
+# ----- Main code event loop
+# ------  Waits for an event, then handles it and any others queued behind it
+# ------  with the handlers for the current mode, see dispatch_events
 ################################################
 while True: # loop forever, waiting for events in any mode
-
-########################################
-# ----- Handle events in non-menu mode
-########################################
-    while Menumode == False: # loops waiting for events in 'normal' mode
-        event = pygame.fastevent.wait() # wait for an event object to check
-#        if Debugprt == True: # print the event in debug mode
-#            print (pygame.time.get_ticks()/1000,Timex, event, "normal mode") # annoying debug
-
-# --Handle Quit if window is closed  - in X11 display mode only
-        if event.type == QUIT: # only works in an X11 window or shutdown
-            if Debugprt == True:
-                print ("Quit Selected")
-            Csvlog.close() # close the csv log file
-            pygame.display.quit() # clean up
-            GPIO.output(Ledgpio, GPIO.LOW) # turn off the LED
-            sys.exit() # exit this programme
-# -- End of Quit event handler            
-
-# --Handle the recording timer pop 1 event           
-        elif event.type == pygame.USEREVENT+1: # using literal here for timer pop 1
-            Do_rectimer_updates() # update variables and log
-# Show graph, if that's the mode we're in           
-            if Displayshow == Displaygraph: # show a graph, if required
-                 make_graph() # build the graph
-                 show_graph() # show the graph
-# -- End of timer pop 1 event handling
-
-# --Handle the time/temp/LED display update for timer pop event 2         
-        elif event.type == pygame.USEREVENT+2: # using literal here for timer pop 2
-            Do_ttimer_updates() # Update the time/temp display values
-            if Displayshow == Displaytemp: # if we're supposed to be showing the temp
-                show_temp() # Show the new time/temp screen
-# -- End of timer pop 2 event handling                
-
-            
-# --Handle a PiTFT button is press - driven by the gpiobut GPIO callback function thread
-        elif event.type == USEREVENT+3: # check for a PiTFT button press, literal value
-            if Debugprt == True:
-                print ("button =", event.button) # debug
-########################################
-# ----- Non-Menu Mode Button  button event tests
-########################################                
-# --Check for button 2 - Capture Hold data
-            if event.button==2: # button 2 = GPIO 22
-                if Debugprt == True:
-                    print ("Button 2 captures a Hold event")                
-# Capture Hold data            
-                Htimex = Updtimex # Capture the time in seconds
-                Hminx = Minx # capture minutes ...
-                Hsecx = Secx # and in seconds too
-                Htemp = Curtemp # Capture the current temp in Celsius
-                Htempf = c_to_f(Htemp) # Capture the temp in Farenheit
-# Update the display immediately, to show we've got it
-                if Displayshow == Displaytemp: # Update the display, if showing temps
-                    show_temp() # show the temperatures again
-# --End of Button 2 - Hold handling                   
-
-# --Check for button 3 - Restart data capture      
-            elif event.button==3: # restart/reset data capture
-                if Debugprt == True:
-                    print ("Button 3 resets the time, temperature and graph")
-# Initialize variables all over again and show temperatures to start
-                Timex=0 # total time since execution started in seconds
-                Minx=0 # total time since execution started in minutes
-                Secx=0 # leftover seconds for Minx:Secx display
-                Updtimex = 0 # Total time since execution started, for temp display
-                Curtemp=get_temp() # get new current temperature
-                Timelist=[Timex/60.0] # dummy list for make_graph
-                Templist=[c_to_f(Curtemp)] # dummy list for make_graph
-                Displayshow=Displaytemp # default to show temperature again
-                Htemp = Curtemp # restart hold data too
-                Htempf = c_to_f(Curtemp) # get this in Farenheit
-                Htimex = 0 # init hold time
-                Hminx = 0 # init hold time min
-                Hsecx = 0 # init hold time sec
-                Csvlog.write("00,00,00\n") # write zeros line to record a restart
-                Csvlog.write("{0},{1},{2}\n".format(str(int(Timex)),str(Curtemp),str(c_to_f(Curtemp)))) # write time (sec) and temp (F)
-                Csvlog.flush() # make sure the file is updated immediately 
-                show_temp() # show the temperature and time
-# -- End of button 3 - Restart handling                
-
-# --Check for button 4 --- switch to Menu mode
-            elif event.button==4: # check for button 4
-                if Debugprt == True:
-                    print ("Button 4 switches to Menu mode")
-                Menumode = True # Turn on Menu Mode for future events
-                Mmenuline = 1 # start main menu with line 1 highlighted
-# Note: Menunow is just a reference to a menu and not the contents of the menu itself
-# This makes for easy, efficient checks for the current menu
-                Menunow = main_menu # set the current menu, for the record
-                show_text_menu(main_menu,Mmenuline,button_menu2) # Show the main menu, 1st line highlighted            
-# -- End of button 4 - Select Menu Mode
-
-# --Handle touchscreen events in non-menu mode ------
-# Switches display show type (graph or temp) if the screen is clicked/touched
-#   because it frees up a GPIO button for other uses 
-        elif event.type == pygame.MOUSEBUTTONDOWN: # check for mouse click/touch
-# -Cleanup for noisy MOUSEBUTTON events on PiTFT, which causes problems
-# Note: Mouse position info for the touchscreen is currently useless on Stretch.
-# SDL TSLIB support used to do this stuff
-                if event.button == 1: # only watch for button 1 - touch screen filter #1
-                    mousetime = pygame.time.get_ticks()/1000 # get the relative time in sec
-# Ignore too many MOUSEDOWN events together - touch screen filter #2
-                    if mousetime - Mousetimer > Mousewait: # check if enough time has passed
-                        Mousetimer = mousetime # if so, record this last touch/click   
-                        show_flip() #switch between temp and latest graph display
-                        if Debugprt == True:
-                            if Displayshow == Displaygraph:
-                                displayshow = 'Graph'
-                            else: displayshow = 'Temperature'
-                        print ("Touch to flip display selected. Now", displayshow)
-# --End touchscreen event handler                   
-
-# --Handle Keyboard events in non menu mode ------
-        elif event.type==pygame.KEYDOWN: # Replicate PiTFT buttons on keyboard for testing
-                if Debugprt == True:
-                    print ("Key Pressed ", event.unicode)
-# Turn keys into button events                    
-                if event.unicode == "h": # "h" key will replicate button 2 - Hold
-                    fastevent.post(pygame.event.Event(pygame.USEREVENT+3, button=2))
-                elif event.unicode == "r": # "r" key will replicate button 3 - restart
-                    fastevent.post(pygame.event.Event(pygame.USEREVENT+3, button=3))
-                elif event.unicode == "m": # "m" key will replicate buttton 4, menu mode
-                    fastevent.post(pygame.event.Event(pygame.USEREVENT+3, button=4)) 
-# emergency exit key is "x" 
-                elif event.unicode == "x": # x key will exit the programme                                        
-                    if Debugprt == True:
-                        print ("Keyboard Exit Selected")
-                    Csvlog.close() # close the log file
-                    GPIO.output(Ledgpio, GPIO.LOW) # turn off the LED
-                    pygame.display.quit() #clean up Pygame
-                    sys.exit()
-# ---- end of non-menu keyboard event handler
-
-#--------End of normal (non-menu) mode event handler
-
-#############################################
-# ----- Menu Mode Event handler 
-#############################################
-    while Menumode == True: # loop forever, waiting for events in 'menu' mode
-        event = pygame.fastevent.wait() # wait for an event object to check
-#        if Debugprt == True: # print the event in debug mode
-#            print (pygame.time.get_ticks()/1000,Timex, event, "Menu mode") # annoying debug
-            
-# --Handle Quit if window is closed - X11 display mode only
-        if event.type == QUIT: # only works in an X11 window
-            Csvlog.close() # close the csv log file
-            GPIO.output(Ledgpio, GPIO.LOW) # turn off the LED
-            pygame.display.quit() # clean up
-            sys.exit() # exit this programme
-# -- End of Quit handler
-
-# --Handle the timer pop 1 event in Menu mode, to keep recording data up to date         
-        elif event.type == pygame.USEREVENT+1: # using literal here for timer pop
-            Do_rectimer_updates() # update record variables and log
-# -- End of Timer pop 1 event handler in menu mode            
-
-# --Handle the time/temp/LED display update timer pop event 2 in menu mode          
-        elif event.type == pygame.USEREVENT+2: # using literal here for timer pop
-            Do_ttimer_updates() # Update the LED & time/temp display values
-# --End of time pop 2 event handler in menu mode            
-
-# --Handle PiTFT button presses in menu mode driven by gpiobut GPIO callback function thread
-        elif event.type == USEREVENT+3: # check for a PiTFT button press, literal value
-            if Debugprt == True:
-                print ("menu button =", event.button) # debug
-
-########################################
-# ---- Menu Mode Button event testing
-########################################                
-# --Check for button 2 - Menu mode - Up
-            if event.button==2: # button 2 = GPIO 22
-                if Debugprt == True:
-                    print ("Button 2 is Up")
-# -Handle Up on the main menu
-                if Menunow == main_menu: # Check if we're on the main menu
-                    if Mmenuline == 1: # if we're at the top
-                        Mmenuline = Mmenumax # roll to the bottom line
-                    else:
-                        Mmenuline = Mmenuline-1 # otherwise, just go up a line
-                    show_text_menu(main_menu,Mmenuline,button_menu2) # show the new highlighted menu line
-# -End of Up for the main menu
-
-# -Handle Up in the Temperature Adjustment menu
-# Note: the following is a reference comparison and not a content comparison
-# i.e. Even if the contents of the tempadj_menu have changed it can be True
-                elif Menunow == tempadj_menu: # check if we're in the temp adjust menu
-                    if Ttempadj <10: # upper limit is 10 for now
-                        Ttempadj = round(Decimal(Ttempadj) + Decimal(0.1),1) # increment Temperature adjustment
-                    tempadj_menu[2][4] = str(Ttempadj) #show current temperature adjustment
-                    show_text_menu(tempadj_menu,2,button_menu2) # show updated menu
-# -End of Up in the Temperature Adjustment menu                    
-
-# -Handle Up in the Time Adjustment menu
-                elif Menunow == timeadj_menu and Ttimeval < len(Timevals)-1: # chk if we're in the time adjust menu
-                    Ttimeval = Ttimeval + 1 # move to the next highest value
-                    timeadj_menu[2][4] = str(Timevals[Ttimeval]) #show current time adjustment
-                    show_text_menu(timeadj_menu,2,button_menu2) # show new menu                    Timeval = Timeval - 1 #go up one item if not at the start value
-# -End of Up in the Time Adjustment  menu
-
-# --Check for button 3 --- Down - in menu mode     
-            elif event.button==3: # Check for Down
-                if Debugprt == True:
-                    print ("Button 3 is Down")
-# -Handle Down on main menu                    
-                if Menunow == main_menu: # Check if we're on the main menu
-                    if Mmenuline == Mmenumax: # if we're at the bottom
-                        Mmenuline = 1 # roll to the top line (line 0 is the title)
-                    else:
-                        Mmenuline = Mmenuline+1 # Otherwise just go to the next line
-                    show_text_menu(main_menu,Mmenuline,button_menu2) # show the new highlighted menu line                    
-# -End Down handler for the main menu
-
-# -Handle Down on the Temperature Adjustment menu - in decimal
-                elif Menunow == tempadj_menu: # Check if we're on the temp adjust menu
-                    if Ttempadj > -10.0: # lower limit is -10 for now
-                        Ttempadj = round(Decimal(Ttempadj) - Decimal(0.1),1) # increment Temperature adjustment                       
-                    tempadj_menu[2][4] = str(Ttempadj) #show current temperature adjustment
-                    show_text_menu(tempadj_menu,2,button_menu2) # show new menu 
-# -End of Down on the Temperature Adjustment menu
-
-# -Handle Down in Time adjustment menu
-                elif Menunow == timeadj_menu and Ttimeval > 0: # chk if we're in the time adjust menu
-                    Ttimeval = Ttimeval - 1 # go down one item if not at the first value
-                    timeadj_menu[2][4] = str(Timevals[Ttimeval]) #show current time adjustment
-                    show_text_menu(timeadj_menu,2,button_menu2) # show updated menu 
-# -End of Down in the Time Adjustment menu
-
-# --Check for button 4 --- Select, in menu mode
-            elif event.button==4:
-                if Debugprt == True:
-                    print ("Button 4 is Select")
-
-########################################
-# ---- Handle Select on the main menu
-########################################
-                if Menunow == main_menu: # check if we're on the main menu
-                  
-# -Handle 'Exit' selected from main menu  - always first, for debugging              
-                    if Mmenuline == 4: # check for line 4 select - Exit programme
-                        if Debugprt == True:
-                            print ("Exit Selected")
-                        Csvlog.close() # close the csv log file
-                        GPIO.output(Ledgpio, GPIO.LOW) # turn off the LED
-                        pygame.display.quit() # clean up
-                        sys.exit() # exit this programme
-
-# -Handle Temp Adjust selected from main menu menu                       
-                    elif Mmenuline == 1: # Check for Temp Adj
-                        if Debugprt == True:
-                            print ("Selected Temp Adj menu")
-                        Menunow = tempadj_menu # update what menu we're in now
-                        Ttempadj = Tempadj # Get the current adjustment for the menu
-                        tempadj_menu[2][4] = str(Ttempadj) #show current temperature adjustment
-                        show_text_menu(tempadj_menu,2,button_menu2) # show new menu
-
-# -Handle Time Adjust selected from main menu                       
-                    elif Mmenuline == 2: # Check for Time Adj
-                        if Debugprt == True:
-                            print ("Selected Time Adj menu")
-                        Menunow = timeadj_menu # update what menu we're in now
-                        Ttimeval = Timeval # Set a temporary index for menu purposes
-                        timeadj_menu[2][4] = str(Timevals[Ttimeval]) #show current time adjustment
-                        show_text_menu(timeadj_menu,2,button_menu2) # show new menu
-
-# -Handle 'Return' selected from main menu                    
-                    elif Mmenuline == 3: # check for Return selected
-                        if Debugprt == True:
-                            print ("Return Selected")
-# Show updated display now, as appropriate to the mode we were in before menu mode
-                        if Displayshow==Displaytemp: # if we were showing the temperature
-                            show_temp() # show current temperature
-# Show graph, if that's the mode we were in           
-                        elif Displayshow == Displaygraph: # show a graph, if required
-                            make_graph()
-                            show_graph()
-                        Menumode = False # Turn off menu mode for now, as if 'Return' was selected       
-########################################
-# ---- Handle Select in secondary menus
-########################################
-
-# -Handle Select in Temperature Adjustment menu
-                elif Menunow == tempadj_menu: # check if we're on the temp adjust menu
-                    Tempadj = float(Ttempadj) # Put the new adjustment value into effect
-# Note: it might be good to also reset values, but there might be a need not to do this                    
-                    Menunow = main_menu # Update current menu to main_menu
-                    show_text_menu(main_menu,Mmenuline,button_menu2) # show it
-                    if Debugprt == True:
-                        print ("Temp Adjust Value Selected =",Tempadj)
-# -End Select in Temperature Adjustment menu
-
-# -Handle Select in Time Adjustment menu
-                elif Menunow == timeadj_menu: #check if we're in the time adj menu
-                    Tinterval = Timevals[Ttimeval] # set the new timer interval in msec
-# Define an updated pygame user event for the new recording timer value
-                    pygame.time.set_timer(USEREVENT+1, Tinterval*1000) # create a timer event
-                    Menunow = main_menu # Update current menu to the main_menu
-                    show_text_menu(main_menu,Mmenuline,button_menu2) # show it
-                    if Debugprt == True:
-                        print ("Time Adjust Selected =",Tinterval)
-# -End Select in Time Adjustment menu                
-
-# --End of button handler in menu mode
-
-########################################
-# ---- Handle Keyboard events in Menu mode
-########################################
-        elif event.type==pygame.KEYDOWN: # Replicate PiTFT buttons on keyboard for testing
-            if Debugprt == True:
-                print ("Menu mode Key Pressed ", event.unicode)
-# --Simulate PiTFT buttons from keyboard - as if they were GPIO events                
-            if event.unicode == "u": # "u" key will replicate button 2 - Up
-                fastevent.post(pygame.event.Event(pygame.USEREVENT+3, button=2))
-            elif event.unicode == "d": # "d" key will replicate button 3 - Down
-                fastevent.post(pygame.event.Event(pygame.USEREVENT+3, button=3))
-            elif event.unicode == "s": # "s" key will replicate button 4 - Select
-                fastevent.post(pygame.event.Event(pygame.USEREVENT+3, button=4))
-            elif event.unicode == "x": # x key will exit the programme
-                if Debugprt == True:
-                    print ("Menu Mode Keyboard Exit Selected")
-                Csvlog.close() # close the log file
-                GPIO.output(Ledgpio, GPIO.LOW) # turn off the LED
-                pygame.display.quit() # clean up Pygame
-                sys.exit()
-# --End of menu mode keyboard event handler
-            
-# ---------End  of Menu mode event loop -------
-
-# ---------End of all event loops --------
+    Watchdog.beat('eventloop') # the display timer pops every second, so this beats at least that often
+    events = [fastevent.wait()] # wait for an event object to check
+    events.extend(fastevent.get()) # and take any others waiting, to handle together
+#    if Debugprt == True: # print the events in debug mode
+#        print (pygame.time.get_ticks()/1000,Timex, events, Menumode) # annoying debug
+    dispatch_events(events) # handle them for the mode we're in
+# ---------End of event loop --------
 
 if Debugprt == True:
     print ("Fell through the bottom of the code") # Debug - should not happen, eh
-Csvlog.close() # close the log file
-GPIO.output(Ledgpio, GPIO.LOW) # turn off the LED
-pygame.display.quit() # clean up and revert to X11 on main display, if available
+exit_programme() # close the log, turn off the LED and exit
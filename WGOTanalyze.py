@@ -0,0 +1,349 @@
+#!/usr/bin/python3
+# Copyright (c) 2019 R.S. Fowler
+# Author: R.S. Fowler for WG Oven Thermometer project
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Offline analysis of WGOT csv logs, instead of post-processing them by hand
+#
+# Each log, or saved generation of one, is read a chunk at a time by
+#  WGOTlog.csv_sessions and split into sessions at the restart lines, so only
+#  one session's arrays are in memory at a time. A session that carries on
+#  into the next log, e.g. after the log got too big and a new one was started,
+#  or after a Resume, is joined up with it. Lines that can't be read, e.g. a
+#  partial or corrupt line from a power cut, are left out. Each probe of each
+#  session is put on an even grid of times, interpolating over gaps and
+#  faults, then measured with NumPy:
+# - ramp: the average heating rate from 10% to 90% of the way to the target,
+#   and the fastest rate over any 'window' seconds, in degrees/min
+# - reach: the minutes until the temperature is within 'band' of the target
+# - overshoot: how far above the target it went after reaching it
+# - steady: the mean and standard deviation from 'settle' seconds after
+#   reaching the target to the end, leaving out the door openings
+# - doors: drops of more than 'door' degrees below the steady temperature,
+#   and the minutes from the start of each drop until it's back within 'band'
+# The target is the given temperature, or the median of the last quarter of
+#  the session, i.e. where it settled. Temperatures are converted with the
+#  thermometer's own c_to_f, and can be filtered with the same WGOTfilter
+#  filters as its graph, so the results match what it showed.
+#
+# A summary table is printed, and can be saved as csv. A chart of each session
+#  can be saved too, drawn like the thermometer's matplotlib graph, with the
+#  target and the door openings marked. The charts are named after the log,
+#  e.g. WGOTdata.csv_session1.png, with the log's place on the command line in
+#  front if logs in different folders have the same name.
+#
+# The following command analyses a log and its saved generations, for an oven
+#  set to 350 F, and saves a chart of each session.
+#
+# python3 WGOTanalyze.py --generations --target=350 --charts=/tmp/charts /home/pi/WGOTdata.csv
+
+import os # used to name the charts
+import sys # used to exit and to get command line arguments
+import getopt # used to parse command line arguments
+import time # used to time the analysis
+import numpy as np # np is a shorthand name
+import WGOTlog # reads the logs, with the thermometer's own parsing and c_to_f
+import WGOTfilter # the thermometer's graph filters
+from WGOTlog import c_to_f # Celsius to Fahrenheit, the same as the thermometer uses
+
+COLOURS = [(255, 0, 0), (0, 255, 0), (255, 160, 0), (255, 0, 255), (0, 255, 255), (255, 255, 255)] # as Probecolours
+COLUMNS = [('file', '%-20s', '%-20.20s'), ('session', '%7s', '%7d'), ('probe', '%5s', '%5d'),
+           ('rows', '%8s', '%8d'), ('minutes', '%8s', '%8.1f'), ('start', '%7s', '%7.1f'),
+           ('peak', '%7s', '%7.1f'), ('target', '%7s', '%7.1f'), ('ramp', '%6s', '%6.2f'),
+           ('maxramp', '%7s', '%7.2f'), ('reach', '%7s', '%7.1f'), ('overshoot', '%9s', '%9.1f'),
+           ('mean', '%7s', '%7.1f'), ('std', '%6s', '%6.2f'), ('doors', '%5s', '%5d'),
+           ('recovery', '%8s', '%8.1f'), ('worst', '%7s', '%7.1f')] # name, heading and value formats for the table
+
+########################################
+#----- Function Definitions
+########################################
+
+# --Define a function to read the sessions of several logs in order, joining any that carry on
+# Note: a session carries on into the next log if that log's first session
+#  doesn't start at time zero, or after the end of the last one, since a new
+#  recording always starts at zero. Only the last session of a log is held
+#  back to check this, so memory use stays at about one session.
+# Yields the name of the log the session started in, its number in that log,
+#  the times (sec) and temperatures (C) with a column for each probe
+def log_sessions(filenames, chunk):
+    held = None # the last session so far, which may carry on into the next log
+    for filename in filenames:
+        number = 0 # sessions started in this log
+        for times, tempc in WGOTlog.csv_sessions(filename, chunk):
+            if (number == 0 and held != None and times[0] > 0 and times[0] >= held[2][-1]
+                    and tempc.shape[1] == held[3].shape[1]): # it carries on from the last log
+                held = (held[0], held[1], np.concatenate((held[2], times)), np.concatenate((held[3], tempc)))
+                number = -1 # not a session of its own, but the next one is
+                continue
+            if held != None:
+                yield held
+            number = max(number, 0) + 1
+            held = (filename, number, times, tempc)
+    if held != None:
+        yield held
+# --End log_sessions function
+
+# --Define a function to put a probe's temperatures on an even grid of times
+# Note: gaps and NaN values from faults are filled by interpolating between
+#  the good readings either side, which is how the thermometer's graph joins them
+# Returns the grid times and values, or None if there are no good readings
+def resample(times, values, step):
+    valid = ~np.isnan(values)
+    if valid.sum() < 2:
+        return None
+    grid = np.arange(times[valid][0], times[valid][-1] + step / 2.0, step)
+    return grid, np.interp(grid, times[valid], values[valid])
+# --End resample function
+
+# --Define a function to find the first index where a condition is true
+# Returns the index, or None if it's never true
+def first_true(condition):
+    if len(condition) == 0:
+        return None
+    index = int(np.argmax(condition))
+    if condition[index] == False:
+        return None
+    return index
+# --End first_true function
+
+# --Define a function to find the door openings in the steady part of a session
+# Note: a door opening is a drop of more than 'door' below the steady median.
+#  It starts at the last time the temperature was within 'band' of the median
+#  before the drop, and ends at the first time it's back within 'band'. Drops
+#  between the same start and end are one door opening.
+# Returns the start and end indexes of each one, with len(values) for an end
+#  if it never recovered
+def find_doors(values, median, door, band):
+    count = len(values)
+    index = np.arange(count)
+    low = values < median - door
+    ok = values >= median - band
+    lastok = np.maximum.accumulate(np.where(ok, index, 0)) # the latest ok index at or before each index
+    nextok = np.minimum.accumulate(np.where(ok, index, count)[::-1])[::-1] # the next ok index at or after each
+    runstarts = np.flatnonzero(low & ~np.concatenate(([False], low[:-1])))
+    runends = np.flatnonzero(low & ~np.concatenate((low[1:], [False])))
+    starts, unique = np.unique(lastok[runstarts], return_index=True)
+    return starts, nextok[runends][unique]
+# --End find_doors function
+
+# --Define a function to measure a probe's session
+# Note: see the notes at the top for what each measure is. Times are in
+#  minutes, rates in degrees/min, and any that can't be measured are NaN,
+#  e.g. the overshoot of a session that never reached the target.
+# Returns a dictionary of the measures, and the door openings as (start, end) minutes
+def analyse(times, values, target=None, band=5.0, window=60.0, settle=300.0, door=15.0, step=None):
+    nan = float('nan')
+    result = {'rows': len(times), 'minutes': 0.0, 'start': nan, 'peak': nan, 'target': nan, 'ramp': nan,
+              'maxramp': nan, 'reach': nan, 'overshoot': nan, 'mean': nan, 'std': nan, 'doors': 0,
+              'recovery': nan, 'worst': nan}
+    if step == None: # the gap between the closest samples, e.g. on an adaptive log's ramp, but fine enough for the ramp window
+        step = min(float(np.percentile(np.diff(times), 10)) if len(times) > 1 else 1.0, window / 10.0)
+    step = max(step, 1e-3)
+    grid = resample(times, values, step)
+    if grid == None:
+        return result, []
+    grid, values = grid
+    result['minutes'] = (grid[-1] - grid[0]) / 60.0
+    result['start'] = start = values[0]
+    result['peak'] = values.max()
+    if target == None: # where it settled
+        target = float(np.median(values[len(values) * 3 // 4:]))
+    result['target'] = target
+    rise = target - start
+    span = max(int(round(window / step)), 1) # grid points in the ramp window
+    if len(values) > span:
+        result['maxramp'] = ((values[span:] - values[:-span]) / (span * step) * 60.0).max()
+    if rise > band: # it heated up, so there's a ramp to measure
+        low, high = first_true(values >= start + 0.1 * rise), first_true(values >= start + 0.9 * rise)
+        if low != None and high != None and high > low:
+            result['ramp'] = 0.8 * rise / (grid[high] - grid[low]) * 60.0
+    reached = first_true(values >= target - band)
+    if reached == None:
+        return result, []
+    result['reach'] = (grid[reached] - grid[0]) / 60.0
+    result['overshoot'] = max(values[reached:].max() - target, 0.0)
+    steady = first_true(grid >= grid[reached] + settle)
+    if steady == None: # not long enough to settle
+        return result, []
+    values, grid = values[steady:], grid[steady:]
+    starts, ends = find_doors(values, float(np.median(values)), door, band)
+    opened = np.zeros(len(values) + 1, dtype=int) # +1 at each start and -1 at each end, so the sum is >0 while open
+    np.add.at(opened, starts, 1)
+    np.add.at(opened, ends, -1)
+    closed = np.cumsum(opened)[:-1] == 0
+    if closed.any():
+        result['mean'] = values[closed].mean()
+        result['std'] = values[closed].std()
+    result['doors'] = len(starts)
+    recovered = ends < len(values)
+    if recovered.any():
+        recovery = (grid[ends[recovered]] - grid[starts[recovered]]) / 60.0
+        result['recovery'] = recovery.mean()
+        result['worst'] = recovery.max()
+    doors = [(grid[start] / 60.0, grid[min(end, len(grid) - 1)] / 60.0) for start, end in zip(starts, ends)]
+    return result, doors
+# --End analyse function
+
+# --Define a function to keep the lowest and highest rows of each bucket of rows, for a chart
+# Note: the same idea as the thermometer's graph buckets, so a chart of
+#  millions of rows is quick to draw but doesn't lose any spikes
+def envelope(times, values, points):
+    buckets = len(times) // max(points // 2, 1)
+    if buckets < 2:
+        return times, values
+    rows = len(times) // buckets * buckets # whole buckets only, plus the last row
+    lows = np.nanmin(values[:rows].reshape(-1, buckets, values.shape[1]), axis=1)
+    highs = np.nanmax(values[:rows].reshape(-1, buckets, values.shape[1]), axis=1)
+    middles = times[:rows].reshape(-1, buckets).mean(axis=1)
+    return (np.concatenate((np.repeat(middles, 2), times[-1:])),
+            np.concatenate((np.stack((lows, highs), axis=1).reshape(-1, values.shape[1]), values[-1:])))
+# --End envelope function
+
+# --Define a function to print the summary table, and save it as csv if a name is given
+def summary_table(rows, csvname=''):
+    print (" ".join([heading % name for name, heading, value in COLUMNS]))
+    for row in rows:
+        print (" ".join([value % row[name][-20:] if name == 'file' # the end of the path, with the log's name
+                         else value % row[name] if row[name] == row[name] else heading % '-'
+                         for name, heading, value in COLUMNS]))
+    if csvname != '':
+        with open(csvname, 'w') as csvfile:
+            csvfile.write(",".join([name for name, heading, value in COLUMNS]) + "\n")
+            for row in rows:
+                csvfile.write(",".join([str(row[name]) if name == 'file' else '' if row[name] != row[name]
+                                        else ('%d' if value.endswith('d') else '%.4f') % row[name] # full detail
+                                        for name, heading, value in COLUMNS]) + "\n")
+# --End summary_table function
+
+# --Define a function to analyse the logs, print the table, and save the charts
+def main(filenames, probe, units, filters, options, tablename, chartdir, chunk):
+    starttime = time.time()
+    rows = []
+    renderer = None # the chart renderer, reused for every chart
+    basenames = [os.path.basename(filename) for filename in filenames]
+    chartnames = {} # the name for each log's charts, numbered if logs in different folders have the same name
+    for index, filename in enumerate(filenames):
+        chartnames[filename] = (basenames[index] if basenames.count(basenames[index]) == 1
+                                else "%d_%s" % (index + 1, basenames[index]))
+    for filename, number, times, tempc in log_sessions(filenames, chunk):
+        if filters != '': # the same as the thermometer's graph would show
+            tempc = WGOTfilter.FilterPipeline(filters, tempc.shape[1]).batch(tempc)
+        temps = c_to_f(tempc) if units == 'F' else tempc
+        probes = range(temps.shape[1]) if probe == None else [probe]
+        target = None # the first probe's, for the chart
+        alldoors = []
+        for column in probes:
+            if column >= temps.shape[1]:
+                continue
+            result, doors = analyse(times, temps[:, column], **options)
+            result.update({'file': filename, 'session': number, 'probe': column})
+            rows.append(result)
+            if target == None:
+                target = result['target']
+            alldoors.extend(doors)
+        if chartdir != '':
+            if renderer == None: # one persistent figure for all of the charts, like the thermometer's
+                import WGOTrender # only needed for charts
+                renderer = WGOTrender.GraphRenderer((960, 720), 100.0, temps.shape[1])
+                renderer.build()
+                renderer.axes.set_ylabel('Temp (' + units + ')')
+            chart(renderer, os.path.join(chartdir, "%s_session%d.png" % (chartnames[filename], number)),
+                  times, temps, target, alldoors,
+                  "%s session %d" % (filename, number))
+    summary_table(rows, tablename)
+    print ("%d sessions analysed in %.2f sec" % (len(set((row['file'], row['session']) for row in rows)),
+                                                time.time() - starttime))
+# --End main function
+
+# --Define a function to save a chart of a session
+# Note: the target and door openings are added to the renderer's axes for this
+#  chart only, then removed, so the next chart starts from the same figure
+def chart(renderer, filename, times, temps, target, doors, title):
+    if temps.shape[1] != len(renderer.lines): # a different number of probes, so a new set of lines
+        for line in renderer.lines:
+            line.remove()
+        renderer.probes = temps.shape[1]
+        renderer.lines = [renderer.axes.plot([], [])[0] for column in range(temps.shape[1])]
+    times, temps = envelope(times, temps, 2000)
+    extras = []
+    if target != None and target == target:
+        extras.append(renderer.axes.axhline(target, color='grey', linestyle='--'))
+    for start, end in doors:
+        extras.append(renderer.axes.axvspan(start, end, color='blue', alpha=0.15))
+    renderer.axes.set_title(title)
+    renderer.render(times / 60.0, temps, COLOURS * (1 + temps.shape[1] // len(COLOURS)), filename, frame=False)
+    for extra in extras:
+        extra.remove()
+# --End chart function
+
+########################################
+# ----- Analyse the logs from the command line
+########################################
+if __name__ == '__main__':
+    usage = ("Usage: python3 WGOTanalyze.py [--generations] [--probe=N] [--celsius] [--filters=spec]\n"
+             "        [--target=T] [--band=T] [--window=sec] [--settle=sec] [--door=T] [--step=sec]\n"
+             "        [--table=csvfile] [--charts=dir] [--chunk=bytes] csvfile ...")
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'h', ['help', 'generations', 'probe=', 'celsius', 'filters=',
+            'target=', 'band=', 'window=', 'settle=', 'door=', 'step=', 'table=', 'charts=', 'chunk='])
+    except getopt.GetoptError as error:
+        print (error)
+        print (usage)
+        sys.exit(2)
+    generations = False
+    probe = None # all of them
+    units = 'F'
+    filters = ''
+    options = {} # for analyse, in the chosen units
+    tablename = ''
+    chartdir = ''
+    chunk = 4194304
+    if len(args) == 0:
+        print (usage)
+        sys.exit(2)
+    for opt, value in opts:
+        if opt in ('-h', '--help'):
+            print (usage)
+            sys.exit()
+        elif opt == '--generations':
+            generations = True
+        elif opt == '--probe':
+            probe = int(value)
+        elif opt == '--celsius':
+            units = 'C'
+        elif opt == '--filters':
+            filters = value
+        elif opt in ('--target', '--band', '--window', '--settle', '--door', '--step'):
+            options[opt[2:]] = float(value)
+        elif opt == '--table':
+            tablename = value
+        elif opt == '--charts':
+            chartdir = value
+        elif opt == '--chunk':
+            chunk = int(value)
+    filenames = []
+    for name in args: # oldest first, if the saved generations are wanted
+        filenames.extend(WGOTlog.log_generations(name) if generations == True else [name])
+    if len(filenames) == 0:
+        print ("No logs found")
+        sys.exit(1)
+    if chartdir != '' and not os.path.isdir(chartdir):
+        os.makedirs(chartdir)
+    main(filenames, probe, units, filters, options, tablename, chartdir, chunk)
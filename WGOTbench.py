@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+# Copyright (c) 2019 R.S. Fowler
+# Author: R.S. Fowler for WG Oven Thermometer project
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Micro-benchmark for the WGOTprobe SPI backends, without the MAX31855 boards
+#
+# MockGPIO stands in for RPi.GPIO with MAX31855 boards attached: a board
+#  shifts its word out on DO, bit by bit, while its CS line is low.
+# MockSpidev stands in for the spidev module on the same boards, handing back
+#  the selected board's word in one go, like the kernel driver does.
+# Each backend reads the boards over and over, and the reads/sec and the CPU
+#  time per read are reported. The mocks' own time is included, so the numbers
+#  are best compared with each other, or between machines, e.g. a dev box and a Pi.
+#
+# The following command will benchmark both backends with 4 probes.
+#
+# python3 WGOTbench.py --probes=4
+
+import sys # used to exit and to get command line arguments
+import getopt # used to parse command line arguments
+import time # used to time the reads
+import WGOTprobe # the backends being measured
+
+########################################
+#----- Class Definitions
+########################################
+
+# --Define a class to stand in for RPi.GPIO, with MAX31855 boards on the pins
+# Note: only the calls the backends use are here
+class MockGPIO(object):
+    BCM = 11
+    IN = 1
+    OUT = 0
+    HIGH = 1
+    LOW = 0
+
+    def __init__(self, do, boards):
+        self.do = do
+        self.boards = boards # the word each board gives, by CS pin
+        self.selected = None # the CS pin that's low, if any
+        self.bit = 31 # the bit the selected board is showing on DO
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, channel, direction, pull_up_down=None):
+        pass
+
+    def output(self, channel, level):
+        if channel in self.boards: # a chip select
+            if level == self.LOW: # the board starts again at its top bit
+                self.selected = channel
+                self.bit = 31
+            elif self.selected == channel:
+                self.selected = None
+        elif level == self.LOW and self.selected != None: # CLK falling, so on to the next bit
+            self.bit = self.bit - 1
+
+    def input(self, channel):
+        if channel != self.do or self.selected == None: # pulled up when no board is selected
+            return 1
+        return (self.boards[self.selected] >> self.bit) & 1
+# --End MockGPIO class
+
+# --Define a class to stand in for the spidev module, on the same boards as a MockGPIO
+class MockSpidev(object):
+    def __init__(self, gpio):
+        self.gpio = gpio
+
+    def SpiDev(self): # a new device, like spidev.SpiDev()
+        return MockSpiDevice(self.gpio)
+# --End MockSpidev class
+
+# --Define a class to stand in for a spidev.SpiDev device
+class MockSpiDevice(object):
+    def __init__(self, gpio):
+        self.gpio = gpio
+        self.max_speed_hz = 500000
+        self.mode = 0
+        self.no_cs = False
+
+    def open(self, port, device):
+        pass
+
+    def close(self):
+        pass
+
+    def readbytes(self, length): # the selected board's word, most significant byte first
+        if self.gpio.selected == None:
+            return [0xFF] * length
+        word = self.gpio.boards[self.gpio.selected]
+        return [(word >> (8 * (length - 1 - index))) & 0xFF for index in range(length)]
+# --End MockSpiDevice class
+
+########################################
+#----- Function Definitions
+########################################
+
+# --Define a function to time a backend
+# Returns the reads/sec and the CPU time per read in seconds
+def bench(bus, reads):
+    bus.read() # warm up
+    walltime = time.perf_counter()
+    cputime = time.process_time()
+    for count in range(reads):
+        bus.read()
+    cputime = time.process_time() - cputime
+    walltime = time.perf_counter() - walltime
+    return reads / walltime, cputime / reads
+# --End bench function
+
+# --Define a function to benchmark the backends and print a table of results
+def main(backends, probes, reads):
+    clk, do = 5, 16 # the original wiring, the mocks don't mind
+    cslist = [6, 13, 19, 26, 12, 20, 24, 25][:probes] # some free GPIO pins for chip selects
+    while len(cslist) < probes: # more probes than that, any numbers will do for the mocks
+        cslist.append(100 + len(cslist))
+    boards = {} # a different temperature and fault state for each board
+    for probe, cs in enumerate(cslist):
+        boards[cs] = WGOTprobe.encode_word(20.0 + 37.25 * probe, 25.0 + probe / 16.0, (probe == 3) * 1)
+    gpio = MockGPIO(do, boards)
+    print ("%-8s %6s %12s %14s %14s" % ('backend', 'probes', 'reads/sec', 'CPU us/read', 'CPU us/probe'))
+    for backend in backends:
+        if backend == 'bitbang':
+            bus = WGOTprobe.BitBangBus(clk, do, cslist, gpio)
+        else:
+            bus = WGOTprobe.SpidevBus(0, 0, cslist, gpio, spidevmodule=MockSpidev(gpio))
+        if bus.read_words() != [boards[cs] for cs in cslist]: # make sure it reads what the boards say
+            print (backend, "read the wrong values")
+            sys.exit(1)
+        rate, cpu = bench(bus, reads)
+        print ("%-8s %6d %12.0f %14.1f %14.1f" % (backend, probes, rate, cpu * 1e6, cpu * 1e6 / probes))
+        bus.close()
+# --End main function
+
+########################################
+# ----- Run the benchmark from the command line
+########################################
+if __name__ == '__main__':
+    usage = "Usage: python3 WGOTbench.py [--backend=bitbang|spidev|all] [--probes=N] [--reads=N]"
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'h', ['help', 'backend=', 'probes=', 'reads='])
+    except getopt.GetoptError as error:
+        print (error)
+        print (usage)
+        sys.exit(2)
+    backends = ['bitbang', 'spidev']
+    probes = 1
+    reads = 2000
+    if len(args) > 0:
+        print (usage)
+        sys.exit(2)
+    for opt, value in opts:
+        if opt in ('-h', '--help'):
+            print (usage)
+            sys.exit()
+        elif opt == '--backend':
+            if value != 'all':
+                backends = [value]
+        elif opt == '--probes':
+            probes = int(value)
+        elif opt == '--reads':
+            reads = int(value)
+    main(backends, probes, reads)
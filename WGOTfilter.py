@@ -0,0 +1,330 @@
+#!/usr/bin/python3
+# Copyright (c) 2019 R.S. Fowler
+# Author: R.S. Fowler for WG Oven Thermometer project
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Temperature filters for the WGOT thermometer and offline tools
+#
+# Each filter takes one sample at a time with update(), at a cost of O(1) or
+#  O(log window) per sample, and gives the filtered value. Each also has a
+#  batch() that gives the same results for a whole array at once, with NumPy,
+#  e.g. for a log that's already recorded.
+# - RunningMedian is the median of the last 'window' samples, kept with two heaps
+# - Ema is an exponential moving average, with weight 'alpha' for each new sample
+# - Hampel replaces outliers with the running median. A sample is an outlier if
+#   it's more than 'nsigma' standard deviations from the median, estimated from
+#   the running median of the samples' deviations from the median (the MAD).
+# - Kalman is a one dimensional Kalman filter for a slowly changing temperature,
+#   with process noise 'q' and measurement noise 'r' (variances in C squared)
+# NaN samples, e.g. from probe faults, aren't seen by the filters and come out
+#  as NaN, so a fault doesn't upset the filtered values after it.
+#
+# Filters are chained by FilterPipeline from a description like 'hampel:7,ema:0.3',
+#  with a separate chain for each probe.
+
+import heapq # used to keep the running median's two halves
+from collections import deque # used to remember the samples in the window
+import numpy as np # np is a shorthand name
+
+MAD_SIGMA = 1.4826 # the MAD times this estimates the standard deviation, for normal noise
+BATCH_ROWS = 65536 # samples per chunk for batch medians, to limit memory use
+
+########################################
+#----- Class Definitions
+########################################
+
+# --Define a class for the running median of the last 'window' samples
+# Note: the lower half of the window is kept in a max heap (as negative values)
+#  and the upper half in a min heap, so the median is at the top of one or both.
+#  Samples leaving the window are only removed when they reach the top of a heap
+#  (lazy deletion), so each sample costs O(log window).
+class RunningMedian(object):
+    def __init__(self, window=5):
+        self.window = max(int(window), 1)
+        self.reset()
+
+    def reset(self): # forget all of the samples
+        self.low = [] # the lower half, as negative values
+        self.high = [] # the upper half
+        self.lowsize = 0 # the number of samples in each half, not counting removed ones
+        self.highsize = 0
+        self.removed = {} # counts of removed values still in the heaps
+        self.samples = deque() # the samples in the window, oldest first
+
+    def update(self, value): # add a sample and give the new median
+        if value != value: # NaN, so skip it
+            return value
+        self.samples.append(value)
+        if len(self.low) == 0 or value <= -self.low[0]: # add it to the right half
+            heapq.heappush(self.low, -value)
+            self.lowsize = self.lowsize + 1
+        else:
+            heapq.heappush(self.high, value)
+            self.highsize = self.highsize + 1
+        self.balance()
+        if len(self.samples) > self.window: # the oldest sample leaves the window
+            self.remove(self.samples.popleft())
+        return self.median()
+
+    def median(self):
+        if self.lowsize > self.highsize: # an odd number of samples
+            return -self.low[0]
+        return (-self.low[0] + self.high[0]) / 2.0
+
+    def remove(self, value): # mark a sample as removed, taking it off the top of its heap if it's there
+        self.removed[value] = self.removed.get(value, 0) + 1
+        if value <= -self.low[0]: # it's in the lower half
+            self.lowsize = self.lowsize - 1
+            if value == -self.low[0]:
+                self.prune(self.low, -1)
+        else:
+            self.highsize = self.highsize - 1
+            if value == self.high[0]:
+                self.prune(self.high, 1)
+        self.balance()
+
+    def prune(self, heap, sign): # take removed values off the top of a heap
+        while len(heap) > 0:
+            value = heap[0] * sign
+            count = self.removed.get(value, 0)
+            if count == 0: # the top is still in the window
+                break
+            if count == 1:
+                del self.removed[value]
+            else:
+                self.removed[value] = count - 1
+            heapq.heappop(heap)
+
+    def balance(self): # keep the lower half the same size as the upper half, or one bigger
+        if self.lowsize > self.highsize + 1:
+            heapq.heappush(self.high, -heapq.heappop(self.low))
+            self.lowsize = self.lowsize - 1
+            self.highsize = self.highsize + 1
+            self.prune(self.low, -1)
+        elif self.lowsize < self.highsize:
+            heapq.heappush(self.low, -heapq.heappop(self.high))
+            self.lowsize = self.lowsize + 1
+            self.highsize = self.highsize - 1
+            self.prune(self.high, 1)
+
+    def batch(self, values): # the running median of a whole array, with no NaN values
+        return rolling_median(values, self.window)
+# --End RunningMedian class
+
+# --Define a class for an exponential moving average
+# Note: the first sample starts the average
+class Ema(object):
+    def __init__(self, alpha=0.3):
+        self.alpha = min(max(float(alpha), 0.0), 1.0)
+        self.reset()
+
+    def reset(self):
+        self.average = None
+
+    def update(self, value):
+        if value != value: # NaN, so skip it
+            return value
+        if self.average == None:
+            self.average = value
+        else:
+            self.average = self.average + self.alpha * (value - self.average)
+        return self.average
+
+    def batch(self, values): # the average of a whole array, with no NaN values
+        return ema(values, self.alpha)
+# --End Ema class
+
+# --Define a class for Hampel outlier rejection
+# Note: the MAD is the running median of each sample's deviation from the running
+#  median when it arrived, rather than recalculated for the whole window every
+#  time, which keeps it O(log window) per sample
+class Hampel(object):
+    def __init__(self, window=7, nsigma=3.0):
+        self.window = max(int(window), 1)
+        self.nsigma = float(nsigma)
+        self.medians = RunningMedian(self.window)
+        self.deviations = RunningMedian(self.window)
+
+    def reset(self):
+        self.medians.reset()
+        self.deviations.reset()
+
+    def update(self, value):
+        if value != value: # NaN, so skip it
+            return value
+        median = self.medians.update(value)
+        deviation = abs(value - median)
+        mad = self.deviations.update(deviation)
+        if deviation > self.nsigma * MAD_SIGMA * mad: # an outlier
+            return median
+        return value
+
+    def batch(self, values): # the same for a whole array, with no NaN values
+        medians = rolling_median(values, self.window)
+        deviations = np.abs(values - medians)
+        mads = rolling_median(deviations, self.window)
+        return np.where(deviations > self.nsigma * MAD_SIGMA * mads, medians, values)
+# --End Hampel class
+
+# --Define a class for a one dimensional Kalman filter
+# Note: the temperature is modelled as a random walk, so each sample's estimate
+#  is the last estimate, corrected towards the sample by the Kalman gain
+class Kalman(object):
+    def __init__(self, q=0.01, r=1.0):
+        self.q = float(q) # process noise variance, how much the temperature wanders between samples
+        self.r = max(float(r), 1e-12) # measurement noise variance
+        self.reset()
+
+    def reset(self):
+        self.estimate = None
+        self.variance = self.r # the estimate's variance, starting from the first sample's
+
+    def gain(self): # the next Kalman gain, updating the variance
+        self.variance = self.variance + self.q # predict
+        gain = self.variance / (self.variance + self.r)
+        self.variance = (1.0 - gain) * self.variance # correct
+        return gain
+
+    def update(self, value):
+        if value != value: # NaN, so skip it
+            return value
+        if self.estimate == None: # the first sample starts it off
+            self.estimate = value
+        else:
+            self.estimate = self.estimate + self.gain() * (value - self.estimate)
+        return self.estimate
+
+    def batch(self, values): # the same for a whole array, with no NaN values
+        filtered = np.empty(len(values))
+        if len(values) == 0:
+            return filtered
+        saved = self.estimate, self.variance # batch doesn't change the filter's state
+        self.reset()
+        estimate = filtered[0] = values[0]
+        gain = None
+        index = 1
+        while index < len(values): # the gain settles to a constant after a few samples
+            lastgain, gain = gain, self.gain()
+            if gain == lastgain: # from here on it's an exponential moving average
+                filtered[index:] = ema(values[index:], gain, estimate)
+                break
+            estimate = filtered[index] = estimate + gain * (values[index] - estimate)
+            index = index + 1
+        self.estimate, self.variance = saved
+        return filtered
+# --End Kalman class
+
+# --Define a class to run a chain of filters on each probe
+# Note: spec is a comma separated list of filters, each a name and its settings
+#  separated by colons, e.g. 'median:5', 'ema:0.3', 'hampel:7:3', 'kalman:0.01:1'.
+#  An empty spec (or 'raw') doesn't filter at all.
+class FilterPipeline(object):
+    def __init__(self, spec, probes=1):
+        self.spec = spec
+        self.chains = [parse_filters(spec) for probe in range(probes)] # a chain of filters for each probe
+
+    def __len__(self): # the number of filters in each chain
+        return len(self.chains[0])
+
+    def reset(self): # forget all of the samples, e.g. when the recording restarts
+        for chain in self.chains:
+            for stage in chain:
+                stage.reset()
+
+    def update(self, values): # filter the next sample from each probe, returns an array
+        filtered = np.array(values, dtype=float)
+        for probe, chain in enumerate(self.chains):
+            value = filtered[probe]
+            for stage in chain:
+                value = stage.update(value)
+            filtered[probe] = value
+        return filtered
+
+    def batch(self, values): # filter whole arrays, a column per probe, without changing the state
+        filtered = np.array(values, dtype=float)
+        for probe, chain in enumerate(self.chains):
+            valid = ~np.isnan(filtered[:, probe]) # the filters don't see NaN values
+            column = filtered[valid, probe]
+            for stage in chain:
+                column = stage.batch(column)
+            filtered[valid, probe] = column
+        return filtered
+
+    def prime(self, values): # start again from recorded samples, a column per probe
+        self.reset()
+        for row in values:
+            self.update(row)
+# --End FilterPipeline class
+
+########################################
+#----- Function Definitions
+########################################
+
+# --Define a function to make a chain of filters from a description, e.g. 'hampel:7,ema:0.3'
+def parse_filters(spec):
+    kinds = {'median': RunningMedian, 'ema': Ema, 'hampel': Hampel, 'kalman': Kalman}
+    chain = []
+    for item in spec.split(','):
+        parts = item.strip().split(':')
+        if parts[0] in ('', 'raw'): # no filtering
+            continue
+        if parts[0] not in kinds:
+            raise ValueError('Unknown filter ' + repr(parts[0]))
+        chain.append(kinds[parts[0]](*[float(setting) for setting in parts[1:]]))
+    return chain
+# --End parse_filters function
+
+# --Define a function to give the running median of an array, like RunningMedian
+# Note: the first samples have fewer before them, so their medians are of what there is.
+#  The windows are views of the array, taken in chunks so memory use stays small.
+def rolling_median(values, window):
+    values = np.asarray(values, dtype=float)
+    padded = np.concatenate((np.full(window - 1, np.nan), values)) # nanmedian ignores the padding
+    medians = np.empty(len(values))
+    for first in range(0, len(values), BATCH_ROWS):
+        last = min(first + BATCH_ROWS, len(values))
+        windows = np.lib.stride_tricks.sliding_window_view(padded[first:last + window - 1], window)
+        medians[first:last] = np.nanmedian(windows, axis=1)
+    return medians
+# --End rolling_median function
+
+# --Define a function to give the exponential moving average of an array, like Ema
+# Note: in each chunk, the average is the sum of the samples weighted by powers of
+#  (1 - alpha), done with a cumulative sum. The chunks are kept short enough that
+#  the weights don't overflow. 'start' is the average before the first sample, if any.
+def ema(values, alpha, start=None):
+    values = np.asarray(values, dtype=float)
+    if len(values) == 0 or alpha >= 1.0: # each sample is the average
+        return values.copy()
+    averages = np.empty(len(values))
+    if start == None: # the first sample starts the average
+        start = values[0]
+    decay = 1.0 - alpha
+    if alpha <= 0.0: # the average never moves
+        averages[:] = start
+        return averages
+    chunk = max(int(100 / -np.log10(decay)), 1) # (1 - alpha) ** -chunk stays below 1e100
+    for first in range(0, len(values), chunk):
+        last = min(first + chunk, len(values))
+        powers = decay ** np.arange(1, last - first + 1) # (1 - alpha) ** k for each sample
+        averages[first:last] = powers * (start + np.cumsum(alpha * values[first:last] / powers))
+        start = averages[last - 1]
+    return averages
+# --End ema function
@@ -0,0 +1,379 @@
+#!/usr/bin/python3
+# Copyright (c) 2019 R.S. Fowler
+# Author: R.S. Fowler for WG Oven Thermometer project
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# WGOT log file formats, shared by the thermometer (Proto29.py) and offline tools
+#
+# The binary log is a fixed header followed by fixed-width records, one per
+#  sample or event, appended as the thermometer runs:
+# - The header is MAGIC, the format version, the record size, then the wall
+#   clock time and the monotonic clock time when the file was started.
+# - Each record is a RECORD, with the monotonic time in seconds, the probe and
+#   internal chip temperatures in Celsius, the probe fault flags, the probe
+#   number, the record kind and the session id.
+# - Each file's first record is a START, with the time its session started,
+#   and each RESTART record has the time the new session started, so the
+#   samples can be timed from the start of their session, like the csv log.
+# A partial record at the end, e.g. from a power cut, is ignored by the reader.
+#
+# The following command will convert a binary log to the csv log layout.
+#
+# python3 WGOTlog.py WGOTdata.bin WGOTdata.csv
+
+import os # used to find saved log generations
+import re # used to find saved log generations
+import sys # used to exit and to get command line arguments
+import getopt # used to parse command line arguments
+import gzip # used to read compressed saved logs
+import mmap # used to read binary logs without copying them
+import struct # used to pack binary log headers and records
+import numpy as np # np is a shorthand name
+
+########################################
+# ----- Binary log format definitions
+########################################
+
+MAGIC = b'WGOTLOG1' # identifies a binary log file
+VERSION = 1 # binary log format version
+HEADER = struct.Struct('<8sHHIdd') # magic, version, record size, spare, wall time, monotonic time
+RECORD = struct.Struct('<ddfBBHI') # time, C, internal C, fault flags, probe, kind, session
+# The same record layout for NumPy, to read records straight from the file
+RECORD_DTYPE = np.dtype([('time', '<f8'), ('tempc', '<f8'), ('itempc', '<f4'), ('fault', 'u1'),
+                         ('probe', 'u1'), ('kind', '<u2'), ('session', '<u4')])
+
+# Record kinds
+SAMPLE = 0 # a recorded temperature sample
+RESTART = 1 # the recording was restarted, e.g. by button 3
+HOLD = 2 # a save/hold temperature was captured, e.g. by button 2
+MISSED = 3 # a recording deadline was missed, so there's no sample for it, temperatures are NaN
+START = 4 # the session the following records belong to started at this time, first in each file
+
+# Probe fault flags, as reported by the MAX31855
+FAULT_OPEN = 1 # thermocouple open circuit
+FAULT_SHORTGND = 2 # thermocouple shorted to ground
+FAULT_SHORTVCC = 4 # thermocouple shorted to VCC
+
+RESTART_SPLIT = re.compile(b'^00,00,00\n', re.MULTILINE) # finds the restart lines in the csv log
+
+########################################
+#----- Function Definitions
+########################################
+
+# --Define a function to convert Celsius to Fahrenheit.
+# Note: works on single values or NumPy arrays
+def c_to_f(c):
+    return c * 9.0 / 5.0 + 32.0
+# -- End c_to_f function
+
+# --Define a function to build a binary log header
+def pack_header(walltime, monotime):
+    return HEADER.pack(MAGIC, VERSION, RECORD.size, 0, walltime, monotime)
+# --End pack_header function
+
+# --Define a function to build a binary log record
+def pack_record(monotime, tempc, itempc, fault, probe, kind, session):
+    return RECORD.pack(monotime, tempc, itempc, fault, probe, kind, session)
+# --End pack_record function
+
+# --Define a function to build the lines of a csv log from binary records
+# Note: times are whole seconds since the start of each session, like the
+#  thermometer's own csv log, and restarts are shown as a line of zeros.
+#  The start is the time of the START or RESTART record, or of the first
+#  sample in older logs without them.
+#  Each line has a C and an F column for each probe, in probe order, since
+#  the thermometer logs all of the probes together, starting with probe 0.
+# Returns the lines and the state (session start time and unfinished line),
+#  to carry on with the next records. The unfinished line, if any, is the
+#  last line of the log once there are no more records.
+def csv_lines(records, state=(None, None)): # state comes from the previous records, if any
+    starttime, line = state
+    lines = []
+    for record in records.tolist(): # plain Python values are much quicker to format
+        if record[5] == RESTART: # show a restart the same way the thermometer does
+            if line != None:
+                lines.append(line + "\n")
+            lines.append("00,00,00\n")
+            starttime, line = record[0], None # the new session started then
+        elif record[5] == START: # the session started then
+            starttime = record[0]
+        elif record[5] == SAMPLE and record[4] == 0: # the first probe starts a new line
+            if line != None:
+                lines.append(line + "\n")
+            if starttime == None: # an older log, so the first sample of a session is time zero
+                starttime = record[0]
+            line = "%d,%r,%r" % (round(record[0] - starttime), record[1], c_to_f(record[1]))
+        elif record[5] == SAMPLE and line != None: # the other probes add to the line
+            line = line + ",%r,%r" % (record[1], c_to_f(record[1]))
+    return lines, (starttime, line)
+# --End csv_lines function
+
+# --Define a function to read the last session from the end of a csv log
+# Note: the file is memory mapped and searched backwards for the last restart
+#  line, then only that session is parsed, by NumPy in one go, so even a
+#  multi-day log takes a fraction of a second. A partial last line is ignored.
+# Returns the session's times (sec) as an array and temperatures (C) as an
+#  array with a column for each probe
+def read_csv_session(filename):
+    with open(filename, 'rb') as csvfile:
+        if csvfile.seek(0, 2) == 0: # nothing to map in an empty file
+            return np.empty(0), np.empty((0, 1))
+        logmap = mmap.mmap(csvfile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            start = logmap.rfind(b'\n00,00,00\n') # the last restart line
+            if start < 0: # no restarts, so the session is the whole file
+                start = 0
+            else: # the session starts after the restart line
+                start = start + len(b'\n00,00,00\n')
+            end = logmap.rfind(b'\n') # the end of the last complete line
+            text = logmap[start:end].decode('ascii')
+        finally:
+            logmap.close()
+    if end <= start: # no samples in this session yet
+        return np.empty(0), np.empty((0, 1))
+    return parse_csv_text(text)
+# --End read_csv_session function
+
+# --Define a function to check that a csv log line is all numbers
+def is_numbers(line):
+    try:
+        for value in line.split(','):
+            float(value)
+    except ValueError:
+        return False
+    return True
+# --End is_numbers function
+
+# --Define a function to parse csv log lines into arrays
+# Note: the text must not have restart lines, and must end with a complete line
+#  or none at all. It's parsed by NumPy in one go. The number of values in each
+#  line is checked first, also in one go, and any line with a different number
+#  from most of them, e.g. a partial line from a power cut, is left out. If NumPy
+#  then finds something that isn't a number, the lines are checked one by one
+#  and any that aren't all numbers are left out too.
+# Returns the times (sec) as an array and temperatures (C) as an array with a
+#  column for each probe, the same as the thermometer logged them
+def parse_csv_text(text):
+    text = text.strip('\n')
+    if text == '':
+        return np.empty(0), np.empty((0, 1))
+    raw = np.frombuffer(text.encode('ascii'), dtype=np.uint8)
+    ends = np.flatnonzero(raw == ord('\n')) # the end of each line but the last
+    commas = np.cumsum(raw == ord(','))
+    perline = np.diff(np.concatenate(([0], commas[ends], commas[-1:]))) # commas in each line
+    columns = np.bincount(perline).argmax() + 1 # time, then C and F for each probe
+    if (perline != columns - 1).any(): # leave out the odd lines, the slow way, but only for this text
+        text = '\n'.join([line for line in text.split('\n') if line.count(',') == columns - 1])
+    try:
+        values = np.fromstring(text.replace('\n', ','), sep=',').reshape(-1, columns)
+    except ValueError: # a line with something that isn't a number, so leave out those too, the slow way
+        text = '\n'.join([line for line in text.split('\n') if is_numbers(line)])
+        if text == '':
+            return np.empty(0), np.empty((0, 1))
+        values = np.fromstring(text.replace('\n', ','), sep=',').reshape(-1, columns)
+    return values[:, 0], values[:, 1::2]
+# --End parse_csv_text function
+
+# --Define a function to open a log file, or a compressed saved generation of one
+# Note: saved logs are compressed with gzip (.gz) or zstd (.zst) by the thermometer
+def open_log(filename):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    if filename.endswith('.zst'):
+        import zstandard # only needed for zstd compressed logs
+        return zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'), closefd=True)
+    return open(filename, 'rb')
+# --End open_log function
+
+# --Define a function to list a log and its saved generations, oldest first
+# Note: e.g. WGOTdata.csvsave2.gz, WGOTdata.csvsave1, WGOTdata.csv, which is
+#  the order they were recorded in
+def log_generations(filename):
+    folder = os.path.dirname(filename) or '.'
+    pattern = re.compile(re.escape(os.path.basename(filename)) + r'save(\d+)(\.gz|\.zst)?$')
+    saved = []
+    for name in os.listdir(folder):
+        match = pattern.match(name)
+        if match != None:
+            saved.append((-int(match.group(1)), os.path.join(os.path.dirname(filename), name)))
+    names = [name for gen, name in sorted(saved)]
+    if os.path.exists(filename):
+        names.append(filename)
+    return names
+# --End log_generations function
+
+# --Define a function to read the sessions of a csv log, a chunk at a time
+# Note: a session ends at a restart line or the end of the file. The file is
+#  read 'chunk' bytes at a time and each chunk is parsed by parse_csv_text, so a
+#  log of millions of lines is never held as Python strings all at once, only
+#  as the arrays of the session being read. A partial last line is ignored.
+# Yields the times (sec) and temperatures (C) of each session with any samples
+def csv_sessions(filename, chunk=4194304):
+    pieces = [] # the arrays parsed so far for this session
+    rest = b'' # a line carried over to the next chunk
+    with open_log(filename) as logfile:
+        while True:
+            data = logfile.read(chunk)
+            if len(data) == 0: # the end of the file
+                break
+            data = rest + data
+            end = data.rfind(b'\n') + 1 # up to the last complete line
+            rest = data[end:]
+            parts = RESTART_SPLIT.split(data[:end]) # the lines between restarts
+            for index, part in enumerate(parts):
+                if index > 0: # a restart, so the session so far is finished
+                    session = join_pieces(pieces)
+                    if len(session[0]) > 0:
+                        yield session
+                    pieces = []
+                times, tempc = parse_csv_text(part.decode('ascii'))
+                if len(times) > 0:
+                    pieces.append((times, tempc))
+    session = join_pieces(pieces)
+    if len(session[0]) > 0:
+        yield session
+# --End csv_sessions function
+
+# --Define a function to join the parsed pieces of a session into single arrays
+def join_pieces(pieces):
+    if len(pieces) == 0:
+        return np.empty(0), np.empty((0, 1))
+    if len(pieces) == 1:
+        return pieces[0]
+    probes = min(tempc.shape[1] for times, tempc in pieces) # in case a piece lost some columns
+    return np.concatenate([times for times, tempc in pieces]), np.concatenate([tempc[:, :probes] for times, tempc in pieces])
+# --End join_pieces function
+
+# --Define a function to read the last session from the end of a binary log
+# Returns a dictionary with the session's times (sec from the session start)
+#  as an array, the temperatures (C) as an array with a column for each of the
+#  'probes' (NaN for any probe not in the log), the session id, the monotonic
+#  time of the last record and the last hold as (time, C), or None if there wasn't one
+def read_bin_session(filename, probes=1):
+    reader = BinLogReader(filename)
+    try:
+        records = reader.records
+        starts = reader.starts()
+        starttime = None # the time the session started
+        if len(starts) > 0: # only keep the records after the last start or restart
+            starttime = float(records['time'][starts[-1]])
+            records = records[starts[-1]+1:]
+        samples = records[(records['kind'] == SAMPLE) & (records['probe'] == 0)]
+        session = {'times': np.empty(0), 'tempc': np.empty((0, probes)), 'session': None, 'lasttime': None, 'hold': None}
+        if len(samples) > 0:
+            if starttime == None: # an older log, so the first sample is time zero
+                starttime = samples['time'][0]
+            session['times'] = samples['time'] - starttime # these are copies, not in the memory map
+            session['tempc'] = np.full((len(samples), probes), np.nan)
+            session['tempc'][:, 0] = samples['tempc']
+            for probe in range(1, probes): # the other probes are logged along with probe 0
+                temps = records['tempc'][(records['kind'] == SAMPLE) & (records['probe'] == probe)]
+                session['tempc'][:len(temps), probe] = temps[:len(samples)]
+            session['session'] = int(records['session'][-1])
+            session['lasttime'] = float(records['time'][-1])
+            holds = records[records['kind'] == HOLD]
+            if len(holds) > 0:
+                session['hold'] = (float(holds['time'][-1] - starttime), float(holds['tempc'][-1]))
+        records = samples = holds = None # let go of the memory map
+    finally:
+        reader.close()
+    return session
+# --End read_bin_session function
+
+# --Define a function to convert a binary log to the csv log layout
+def bin_to_csv(binname, csvname, chunk=100000): # chunk is the number of records per write
+    reader = BinLogReader(binname)
+    try:
+        records = reader.records
+        state = (None, None) # the session start time and unfinished line, carried from chunk to chunk
+        with open(csvname, 'w') as csvfile:
+            for first in range(0, len(records), chunk):
+                lines, state = csv_lines(records[first:first + chunk], state)
+                csvfile.writelines(lines)
+            if state[1] != None: # the last line
+                csvfile.write(state[1] + "\n")
+        records = None # let go of the memory map
+    finally:
+        reader.close()
+# --End bin_to_csv function
+
+########################################
+#----- Class Definitions
+########################################
+
+# --Define a class to read a binary log without copying or parsing it
+# Note: records is a NumPy structured array that points straight into the
+#  memory-mapped file, so even a multi-day log opens immediately
+class BinLogReader(object):
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+        self.map = None
+        size = self.file.seek(0, 2) # the file size
+        if size < HEADER.size:
+            raise ValueError(filename + ' is too short to be a binary log')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, recordsize, spare, self.walltime, self.monotime = HEADER.unpack_from(self.map)
+        if magic != MAGIC or recordsize != RECORD.size:
+            raise ValueError(filename + ' is not a version ' + str(VERSION) + ' binary log')
+        count = (size - HEADER.size) // RECORD.size # ignore any partial record at the end
+        self.records = np.frombuffer(self.map, dtype=RECORD_DTYPE, count=count, offset=HEADER.size)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def samples(self, probe=0): # the sample records for a probe
+        records = self.records
+        return records[(records['kind'] == SAMPLE) & (records['probe'] == probe)]
+
+    def restarts(self): # the indexes of the restart records
+        return np.flatnonzero(self.records['kind'] == RESTART)
+
+    def starts(self): # the indexes of the start and restart records, where each session's times start
+        return np.flatnonzero((self.records['kind'] == START) | (self.records['kind'] == RESTART))
+
+    def close(self):
+        self.records = None # let go of the memory map before closing it
+        if self.map != None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+# --End BinLogReader class
+
+########################################
+# ----- Convert a binary log to csv from the command line
+########################################
+if __name__ == '__main__':
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'h')
+    except getopt.GetoptError as error:
+        print (error)
+        sys.exit(2)
+    if len(args) not in (1, 2) or len(opts) > 0:
+        print ("Usage: python3 WGOTlog.py binfile [csvfile]")
+        sys.exit(2)
+    if len(args) == 1: # write the csv next to the binary log
+        args.append(args[0].rsplit('.', 1)[0] + '.csv')
+    bin_to_csv(args[0], args[1])
@@ -0,0 +1,272 @@
+#!/usr/bin/python3
+# Copyright (c) 2019 R.S. Fowler
+# Author: R.S. Fowler for WG Oven Thermometer project
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Performance metrics for the WGOT thermometer, to watch it without a profiler
+#
+# Histogram counts values, e.g. the seconds a stage took, in fixed buckets, so
+#  it costs the same however long the thermometer runs, and the median or the
+#  slowest 1% can be estimated from it at any time.
+# Metrics holds the histograms, and gauges, which are functions giving a value
+#  when asked, e.g. a cache hit count. Its timed() decorator puts each call of a
+#  function into a histogram of wgot_stage_seconds. text() gives them all in the
+#  Prometheus text format, with the process CPU time and memory, and write()
+#  saves that to a file, e.g. for node_exporter's textfile collector. summary()
+#  gives a one line summary of what's happened since the last one.
+#
+# Each histogram should only be added to from one thread, but they can all be
+#  read from any thread, e.g. by a web server. The bucket counts are copied in
+#  one go as they're read, so the buckets and the total count always agree.
+#
+# The following command will measure the cost of timing a function.
+#
+# python3 WGOTmetrics.py --calls=100000
+
+import os # used to save the metrics file and read the memory use
+import sys # used to exit and to get command line arguments
+import getopt # used to parse command line arguments
+import time # used to time the stages
+import math # used to round up whole number quantiles
+import functools # used to keep the timed functions' names
+import threading # used to count the threads
+from bisect import bisect_left # used to find the bucket for a value
+
+LATENCY = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+           0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0) # bucket upper bounds (sec) for stage times
+DEPTH = (1, 2, 3, 4, 6, 8, 12, 16, 24, 32, 64, 128) # bucket upper bounds for queue depths
+
+########################################
+#----- Function Definitions
+########################################
+
+# --Define a function to get the memory used by this process
+# Note: /proc gives the current resident size on Linux, and getrusage the peak
+#  size elsewhere, which is the best there is without psutil
+def resident_bytes():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024 # bytes on a Mac, KB on Linux
+    except (ImportError, AttributeError):
+        return 0
+# --End resident_bytes function
+
+# --Define a function to format a value for the Prometheus text format
+def format_value(value):
+    if value != value:
+        return 'NaN'
+    if value in (float('inf'), float('-inf')):
+        return '+Inf' if value > 0 else '-Inf'
+    if value == int(value) and abs(value) < 1e15: # counts look like counts
+        return str(int(value))
+    return repr(float(value))
+# --End format_value function
+
+########################################
+#----- Class Definitions
+########################################
+
+# --Define a class to count values in fixed buckets
+# Note: counts has one count for each bucket, plus one for values above the
+#  last bound, and isn't cumulative, so observe() only adds to one of them
+class Histogram(object):
+    def __init__(self, bounds=LATENCY):
+        self.bounds = tuple(bounds) # the upper bound of each bucket, in order
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0 # the total of the values
+        self.max = 0.0 # the biggest value
+        self.last = list(self.counts) # the counts at the last summary
+
+    def observe(self, value): # count a value
+        self.counts[bisect_left(self.bounds, value)] += 1 # the first bucket whose bound is at least the value
+        self.sum = self.sum + value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, fraction, counts=None): # estimate a quantile, e.g. 0.99, of all the values or some counts
+        if counts == None:
+            counts = list(self.counts)
+        total = sum(counts)
+        if total == 0:
+            return 0.0
+        rank = fraction * total # how many values are at or below the quantile
+        seen = 0
+        for index, count in enumerate(counts):
+            if count > 0 and seen + count >= rank:
+                if index == len(self.bounds): # above the last bound, so it's somewhere up to the biggest
+                    return max(self.max, self.bounds[-1])
+                lower = self.bounds[index-1] if index > 0 else 0.0
+                return lower + (self.bounds[index] - lower) * (rank - seen) / count # assume they're spread evenly
+            seen = seen + count
+        return self.max
+
+    def since_last(self): # the counts since the last call, for a summary
+        counts = list(self.counts)
+        recent = [count - last for count, last in zip(counts, self.last)]
+        self.last = counts
+        return recent
+# --End Histogram class
+
+# --Define a class to hold the histograms and gauges, and give them out
+class Metrics(object):
+    def __init__(self, prefix='wgot'):
+        self.prefix = prefix # the start of every metric name
+        self.families = {} # (help, type, {labels: histogram or function}) by metric name, in order
+        self.shortnames = {} # a short name for each histogram, for the summary
+        self.lastcpu = time.process_time() # the CPU time and real time at the last summary
+        self.lastwall = time.monotonic()
+
+    def family(self, name, help, kind): # get or add a metric family
+        name = self.prefix + '_' + name
+        if name not in self.families:
+            self.families[name] = (help, kind, {})
+        return self.families[name][2]
+
+    def histogram(self, name, help, labels='', bounds=LATENCY, short=None): # get or add a histogram
+        members = self.family(name, help, 'histogram')
+        if labels not in members:
+            members[labels] = Histogram(bounds)
+            self.shortnames[members[labels]] = short or (labels.split('"')[1] if labels != '' else name)
+        return members[labels]
+
+    def stage(self, name): # the histogram of the time a stage takes
+        return self.histogram('stage_seconds', "Seconds taken by each stage of the thermometer", 'stage="%s"' % name)
+
+    def timed(self, name): # a decorator, timing each call of a function as a stage
+        histogram = self.stage(name)
+        def decorate(function):
+            @functools.wraps(function)
+            def timer(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - start)
+            return timer
+        return decorate
+
+    def gauge(self, name, help, function, labels='', kind='gauge'): # add a function giving a value, kind can be 'counter'
+        self.family(name, help, kind)[labels] = function
+
+    def text(self): # all of the metrics in the Prometheus text format
+        lines = []
+        def add(name, help, kind):
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+        add('process_cpu_seconds_total', "Total user and system CPU time spent in seconds", 'counter')
+        lines.append('process_cpu_seconds_total ' + format_value(time.process_time()))
+        add('process_resident_memory_bytes', "Resident memory size in bytes", 'gauge')
+        lines.append('process_resident_memory_bytes ' + format_value(resident_bytes()))
+        add(self.prefix + '_threads', "Threads running in the thermometer", 'gauge')
+        lines.append(self.prefix + '_threads ' + format_value(threading.active_count()))
+        for name in list(self.families):
+            help, kind, members = self.families[name]
+            add(name, help, kind)
+            for labels in list(members):
+                member = members[labels]
+                if kind != 'histogram':
+                    try:
+                        value = member()
+                    except Exception: # e.g. not set up yet
+                        continue
+                    lines.append(name + ('{%s}' % labels if labels != '' else '') + ' ' + format_value(value))
+                    continue
+                counts = list(member.counts) # one copy, so the buckets and count agree
+                comma = labels + ',' if labels != '' else ''
+                total = 0
+                for bound, count in zip(member.bounds + (float('inf'),), counts): # cumulative counts
+                    total = total + count
+                    lines.append('%s_bucket{%sle="%s"} %d' % (name, comma, format_value(bound), total))
+                lines.append(name + '_sum' + ('{%s}' % labels if labels != '' else '') + ' ' + format_value(member.sum))
+                lines.append(name + '_count' + ('{%s}' % labels if labels != '' else '') + ' ' + str(total))
+        return "\n".join(lines) + "\n"
+
+    def write(self, filename): # save text() to a file, replacing it in one go so it's never seen half written
+        temporary = filename + '.tmp'
+        with open(temporary, 'w') as metricsfile:
+            metricsfile.write(self.text())
+        os.replace(temporary, filename)
+
+    def summary(self): # one line: CPU, memory, and the median and slowest 1% of each histogram, since the last one
+        cpu, wall = time.process_time(), time.monotonic()
+        percent = (cpu - self.lastcpu) * 100 / max(wall - self.lastwall, 1e-9)
+        self.lastcpu, self.lastwall = cpu, wall
+        parts = ["cpu %.1f%%, rss %.1f MB" % (percent, resident_bytes() / 1e6)]
+        for name in list(self.families):
+            help, kind, members = self.families[name]
+            if kind != 'histogram':
+                continue
+            for member in list(members.values()):
+                counts = member.since_last()
+                if sum(counts) == 0: # nothing new
+                    continue
+                median, slowest = member.quantile(0.5, counts), member.quantile(0.99, counts)
+                if name.endswith('_seconds'): # times in ms
+                    parts.append("%s %.3g/%.3g ms x%d" % (self.shortnames[member], median * 1000, slowest * 1000, sum(counts)))
+                else: # whole numbers, e.g. queue depths
+                    parts.append("%s %d/%d x%d" % (self.shortnames[member], math.ceil(median), math.ceil(slowest), sum(counts)))
+        return ", ".join(parts)
+# --End Metrics class
+
+########################################
+# ----- Measure the cost of timing a function from the command line
+########################################
+if __name__ == '__main__':
+    usage = "Usage: python3 WGOTmetrics.py [--calls=N] [--show]"
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'h', ['help', 'calls=', 'show'])
+    except getopt.GetoptError as error:
+        print (error)
+        print (usage)
+        sys.exit(2)
+    calls = 100000
+    show = False
+    if len(args) > 0:
+        print (usage)
+        sys.exit(2)
+    for opt, value in opts:
+        if opt in ('-h', '--help'):
+            print (usage)
+            sys.exit()
+        elif opt == '--calls':
+            calls = int(value)
+        elif opt == '--show':
+            show = True
+    metrics = Metrics()
+    def plain():
+        return None
+    timed = metrics.timed('timed')(plain)
+    results = []
+    for function in (plain, timed):
+        start = time.perf_counter()
+        for count in range(calls):
+            function()
+        results.append((time.perf_counter() - start) / calls)
+    print ("%d calls: %.2f us each untimed, %.2f us timed, so timing costs %.2f us a call"
+           % (calls, results[0] * 1e6, results[1] * 1e6, (results[1] - results[0]) * 1e6))
+    print (metrics.summary())
+    if show == True: # what a scrape would see
+        print (metrics.text())
@@ -0,0 +1,188 @@
+#!/usr/bin/python3
+# Copyright (c) 2014 Adafruit Industries, 2019 R.S. Fowler
+# Author: Tony DiCola - for the MAX31855 data format, from MAX31855.py
+# Author: R.S. Fowler for WG Oven Thermometer project
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Reading one or more MAX31855 thermocouple boards for the WGOT thermometer
+#
+# The boards share the SPI clock (CLK) and data out (DO) lines, and each has
+#  its own chip select (CS) line. Each board gives one 32 bit word per read:
+# - bits 31-18 are the probe temperature, signed, in 0.25 C steps
+# - bit 16 is set if there's any fault
+# - bits 15-4 are the board's internal (cold junction) temperature, signed, in 0.0625 C steps
+# - bits 2-0 are the fault flags, short to VCC, short to ground and open circuit
+# The Adafruit MAX31855 class reads the board again for each of these values.
+#  Here each board is read once per pass, and all of the words are decoded
+#  together by NumPy, so the cost per pass is one read per probe.
+#
+# There are two ways to read the boards, picked by open_bus:
+# - BitBangBus drives the CLK and CS lines and reads DO from Python, on any
+#   GPIO pins, e.g. the original wiring with CLK on GPIO 5 and DO on GPIO 16.
+# - SpidevBus uses the kernel's hardware SPI driver (spidev), which clocks the
+#   bits for us, so it takes much less CPU. The boards' CLK and DO must be wired
+#   to the SPI bus's SCLK and MISO, and the CS lines are still GPIO pins.
+# WGOTbench.py measures both, without the boards.
+
+import numpy as np # np is a shorthand name
+
+########################################
+#----- Function Definitions
+########################################
+
+# --Define a function to decode MAX31855 words
+# Note: works on a list or array of words, one per probe
+# Returns arrays of the probe temperatures (C, NaN for a fault), the internal
+#  temperatures (C) and the fault flags, which match the WGOTlog FAULT_ values
+def decode_words(words):
+    words = np.asarray(words, dtype=np.uint32)
+    tempc = (words >> 18).astype(np.int32) # 14 bits, signed
+    tempc = np.where(tempc & 0x2000, tempc - 0x4000, tempc) * 0.25
+    itempc = ((words >> 4) & 0xFFF).astype(np.int32) # 12 bits, signed
+    itempc = np.where(itempc & 0x800, itempc - 0x1000, itempc) * 0.0625
+    fault = (words & 0x7).astype(np.uint8)
+    tempc[fault != 0] = np.nan # the temperature isn't valid with a fault
+    return tempc, itempc, fault
+# --End decode_words function
+
+# --Define a function to build a MAX31855 word, e.g. for simulated probes
+# Note: the opposite of decode_words, for a single probe
+def encode_word(tempc, itempc, fault=0):
+    word = (int(round(itempc * 16)) & 0xFFF) << 4 | (fault & 0x7)
+    if fault != 0:
+        word = word | 0x10000 # the fault bit
+    else:
+        word = word | (int(round(tempc * 4)) & 0x3FFF) << 18
+    return word
+# --End encode_word function
+
+# --Define a function to open the probes with the chosen backend
+# Note: backend is 'bitbang', 'spidev', or 'auto', which tries spidev and falls
+#  back to bit banging if it can't be used, e.g. there's no /dev/spidev device
+#  because the SPI bus is turned off or the PiTFT has it.
+# Returns the bus, whose name says which backend is in use
+def open_bus(backend, clk, do, cslist, gpio, port=0, device=0, hz=5000000):
+    if backend in ('spidev', 'auto'):
+        try:
+            return SpidevBus(port, device, cslist, gpio, hz)
+        except Exception as error: # ImportError, or OSError/IOError from the device
+            if backend == 'spidev': # no fallback asked for
+                raise
+            print ("Can't use spidev", str(port) + '.' + str(device), error, "- bit banging instead")
+    elif backend != 'bitbang':
+        raise ValueError('Unknown SPI backend ' + repr(backend))
+    return BitBangBus(clk, do, cslist, gpio)
+# --End open_bus function
+
+########################################
+#----- Class Definitions
+########################################
+
+# --Define a class to read MAX31855 boards sharing CLK and DO, by bit banging GPIO pins
+# Note: this is SPI mode 0, like the Adafruit MAX31855 class uses, straight
+#  to RPi.GPIO without the Adafruit_GPIO layers, which are slow per bit.
+#  gpio is RPi.GPIO, or anything like it, set to BCM numbering.
+class BitBangBus(object):
+    name = 'bitbang'
+
+    def __init__(self, clk, do, cslist, gpio):
+        self.clk = clk
+        self.do = do
+        self.cslist = list(cslist) # one chip select per probe, in order
+        self.gpio = gpio
+        gpio.setup(clk, gpio.OUT)
+        gpio.output(clk, gpio.LOW) # the clock idles low in mode 0
+        gpio.setup(do, gpio.IN)
+        for cs in self.cslist: # all of the boards off to start with
+            gpio.setup(cs, gpio.OUT)
+            gpio.output(cs, gpio.HIGH)
+
+    def __len__(self): # the number of probes
+        return len(self.cslist)
+
+    def read_words(self): # read each probe's word, in one pass
+        output, input = self.gpio.output, self.gpio.input # local names are quicker in the loop
+        clk, do, high, low = self.clk, self.do, self.gpio.HIGH, self.gpio.LOW
+        words = []
+        for cs in self.cslist:
+            output(cs, low) # select the board
+            word = 0
+            for bit in range(32): # most significant bit first
+                output(clk, high)
+                word = word << 1 | input(do) # read on the rising edge
+                output(clk, low) # the board moves to the next bit
+            output(cs, high)
+            words.append(word)
+        return words
+
+    def read(self): # read and decode all of the probes
+        return decode_words(self.read_words())
+
+    def close(self):
+        pass
+# --End BitBangBus class
+
+# --Define a class to read MAX31855 boards on a hardware SPI bus, with spidev
+# Note: the CS lines are GPIO pins set by this class (spidev's no_cs), so any
+#  number of boards can share the bus. spidevmodule can be a stand-in for
+#  the spidev module, e.g. for benchmarking.
+class SpidevBus(object):
+    name = 'spidev'
+
+    def __init__(self, port, device, cslist, gpio, hz=5000000, spidevmodule=None):
+        if spidevmodule == None: # the real one, only needed for this backend
+            import spidev as spidevmodule
+        self.cslist = list(cslist) # one chip select per probe, in order
+        self.gpio = gpio
+        self.spi = spidevmodule.SpiDev()
+        self.spi.open(port, device) # i.e. /dev/spidev<port>.<device>
+        try:
+            self.spi.max_speed_hz = hz # the MAX31855 can go up to 5 MHz
+            self.spi.mode = 0
+            self.spi.no_cs = True # the chip selects are ours
+        except Exception: # don't leave the device open
+            self.spi.close()
+            raise
+        for cs in self.cslist: # all of the boards off to start with
+            gpio.setup(cs, gpio.OUT)
+            gpio.output(cs, gpio.HIGH)
+
+    def __len__(self): # the number of probes
+        return len(self.cslist)
+
+    def read_words(self): # read each probe's word, in one pass
+        output, readbytes = self.gpio.output, self.spi.readbytes # local names are quicker in the loop
+        high, low = self.gpio.HIGH, self.gpio.LOW
+        words = []
+        for cs in self.cslist:
+            output(cs, low) # select the board
+            raw = readbytes(4) # the kernel clocks in all 32 bits
+            output(cs, high)
+            if len(raw) != 4:
+                raise RuntimeError('Did not read expected number of bytes from device!')
+            words.append(raw[0] << 24 | raw[1] << 16 | raw[2] << 8 | raw[3])
+        return words
+
+    def read(self): # read and decode all of the probes
+        return decode_words(self.read_words())
+
+    def close(self):
+        self.spi.close()
+# --End SpidevBus class
@@ -0,0 +1,271 @@
+#!/usr/bin/python3
+# Copyright (c) 2019 R.S. Fowler
+# Author: R.S. Fowler for WG Oven Thermometer project
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Drawing the WGOT matplotlib graph, in the thermometer's process or a worker process
+#
+# GraphRenderer draws the times and temperatures of each probe into one
+#  persistent, screen sized matplotlib figure, and returns the RGBA pixels,
+#  ready for pygame.image.frombuffer. It can also save the graph to a file.
+# RenderWorker runs a GraphRenderer in its own process, so a slow graph, e.g.
+#  a long session on a Pi Zero, doesn't hold up the thermometer's event loop,
+#  and a Pi 3/4 draws it on another core. Requests go to the worker through
+#  one pipe and the frames come back through another. Only the latest request
+#  matters: if a request is made while a frame is being drawn, it replaces any
+#  request already waiting, and the worker skips any it's sent but hasn't started.
+#  If a graph can't be drawn, e.g. the export file can't be written, the reply
+#  has no frame and the error, and the worker carries on with the next one.
+#
+# The worker is forked, so it should be started before any threads, while the
+#  process is small. It never uses pygame, so a display that's already open is
+#  no problem. The following command will time a graph of 4 probes in a worker process.
+#
+# python3 WGOTrender.py --probes=4
+
+import os # used to lower the worker's priority while loading matplotlib
+import sys # used to exit and to get command line arguments
+import getopt # used to parse command line arguments
+import time # used to time loading and drawing
+import multiprocessing # used to run the worker process
+import signal # used to reset the worker's signal handlers
+import numpy as np # np is a shorthand name
+
+Figure = None # matplotlib's Figure, imported by load_plotting
+FigureCanvasAgg = None # matplotlib's Agg canvas, imported by load_plotting
+
+########################################
+#----- Function Definitions
+########################################
+
+# --Define a function to import matplotlib, the first time it's needed
+# Note: this takes several seconds on a Pi Zero
+def load_plotting(debug=False): # debug=True prints the time it took
+    global Figure, FigureCanvasAgg # declare globals as needed
+    if Figure != None: # already done
+        return
+    importstart = time.time()
+    import matplotlib # used to make graphs
+# the following line allows this program to start from rc.local to avoid errors
+    matplotlib.use('Agg') # Needed to run screenless matplotlib - BEFORE importing pyplot
+    import matplotlib.figure # one persistent figure, no pyplot state machine needed
+    import matplotlib.backends.backend_agg # draws the figure into memory
+    FigureCanvasAgg = matplotlib.backends.backend_agg.FigureCanvasAgg
+    Figure = matplotlib.figure.Figure
+    if debug == True:
+        print ("Loaded matplotlib in %.2f sec" % (time.time() - importstart))
+# --End load_plotting function
+
+# --Define a function to serve render requests, in the worker process
+# Note: each request is a dictionary of GraphRenderer.render arguments, plus a
+#  tag to identify it, and None ends the worker. Each reply is (frame, size,
+#  seconds to draw, requests skipped, tag, error), where error is None, or the
+#  text of the error if the graph couldn't be drawn, when the frame is None too.
+def serve(requests, replies, size, dpi, probes, prewarm, debug):
+    sys.setprofile(None) # not the parent's profiler, if it was forked with one
+    signal.signal(signal.SIGTERM, signal.SIG_DFL) # not pygame's handler, so terminate() stops it
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl-C is for the thermometer, which then closes the worker
+    renderer = GraphRenderer(size, dpi, probes, debug)
+    if prewarm == True: # load matplotlib now, at low priority, so the first graph is quick
+        try:
+            os.nice(10)
+        except Exception:
+            pass
+        load_plotting(debug)
+        try: # back to the normal priority for drawing, if we're allowed
+            os.nice(-10)
+        except Exception:
+            pass
+    while True:
+        try:
+            request = requests.recv() # wait for a request
+            skipped = 0
+            while request != None and requests.poll(): # only draw the latest one
+                request = requests.recv()
+                skipped = skipped + 1
+        except (EOFError, OSError): # the thermometer has gone
+            break
+        if request == None: # asked to finish
+            break
+        tag = request.pop('tag', None) # not for the renderer
+        drawstart = time.time()
+        try:
+            frame, error = renderer.render(**request), None
+        except Exception as problem: # say what happened, and carry on with the next one
+            frame, error = None, "%s: %s" % (type(problem).__name__, problem)
+        replies.send((frame, renderer.size, time.time() - drawstart, skipped, tag, error))
+# --End serve function
+
+########################################
+#----- Class Definitions
+########################################
+
+# --Define a class to draw the graph with matplotlib
+# Note: the figure, axes and lines are built on first use and reused for every
+#  graph after that, which avoids rebuilding all of the matplotlib objects
+class GraphRenderer(object):
+    def __init__(self, size, dpi, probes, debug=False):
+        self.size = size # (width, height) in pixels
+        self.dpi = dpi # dots per inch for the figure, e.g. 320x240 at 6.4x4.8 inches
+        self.probes = probes # number of lines
+        self.debug = debug
+        self.figure = None
+
+    def build(self): # build the persistent figure, once only
+        load_plotting(self.debug) # make sure matplotlib is loaded
+        width, height = self.size
+        self.figure = Figure(figsize=(width/self.dpi, height/self.dpi), dpi=self.dpi) # exactly screen sized
+        self.canvas = FigureCanvasAgg(self.figure) # an in-memory Agg canvas to draw on
+        self.axes = self.figure.add_subplot(111) # a single set of axes
+        self.figure.subplots_adjust(left=0.11, right=0.97, top=0.94, bottom=0.11) # reduce margin size
+        self.lines = [self.axes.plot([], [])[0] for probe in range(self.probes)] # an empty line for each probe
+        self.axes.set(xlabel='Time (min)', ylabel='Temp (F)',title='Temperature') # add axis labels
+        self.axes.grid() #show with default grid for major axes
+
+    def render(self, times, temps, colours, export=None, frame=True):
+        # times in minutes, temps in F with a column per probe, an RGB colour (0-255) per probe
+        # export is a file to save the graph to, if any, and frame=False skips the pixels
+        if self.figure == None: # build the figure the first time through
+            self.build()
+        for probe, line in enumerate(self.lines): # just replace the data in the existing lines
+            line.set_data(times, temps[:, probe])
+            line.set_color([value/255.0 for value in colours[probe]]) # matplotlib colours are 0 to 1
+        self.axes.relim() # recalculate the data limits for the new data
+        self.axes.autoscale_view() # and rescale the axes to suit
+        if export != None: # save a copy (before drawing to the canvas)
+# The following creates a 320 x 240 pixel (for now) graph image file
+#   after experimenting with 'dpi' values.
+            self.figure.savefig(export, dpi=self.dpi + 0.1) # save graph
+        if frame == False: # the pixels aren't wanted
+            return None
+        self.canvas.draw() # draw the graph into the Agg canvas memory
+        return bytes(self.canvas.buffer_rgba()) # a copy, the canvas is reused
+# --End GraphRenderer class
+
+# --Define a class to draw the graph in a worker process
+# Note: request() never waits. The frames come back in order from receive(),
+#  which waits for one, so it's best called from its own thread, and done()
+#  must be called for each one, to send any request that was held back meanwhile.
+# If the worker has gone, receive() raises EOFError and nothing is busy or
+#  waiting any more. 'closed' is set by close(), to tell that from a failure.
+class RenderWorker(object):
+    def __init__(self, size, dpi, probes, prewarm=True, debug=False):
+        context = multiprocessing.get_context('fork') # a copy of this process, without re-running it
+        workerrequests, self.requests = context.Pipe(duplex=False)
+        self.replies, workerreplies = context.Pipe(duplex=False)
+        self.process = context.Process(target=serve, name='render',
+                                       args=(workerrequests, workerreplies, size, dpi, probes, prewarm, debug))
+        self.process.daemon = True # don't keep the programme alive on exit
+        self.process.start()
+        workerrequests.close() # the worker's ends
+        workerreplies.close()
+        self.lock = multiprocessing.Lock() # stops request() and done() overlapping
+        self.busy = False # True while the worker has a request
+        self.waiting = None # the latest request held back while the worker was busy
+        self.dropped = 0 # requests replaced before they were sent
+        self.closed = False # True once close() has been called
+
+    def request(self, **request): # ask for a graph, see GraphRenderer.render for the arguments, plus any tag
+        with self.lock:
+            if self.busy == True: # hold on to it until the worker is free, replacing any older one
+                if self.waiting != None:
+                    self.dropped = self.dropped + 1
+                self.waiting = request
+            else:
+                self.send(request)
+
+    def send(self, request): # send a request to the worker, with the lock held
+        try:
+            self.requests.send(request)
+            self.busy = True
+        except (OSError, ValueError): # the worker has gone, and receive() will say so
+            self.busy = False
+
+    def receive(self): # wait for the next frame, returns (frame, size, seconds to draw, requests skipped, tag, error)
+        try:
+            return self.replies.recv()
+        except (EOFError, OSError): # the worker has gone, so nothing will come back
+            with self.lock:
+                self.busy = False
+                self.waiting = None
+            raise EOFError("the render worker has stopped")
+
+    def done(self): # the frame from receive() has been dealt with, so send the next request, if any
+        with self.lock:
+            self.busy = False
+            if self.waiting != None:
+                self.send(self.waiting)
+                self.waiting = None
+
+    def close(self): # ask the worker to finish, then make sure it has
+        self.closed = True
+        try:
+            self.requests.send(None)
+        except (OSError, ValueError): # it's gone already
+            pass
+        self.process.join(2)
+        if self.process.is_alive():
+            self.process.terminate()
+# --End RenderWorker class
+
+########################################
+# ----- Time the graph in a worker process from the command line
+########################################
+if __name__ == '__main__':
+    usage = "Usage: python3 WGOTrender.py [--probes=N] [--points=N] [--frames=N]"
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'h', ['help', 'probes=', 'points=', 'frames='])
+    except getopt.GetoptError as error:
+        print (error)
+        print (usage)
+        sys.exit(2)
+    probes = 1
+    points = 550 # about what the thermometer graphs, two per pixel
+    frames = 20
+    if len(args) > 0:
+        print (usage)
+        sys.exit(2)
+    for opt, value in opts:
+        if opt in ('-h', '--help'):
+            print (usage)
+            sys.exit()
+        elif opt == '--probes':
+            probes = int(value)
+        elif opt == '--points':
+            points = int(value)
+        elif opt == '--frames':
+            frames = int(value)
+    times = np.linspace(0, 60, points)
+    temps = np.column_stack([70 + 300 * (1 - np.exp(-times / (20 + 5 * probe))) for probe in range(probes)])
+    colours = [(255, 0, 0)] * probes
+    worker = RenderWorker((320, 240), 50.0, probes, debug=True)
+    for count in range(frames + 1): # the first one includes building the figure
+        if count == 1:
+            walltime = time.time()
+            drawtime = 0.0
+        worker.request(times=times, temps=temps, colours=colours)
+        frame, size, seconds, skipped, tag, error = worker.receive()
+        worker.done()
+        if count > 0:
+            drawtime = drawtime + seconds
+    walltime = time.time() - walltime
+    print ("%d frames of %d probes x %d points: %.1f ms each to draw, %.1f ms each with the round trip"
+           % (frames, probes, points, drawtime * 1000 / frames, walltime * 1000 / frames))
+    worker.close()
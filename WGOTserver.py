@@ -0,0 +1,403 @@
+#!/usr/bin/python3
+# Copyright (c) 2019 R.S. Fowler
+# Author: R.S. Fowler for WG Oven Thermometer project
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# A small web server for the WGOT thermometer, to watch the oven from a browser
+#
+# LiveServer runs an asyncio HTTP server in its own thread, with its own event
+#  loop, so it never holds up the thermometer's pygame event loop. It serves:
+# - /          a page showing the live temperatures and the graph
+# - /events    the live samples and new graph notices, as Server-Sent Events
+# - /graph.png the latest graph
+# - /series.json and /series.bin  the recorded series, gzip compressed, as JSON,
+#              or as little-endian doubles: the times (min), then the
+#              temperatures (F) row by row. ?points=N picks the detail.
+# - /metrics   the thermometer's performance metrics, for Prometheus, if given
+# Each sample is encoded once, however many clients there are, and put on each
+#  client's own queue. A slow client's queue drops its oldest samples, rather
+#  than holding up the others. The graph is PNG encoded once per new graph, and
+#  the series once per change, the first time they're asked for. Only the
+#  latest series of each format is kept, so asking for another ?points
+#  encodes it again rather than adding to the server's memory.
+#
+# The thermometer publishes its samples and graphs with publish_sample and
+#  publish_frame, which can be called from any thread. The series comes from
+#  the 'snapshot' function given to LiveServer, which is called in the server
+#  thread and returns a concurrent.futures.Future for (version, times, temps).
+#  The metrics come from the 'metrics' function, also called in the server
+#  thread, which returns them in the Prometheus text format.
+#
+# The following command runs 50 test clients for 10 seconds against a demo
+#  server, which publishes a synthetic sample 20 times a second, and reports
+#  the throughput. Give host:port instead of --demo to test a running thermometer.
+#
+# python3 WGOTserver.py --demo --clients=50 --seconds=10
+
+import sys # used to exit and to get command line arguments
+import getopt # used to parse command line arguments
+import time # used to time the test clients
+import threading # used to run the server's event loop
+import asyncio # used to serve all of the clients from one thread
+import concurrent.futures # used to ask for the series from another thread
+import json # used to encode samples and series
+import gzip # used to compress series
+import zlib # used to compress PNG graphs
+import struct # used to build PNG graphs
+import math # used for the demo samples
+import numpy as np # np is a shorthand name
+from WGOTlog import c_to_f # Celsius to Fahrenheit, the same as the thermometer uses
+
+QUEUESIZE = 32 # samples queued for each client before its oldest are dropped
+SNAPSHOTWAIT = 5.0 # seconds to wait for a series snapshot
+
+PAGE = b"""<!DOCTYPE html>
+<html><head><title>WGOT</title></head>
+<body style="font-family: sans-serif">
+<h1 id="temps">Waiting for the oven...</h1>
+<img id="graph" src="/graph.png" width="640" height="480" alt="No graph yet">
+<script>
+var events = new EventSource('/events');
+events.addEventListener('sample', function (message) {
+    var sample = JSON.parse(message.data);
+    var text = Math.floor(sample.time / 60) + ':' + ('0' + Math.round(sample.time % 60)).slice(-2);
+    for (var probe = 0; probe < sample.tempf.length; probe++) {
+        text += ' &nbsp; ' + (sample.tempf[probe] === null ? '--' : sample.tempf[probe].toFixed(1)) + ' F';
+    }
+    document.getElementById('temps').innerHTML = text;
+});
+events.addEventListener('graph', function (message) {
+    document.getElementById('graph').src = '/graph.png?' + message.data;
+});
+</script>
+</body></html>
+"""
+
+########################################
+#----- Function Definitions
+########################################
+
+# --Define a function to encode RGBA pixels as a PNG image
+# Note: no filtering, just zlib, which suits the flat colours of a graph
+def encode_png(rgba, size):
+    width, height = size
+    stride = width * 4
+    rows = b"".join([b"\x00" + rgba[row*stride:(row+1)*stride] for row in range(height)]) # filter type 0 for each row
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xFFFFFFFF)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)) # 8 bit RGBA
+            + chunk(b'IDAT', zlib.compress(rows, 6)) + chunk(b'IEND', b""))
+# --End encode_png function
+
+# --Define a function to turn a list of temperatures into JSON values
+# Note: JSON has no NaN, so probe faults are null
+def json_temps(temps):
+    return [None if temp != temp else round(temp, 3) for temp in temps]
+# --End json_temps function
+
+# --Define a function to build an HTTP response
+def response(status, body, contenttype, headers=None):
+    lines = ["HTTP/1.1 " + status, "Content-Type: " + contenttype, "Content-Length: " + str(len(body)),
+             "Cache-Control: no-cache", "Connection: close"]
+    if headers != None:
+        lines.extend(headers)
+    return ("\r\n".join(lines) + "\r\n\r\n").encode('ascii') + body
+# --End response function
+
+########################################
+#----- Class Definitions
+########################################
+
+# --Define a class to serve the live samples, graph and series over HTTP
+class LiveServer(object):
+    def __init__(self, host, port, snapshot=None, metrics=None):
+        self.host = host
+        self.port = port
+        self.snapshot = snapshot # gives a Future for the series, see the notes above
+        self.metrics = metrics # gives the metrics text, see the notes above
+        self.loop = None
+        self.clients = [] # a queue of encoded events for each /events client
+        self.lastsample = None # the latest encoded sample, for new clients
+        self.frame = None # the latest graph as (RGBA pixels, size, version)
+        self.png = None # the latest graph as (version, PNG), once it's asked for
+        self.series = {} # the latest encoded series, by path, as (version, points, payload, shape)
+        self.stats = {'samples': 0, 'sent': 0, 'dropped': 0, 'requests': 0, 'pngs': 0, 'series': 0}
+        self.started = threading.Event() # set once the server is listening
+        self.error = None # why the server couldn't start, if it couldn't
+
+    def start(self): # start serving in a thread, returns once it's listening, or has failed
+        thread = threading.Thread(target=self.run, name='webserver')
+        thread.daemon = True # don't keep the programme alive on exit
+        thread.start()
+        self.started.wait()
+        if self.error != None:
+            raise self.error
+
+    def run(self): # the server thread
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.server = self.loop.run_until_complete(asyncio.start_server(self.handle, self.host, self.port))
+        except Exception as error: # e.g. the port is in use
+            self.error = error
+            self.started.set()
+            return
+        self.started.set()
+        self.loop.run_forever()
+
+    def close(self): # stop serving
+        if self.loop != None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def publish_sample(self, seconds, tempc): # a new sample, from any thread, tempc is an array with a value per probe
+        if self.loop != None:
+            self.loop.call_soon_threadsafe(self.fanout_sample, seconds, tempc.tolist())
+
+    def publish_frame(self, frame, size, version): # a new graph's RGBA pixels, from any thread
+        if self.loop != None:
+            self.loop.call_soon_threadsafe(self.fanout_frame, frame, size, version)
+
+    def fanout(self, payload): # put an encoded event on every client's queue, in the server thread
+        for queue in self.clients:
+            if queue.full(): # a slow client, so drop its oldest event
+                queue.get_nowait()
+                self.stats['dropped'] = self.stats['dropped'] + 1
+            queue.put_nowait(payload)
+
+    def fanout_sample(self, seconds, tempc): # encode a sample once, for all of the clients
+        sample = {'time': round(seconds, 3), 'tempc': json_temps(tempc),
+                  'tempf': json_temps([c_to_f(tempc) for tempc in tempc])}
+        self.lastsample = ("event: sample\ndata: " + json.dumps(sample, separators=(',', ':')) + "\n\n").encode('ascii')
+        self.stats['samples'] = self.stats['samples'] + 1
+        self.fanout(self.lastsample)
+
+    def fanout_frame(self, frame, size, version): # tell the clients there's a new graph
+        self.frame = (frame, size, version)
+        self.fanout(("event: graph\ndata: %d\n\n" % version).encode('ascii'))
+
+    async def handle(self, reader, writer): # one HTTP request
+        self.stats['requests'] = self.stats['requests'] + 1
+        try:
+            request = await reader.readline()
+            while True: # skip the headers
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+            parts = request.decode('ascii', 'replace').split()
+            if len(parts) < 2 or parts[0] != 'GET':
+                writer.write(response("405 Method Not Allowed", b"GET only\n", "text/plain"))
+            else:
+                path, query = (parts[1].split('?', 1) + [''])[:2]
+                if path == '/events':
+                    await self.stream(writer)
+                else:
+                    try:
+                        page = await self.page(path, query)
+                    except Exception as error: # say what happened, and tell the client
+                        print ("Web page", path, "failed:", error)
+                        page = response("500 Internal Server Error", b"Internal error\n", "text/plain")
+                    writer.write(page)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError): # the client went away
+            pass
+        except Exception as error: # anything else, so the server carries on
+            print ("Web request failed:", error)
+        finally:
+            writer.close()
+
+    async def page(self, path, query): # the response for anything but /events
+        if path == '/':
+            return response("200 OK", PAGE, "text/html")
+        if path == '/graph.png':
+            if self.frame == None:
+                return response("404 Not Found", b"No graph yet\n", "text/plain")
+            frame, size, version = self.frame
+            if self.png == None or self.png[0] != version: # encode it once for everyone
+                self.png = (version, encode_png(frame, size))
+                self.stats['pngs'] = self.stats['pngs'] + 1
+            return response("200 OK", self.png[1], "image/png")
+        if path in ('/series.json', '/series.bin'):
+            return await self.series_page(path, query)
+        if path == '/metrics' and self.metrics != None:
+            return response("200 OK", self.metrics().encode('utf-8'), "text/plain; version=0.0.4")
+        return response("404 Not Found", b"Not found\n", "text/plain")
+
+    async def series_page(self, path, query): # the recorded series, gzip compressed
+        if self.snapshot == None:
+            return response("404 Not Found", b"No series\n", "text/plain")
+        points = 0 # all of them
+        for item in query.split('&'):
+            if item.startswith('points='):
+                try:
+                    points = int(item[7:])
+                except ValueError:
+                    points = -1
+                if points < 0:
+                    return response("400 Bad Request", b"points should be a whole number, 0 for all\n", "text/plain")
+        try:
+            version, times, temps = await asyncio.wait_for(asyncio.wrap_future(self.snapshot(points)), SNAPSHOTWAIT)
+        except asyncio.TimeoutError:
+            return response("503 Service Unavailable", b"The thermometer is busy\n", "text/plain")
+        if path not in self.series or self.series[path][:2] != (version, points): # encode it once for this version
+            if path == '/series.json':
+                body = json.dumps({'version': version, 'times': np.round(times, 4).tolist(),
+                                   'tempf': [json_temps(row) for row in temps.tolist()]}, separators=(',', ':')).encode('ascii')
+            else:
+                body = np.concatenate((times, temps.ravel())).astype('<f8').tobytes()
+            self.series[path] = (version, points, gzip.compress(body, 6), temps.shape) # replaces the last one
+            self.stats['series'] = self.stats['series'] + 1
+        version, points, body, shape = self.series[path]
+        headers = ["Content-Encoding: gzip", "X-Points: %d" % shape[0], "X-Probes: %d" % shape[1]]
+        contenttype = "application/json" if path == '/series.json' else "application/octet-stream"
+        return response("200 OK", body, contenttype, headers)
+
+    async def stream(self, writer): # Server-Sent Events, until the client goes away
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n\r\n")
+        queue = asyncio.Queue(QUEUESIZE)
+        if self.lastsample != None: # start with the latest sample
+            queue.put_nowait(self.lastsample)
+        self.clients.append(queue)
+        try:
+            while True:
+                payload = await queue.get()
+                writer.write(payload)
+                self.stats['sent'] = self.stats['sent'] + 1
+                await writer.drain()
+        finally:
+            self.clients.remove(queue)
+# --End LiveServer class
+
+# --Define a class to subscribe to /events, for testing
+class TestClient(object):
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.events = 0
+        self.bytes = 0
+
+    async def run(self, seconds):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        writer.write(b"GET /events HTTP/1.1\r\nHost: wgot\r\n\r\n")
+        end = time.time() + seconds
+        try:
+            while True:
+                line = await asyncio.wait_for(reader.readline(), max(end - time.time(), 0.001))
+                self.bytes = self.bytes + len(line)
+                if line.startswith(b"data: {"): # a sample
+                    self.events = self.events + 1
+        except asyncio.TimeoutError: # time's up
+            pass
+        writer.close()
+# --End TestClient class
+
+# --Define a function to publish synthetic samples to a demo server, in its own thread
+def demo_samples(server, rate, probes):
+    start = time.time()
+    while True:
+        time.sleep(1.0 / rate)
+        seconds = time.time() - start
+        tempc = np.array([20 + 160 * (1 - math.exp(-seconds / (60.0 + probe))) for probe in range(probes)])
+        server.publish_sample(seconds, tempc)
+# --End demo_samples function
+
+# --Define a function to fetch a page, for testing
+async def fetch(host, port, path):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(("GET " + path + " HTTP/1.1\r\nHost: wgot\r\n\r\n").encode('ascii'))
+    data = await reader.read()
+    writer.close()
+    head, body = data.split(b"\r\n\r\n", 1)
+    return head.split(b"\r\n")[0].decode('ascii'), len(body)
+# --End fetch function
+
+# --Define a function to run the test clients and print a report
+def test_clients(host, port, clients, seconds, server=None):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    testers = [TestClient(host, port) for count in range(clients)]
+    cpustart = time.process_time()
+    loop.run_until_complete(asyncio.gather(*[tester.run(seconds) for tester in testers]))
+    cputime = time.process_time() - cpustart
+    events = sum([tester.events for tester in testers])
+    print ("%d clients for %d sec: %d samples (%.0f/sec), %.0f KB received, %d to %d samples per client"
+           % (clients, seconds, events, events / float(seconds), sum([tester.bytes for tester in testers]) / 1024.0,
+              min([tester.events for tester in testers]), max([tester.events for tester in testers])))
+    for path in ('/graph.png', '/series.json?points=500', '/series.bin'):
+        status, length = loop.run_until_complete(fetch(host, port, path))
+        print ("%-24s %s, %d bytes" % (path, status, length))
+    if server != None: # the demo server is in this process, so its numbers are here too
+        stats = server.stats
+        print ("Server: %d samples published, each encoded once, %d events sent, %d dropped, CPU %.1f%% (with the clients)"
+               % (stats['samples'], stats['sent'], stats['dropped'], cputime * 100 / seconds))
+    loop.close()
+# --End test_clients function
+
+########################################
+# ----- Test the server with many clients from the command line
+########################################
+if __name__ == '__main__':
+    usage = "Usage: python3 WGOTserver.py [--clients=N] [--seconds=N] [--demo] [--rate=N] [--probes=N] [host:port]"
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'h', ['help', 'clients=', 'seconds=', 'demo', 'rate=', 'probes='])
+    except getopt.GetoptError as error:
+        print (error)
+        print (usage)
+        sys.exit(2)
+    clients = 50
+    seconds = 10
+    demo = False
+    rate = 20.0 # demo samples per second
+    probes = 1
+    address = 'localhost:8080'
+    if len(args) > 1:
+        print (usage)
+        sys.exit(2)
+    if len(args) == 1:
+        address = args[0]
+    for opt, value in opts:
+        if opt in ('-h', '--help'):
+            print (usage)
+            sys.exit()
+        elif opt == '--clients':
+            clients = int(value)
+        elif opt == '--seconds':
+            seconds = int(value)
+        elif opt == '--demo':
+            demo = True
+        elif opt == '--rate':
+            rate = float(value)
+        elif opt == '--probes':
+            probes = int(value)
+    host, port = address.rsplit(':', 1)
+    server = None
+    if demo == True: # serve synthetic samples, a graph and a series from this process
+        def snapshot(points): # a ready series, like the thermometer's
+            future = concurrent.futures.Future()
+            times = np.linspace(0, 60, points or 3600)
+            future.set_result((1, times, np.column_stack([70 + 300 * (1 - np.exp(-times / 20))] * probes)))
+            return future
+        server = LiveServer(host, int(port), snapshot)
+        server.start()
+        server.publish_frame(b"\xff\x00\x00\xff" * (320 * 240), (320, 240), 1) # a red graph
+        sampler = threading.Thread(target=demo_samples, args=(server, rate, probes), name='demo')
+        sampler.daemon = True
+        sampler.start()
+        time.sleep(0.1) # let the graph be published
+    test_clients(host, int(port), clients, seconds, server)
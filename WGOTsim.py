@@ -0,0 +1,219 @@
+#!/usr/bin/python3
+# Copyright (c) 2019 R.S. Fowler
+# Author: R.S. Fowler for WG Oven Thermometer project
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Simulated WGOT hardware, so Proto29.py can run without a Raspberry Pi
+#
+# - SimClock runs virtual time faster than real time, for quick tests.
+# - SimSensor stands in for the MAX31855 board, with a synthetic heat curve
+#   or a replay of a csv log, plus optional noise and probe faults.
+#   SimBus reads several of them, like WGOTprobe.BitBangBus.
+# - SimGPIO stands in for RPi.GPIO, and can press the PiTFT buttons from a
+#   script, calling the same callbacks as the real button events.
+# With SDL's "dummy" video driver, the whole programme then runs headless.
+#
+# The following command will run the thermometer at 100 times real time.
+#
+# python3 Proto29.py --sim --speed=100
+
+import time
+import math # used for the heat curve
+import random # used for probe noise and faults
+import threading # used to press buttons from a script
+from bisect import bisect_right # used to find replay times
+import WGOTprobe # MAX31855 words, the same as the real probes give
+
+########################################
+#----- Class Definitions
+########################################
+
+# --Define a class to run virtual time, 'speed' times faster than real time
+# Note: it has the same monotonic() and sleep() as the time module, so either can be used
+class SimClock(object):
+    def __init__(self, speed=1.0):
+        self.speed = float(speed)
+        self.realstart = time.monotonic() # virtual time starts at the real time
+
+    def monotonic(self): # virtual seconds
+        return self.realstart + (time.monotonic() - self.realstart) * self.speed
+
+    def sleep(self, seconds): # sleep for virtual seconds
+        time.sleep(seconds / self.speed)
+# --End SimClock class
+
+# --Define a class to stand in for the Adafruit MAX31855 board
+# Note: the temperature follows a heat curve from 'ambient' towards 'setpoint'
+#  with time constant 'tau' (sec), or replays the times and temperatures (C) of
+#  a csv log if 'replay' is given. It's quantised to 0.25 C like the real board.
+# 'probe' picks which probe's temperatures to replay from a multi-probe log.
+class SimSensor(object):
+    def __init__(self, clock, replay=None, noise=0.25, faultrate=0.0, ambient=20.0, setpoint=180.0, tau=600.0, seed=None, probe=0):
+        self.clock = clock
+        self.noise = noise # standard deviation of the noise in C
+        self.faultrate = faultrate # chance of an open circuit fault on each reading
+        self.ambient = ambient
+        self.setpoint = setpoint
+        self.tau = tau
+        self.random = random.Random(seed) # seeded, so runs can be repeated
+        self.start = clock.monotonic()
+        self.fault = False # whether the last reading had a fault
+        self.replaytimes = self.replaytemps = None
+        if replay != None:
+            self.replaytimes, self.replaytemps = read_replay(replay, probe)
+
+    def truetemp(self, elapsed): # the temperature without noise, at 'elapsed' seconds
+        if self.replaytimes == None: # follow the heat curve
+            return self.setpoint - (self.setpoint - self.ambient) * math.exp(-elapsed / self.tau)
+        index = min(bisect_right(self.replaytimes, elapsed), len(self.replaytimes) - 1)
+        if index == 0 or elapsed >= self.replaytimes[-1]: # before the start or after the end
+            return self.replaytemps[index]
+        before = self.replaytimes[index-1] # interpolate between the two readings
+        fraction = (elapsed - before) / (self.replaytimes[index] - before)
+        return self.replaytemps[index-1] + fraction * (self.replaytemps[index] - self.replaytemps[index-1])
+
+    def readTempC(self): # NaN if there's a fault, like the real board
+        self.fault = self.random.random() < self.faultrate
+        if self.fault == True:
+            return float('nan')
+        tempc = self.truetemp(self.clock.monotonic() - self.start) + self.random.gauss(0, self.noise)
+        return round(tempc * 4) / 4.0
+
+    def readInternalC(self): # the board warms up a little with the oven
+        return round((25.0 + (self.truetemp(self.clock.monotonic() - self.start) - self.ambient) * 0.02) * 16) / 16.0
+
+    def readState(self): # the fault flags for the last reading
+        return {'openCircuit': self.fault, 'shortGND': False, 'shortVCC': False, 'fault': self.fault}
+
+    def read32(self): # a reading as the 32 bit word the real board gives
+        tempc = self.readTempC()
+        return WGOTprobe.encode_word(tempc, self.readInternalC(), self.fault * 1) # bit 0 is open circuit
+# --End SimSensor class
+
+# --Define a class to read several simulated probes, like WGOTprobe.BitBangBus
+class SimBus(object):
+    name = 'sim'
+
+    def __init__(self, sensors):
+        self.sensors = sensors # a SimSensor for each probe, in order
+
+    def __len__(self): # the number of probes
+        return len(self.sensors)
+
+    def read_words(self): # read each probe's word, in one pass
+        return [sensor.read32() for sensor in self.sensors]
+
+    def read(self): # read and decode all of the probes
+        return WGOTprobe.decode_words(self.read_words())
+
+    def close(self):
+        pass
+# --End SimBus class
+
+# --Define a class to stand in for RPi.GPIO
+# Note: only what the thermometer uses is here. Output levels are kept in
+#  'levels' and counted in 'changes', so the LED can be checked.
+class SimGPIO(object):
+    BCM = 11
+    IN = 1
+    OUT = 0
+    PUD_UP = 22
+    FALLING = 32
+    HIGH = 1
+    LOW = 0
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.levels = {} # output levels by channel
+        self.changes = {} # number of output changes by channel
+        self.callbacks = {} # event callbacks by channel
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, channel, direction, pull_up_down=None):
+        self.levels[channel] = self.HIGH # inputs are pulled up, outputs start high
+
+    def output(self, channel, level):
+        if self.levels.get(channel) != level:
+            self.changes[channel] = self.changes.get(channel, 0) + 1
+        self.levels[channel] = level
+
+    def input(self, channel):
+        return self.levels.get(channel, self.HIGH)
+
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=None):
+        self.callbacks[channel] = callback
+
+    def cleanup(self):
+        pass
+
+    def press(self, channel): # press a button, calling its callback like a real button
+        if channel in self.callbacks:
+            self.callbacks[channel](channel)
+
+    def run_script(self, script): # press buttons at virtual times, from a script like "30:22,60:23"
+        presses = []
+        for item in script.split(','): # each item is seconds:channel
+            if item.strip() != '':
+                seconds, channel = item.split(':')
+                presses.append((float(seconds), int(channel)))
+        presser = threading.Thread(target=self.pressing, args=(sorted(presses),), name='simbuttons')
+        presser.daemon = True # don't keep the programme alive on exit
+        presser.start()
+
+    def pressing(self, presses): # the script thread
+        start = self.clock.monotonic()
+        for seconds, channel in presses:
+            delay = start + seconds - self.clock.monotonic()
+            if delay > 0:
+                self.clock.sleep(delay)
+            self.press(channel)
+# --End SimGPIO class
+
+########################################
+#----- Function Definitions
+########################################
+
+# --Define a function to read a csv log for SimSensor to replay
+# Note: restarts (00,00,00 lines) are skipped, and the times after each one are
+#  carried on from the time before it, so the replay is one continuous run.
+#  If the log doesn't have the probe, the first probe is used instead.
+# Returns lists of times (sec) and temperatures (C)
+def read_replay(filename, probe=0):
+    times = []
+    temps = []
+    offset = 0.0 # time added to the current session
+    with open(filename) as replayfile:
+        for line in replayfile:
+            values = line.strip().split(',')
+            if len(values) < 2 or values[0] == '00': # a restart or a partial line
+                if len(times) > 0:
+                    offset = times[-1]
+                continue
+            column = 1 + probe * 2 # each probe has a C and an F column
+            if column >= len(values):
+                column = 1
+            times.append(offset + float(values[0]))
+            temps.append(float(values[column]))
+    if len(times) == 0:
+        raise ValueError(filename + ' has no samples to replay')
+    return times, temps
+# --End read_replay function